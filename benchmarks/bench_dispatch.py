@@ -0,0 +1,63 @@
+"""
+Micro-benchmark: cost of routing one /ws frame through dispatch_ws_action.
+
+Handlers are called with a fake socket, so this measures lookup, schema
+validation, rate limiting and timing overhead without any network I/O.
+
+Run from the project folder:
+    python benchmarks/bench_dispatch.py
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeSocket:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_text(self, data):
+        self.sent += 1
+
+    async def send_bytes(self, data):
+        self.sent += 1
+
+
+async def run(frames, rounds):
+    ctx = main.WsContext(FakeSocket(), "bench-user")
+    peer = FakeSocket()
+    main.manager.active_connections[peer] = "bench-peer"
+    main.manager.subscribe(ctx.websocket, [main.DEFAULT_CHANNEL])
+    main.manager.subscribe(peer, [main.DEFAULT_CHANNEL])
+    # Benchmark the dispatcher, not the limiter's verdicts
+    for limiter in main.WS_RATE_LIMITS.values():
+        limiter.max_requests = limiter.rate = 10**12
+
+    for name, frame in frames:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await main.dispatch_ws_action(ctx, frame)
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16} {elapsed / rounds * 1e6:8.2f} µs/frame")
+
+
+def main_():
+    main.log.configure(levels="call=off,signal=off,message=off,typing=off")
+    frames = [
+        ("unknown type", {"type": "nope"}),
+        ("ping", {"type": "ping"}),
+        ("typing_start", {"type": "typing_start"}),
+        ("ice_candidate", {"type": "ice_candidate", "to": "bench-peer", "candidate": {"candidate": "x"}}),
+        ("invalid edit", {"type": "edit", "id": 5}),
+    ]
+    asyncio.run(run(frames, 20_000))
+
+
+if __name__ == "__main__":
+    main_()
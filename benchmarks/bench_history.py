@@ -0,0 +1,182 @@
+"""
+History replay benchmark: per-message cost of turning stored rows into frames.
+
+Run from the project folder (pip install msgpack for the binary rows):
+    python benchmarks/bench_history.py --messages 100000
+
+Seeds a throwaway chatter.db (texts with read receipts and reactions, replies,
+voice notes with waveforms) and compares, per message replayed at login:
+
+  dict     sqlite3.Row, json.loads of read_by/reactions, a fresh dict per
+           message, then codec.encode (how history was sent before)
+  record   plain row tuples in MessageRecord order through
+           codec.encode_record (read_by/reactions spliced in as stored)
+
+for each codec, plus memory held by the fetched rows and a full
+send_history() to a fake socket. Frames from both paths are checked to decode
+to the same message.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+USERS = [f"user{i}" for i in range(12)]
+WORDS = ("ok see you at lunch the build is green again can someone review my pull request "
+         "meeting moved to three thanks 👍 on my way did the printer die again").split()
+OLD_SELECT = """SELECT m.id, m.username, m.message, m.type, m.timestamp, m.reply_to, m.read_by,
+    m.file_size, m.original_name, m.reactions, m.channel_id, v.duration, v.peaks, v.opus_size
+    FROM messages m LEFT JOIN voice_notes v ON m.type = 'voice' AND v.media_key = m.message
+    ORDER BY m.timestamp"""
+
+
+class FakeSocket:
+    async def send_text(self, data):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+
+def seed(count, rng):
+    start = datetime(2024, 1, 1)
+    messages, voice = [], []
+    previous = None
+    for i in range(count):
+        kind = rng.choices(["text", "image", "voice"], [90, 6, 4])[0]
+        msg_id = str(uuid.uuid4())
+        if kind == "text":
+            content = " ".join(rng.choices(WORDS, k=rng.randint(2, 25)))
+        else:
+            content = f"{main.MEDIA_SUBDIRS[kind]}/{uuid.uuid4()}.{'jpg' if kind == 'image' else 'webm'}"
+        if kind == "voice":
+            voice.append((content, round(rng.uniform(1, 60), 2),
+                          json.dumps([rng.randint(0, 100) for _ in range(main.VOICE_PEAKS)]), 20_000))
+        reactions = {"👍": rng.sample(USERS, 2)} if rng.random() < 0.1 else {}
+        messages.append((msg_id, rng.choice(USERS), content, kind, (start + timedelta(seconds=i)).isoformat(),
+                         previous if rng.random() < 0.1 else None, json.dumps(rng.sample(USERS, rng.randint(0, 6))),
+                         0 if kind == "text" else rng.randint(10_000, 5_000_000),
+                         "IMG_0001.jpg" if kind == "image" else "", json.dumps(reactions), main.DEFAULT_CHANNEL))
+        previous = msg_id
+    with main.get_db() as conn:
+        conn.executemany("INSERT INTO messages VALUES (?,?,?,?,?,?,?,?,?,?,?)", messages)
+        conn.executemany("INSERT INTO voice_notes VALUES (?,?,?,?)", voice)
+        conn.commit()
+
+
+def fetch(row_factory):
+    with main.get_db() as conn:
+        c = conn.cursor()
+        c.row_factory = row_factory
+        c.execute(OLD_SELECT)
+        return c.fetchall()
+
+
+def frame_dict(msg):
+    """The dict history replay built for every message before MessageRecord."""
+    read_by = json.loads(msg['read_by']) if msg['read_by'] else []
+    reactions = json.loads(msg['reactions']) if msg['reactions'] else {}
+    frame = {
+        "type": msg['type'],
+        "id": msg['id'],
+        "user": msg['username'],
+        "msg": msg['message'],
+        "timestamp": msg['timestamp'],
+        "reply_to": msg['reply_to'],
+        "read_by": read_by,
+        "file_size": msg['file_size'],
+        "original_name": msg['original_name'],
+        "reactions": reactions,
+        "channel": msg['channel_id']
+    }
+    if msg['duration'] is not None:
+        frame["audio"] = main.audio_info(msg['message'], msg['duration'], msg['peaks'], msg['opus_size'])
+    return frame
+
+
+def rows_memory(row_factory):
+    tracemalloc.start()
+    rows = fetch(row_factory)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del rows
+    return size
+
+
+def per_message(fn, rows, rounds):
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for row in rows:
+            fn(row)
+        best = min(best, time.perf_counter() - started)
+    return best / len(rows)
+
+
+def check_same(codec, decode, rows, records):
+    for row, record in zip(rows[:2000], records[:2000]):
+        old, new = decode(codec.encode(frame_dict(row))), decode(codec.encode_record(record))
+        if old != new:
+            raise SystemExit(f"{codec.name}: frames differ for {row['id']}:\n{old}\n{new}")
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=100_000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="chat-history-")
+    os.chdir(workdir)
+    try:
+        main.prepare_storage()
+        seed(args.messages, random.Random(42))
+        rows, records = fetch(main.sqlite3.Row), fetch(None)
+        n = len(records)
+
+        codecs = [(main.JSON_CODEC, json.loads)]
+        if main.msgpack is not None:
+            back = main.WIRE_KEYS_BACK
+            codecs.append((main.WS_CODECS["msgpack"], lambda frame: {
+                back.get(k, k): v for k, v in main.msgpack.unpackb(frame, raw=False).items()}))
+        else:
+            print("msgpack is not installed: only JSON is measured (pip install msgpack)\n")
+
+        print(f"{n:,} messages; rows held after fetchall(): sqlite3.Row {rows_memory(main.sqlite3.Row) / 2**20:.1f} MB, "
+              f"tuples {rows_memory(None) / 2**20:.1f} MB\n")
+        print(f"{'codec':<9} {'path':<8} {'µs/msg':>8} {'total ms':>10}")
+        for codec, decode in codecs:
+            check_same(codec, decode, rows, records)
+            old = per_message(lambda row: codec.encode(frame_dict(row)), rows, args.rounds)
+            new = per_message(codec.encode_record, records, args.rounds)
+            for path, seconds in (("dict", old), ("record", new)):
+                print(f"{codec.name:<9} {path:<8} {seconds * 1e6:>8.2f} {seconds * n * 1000:>10.0f}")
+            print(f"{'':<9} {'speedup':<8} {old / new:>8.1f}x\n")
+
+        ws = FakeSocket()
+        for codec, _ in codecs:
+            main.manager.codecs[ws] = codec
+            started = time.perf_counter()
+            asyncio.run(main.send_history(ws, [main.DEFAULT_CHANNEL]))
+            elapsed = time.perf_counter() - started
+            print(f"send_history() {codec.name:<8} {elapsed * 1000:8.0f} ms  ({elapsed / n * 1e6:.2f} µs/msg incl. query)")
+    finally:
+        os.chdir(os.path.dirname(workdir))
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,64 @@
+"""
+Micro-benchmark: token-bucket RateLimiter vs the old list-of-datetimes limiter.
+
+Run from the project folder:
+    python benchmarks/bench_rate_limiter.py
+"""
+
+import os
+import sys
+import time
+import timeit
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import RateLimiter  # noqa: E402
+
+
+class ListRateLimiter:
+    """The previous implementation, kept here only for comparison."""
+
+    def __init__(self, max_requests=100, window_seconds=60):
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+        self.requests = defaultdict(list)
+
+    def is_allowed(self, client_ip):
+        now = datetime.now()
+        cutoff = now - timedelta(seconds=self.window_seconds)
+        self.requests[client_ip] = [t for t in self.requests[client_ip] if t > cutoff]
+        if len(self.requests[client_ip]) >= self.max_requests:
+            return False
+        self.requests[client_ip].append(now)
+        return True
+
+
+def bench(name, limiter, keys, calls):
+    def run():
+        for i in range(calls):
+            limiter.is_allowed(keys[i % len(keys)])
+
+    seconds = min(timeit.repeat(run, number=1, repeat=3))
+    print(f"{name:<14} {calls / seconds:>12,.0f} calls/s   {seconds / calls * 1e6:6.2f} µs/call")
+
+
+def main():
+    calls = 200_000
+    for n_keys in (1, 100, 10_000):
+        keys = [f"10.0.{i // 256}.{i % 256}" for i in range(n_keys)]
+        print(f"\n--- {n_keys} distinct keys, limit 200/60s ---")
+        bench("list (old)", ListRateLimiter(200, 60), keys, calls)
+        bench("token bucket", RateLimiter(200, 60), keys, calls)
+
+    print("\n--- memory: 50,000 one-off clients with max_keys=10,000 ---")
+    limiter = RateLimiter(200, 60, max_keys=10_000)
+    start = time.perf_counter()
+    for i in range(50_000):
+        limiter.is_allowed(f"client-{i}")
+    print(f"tracked keys: {len(limiter.buckets):,} (took {time.perf_counter() - start:.3f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Server benchmark: startup time and request throughput per event loop / HTTP parser.
+
+Run from the project folder (nothing else should be listening on the port):
+    python benchmarks/bench_server.py --duration 10 --connections 50
+
+For every combination that is installed (asyncio/uvloop x h11/httptools) it
+starts `python main.py`, measures the time until the first `GET /` answers,
+then hammers the server with keep-alive requests from asyncio clients:
+`/favicon.ico` (routing + middleware only) and `/` (the cached page).
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def installed(name):
+    return importlib.util.find_spec(name) is not None
+
+
+def wait_until_up(port, proc, timeout=30.0):
+    request = b"GET / HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n"
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as sock:
+                sock.sendall(request)
+                if sock.recv(12).startswith(b"HTTP/1.1 200"):
+                    return
+        except OSError:
+            time.sleep(0.02)
+    raise SystemExit("server did not come up")
+
+
+async def client(port, path, stop_at, counts):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = f"GET {path} HTTP/1.1\r\nHost: bench\r\nAccept-Encoding: gzip\r\n\r\n".encode()
+    try:
+        while time.perf_counter() < stop_at:
+            writer.write(request)
+            headers = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in headers.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":", 1)[1])
+            if length:
+                await reader.readexactly(length)
+            counts[0] += 1
+    finally:
+        writer.close()
+
+
+async def load(port, path, connections, duration):
+    counts = [0]
+    stop_at = time.perf_counter() + duration
+    await asyncio.gather(*(client(port, path, stop_at, counts) for _ in range(connections)))
+    return counts[0] / duration
+
+
+def run_case(loop, http, args):
+    cmd = [sys.executable, "main.py", "--host", "127.0.0.1", "--port", str(args.port),
+           "--loop", loop, "--http", http]
+    env = dict(os.environ, CHAT_LOG_LEVELS="connection=warning,server=warning,system=off")
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=PROJECT_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(args.port, proc)
+        startup = time.perf_counter() - started
+        results = {path: asyncio.run(load(args.port, path, args.connections, args.duration))
+                   for path in ("/favicon.ico", "/")}
+    finally:
+        proc.terminate()
+        proc.wait(10)
+    return startup, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per endpoint")
+    parser.add_argument("--connections", type=int, default=50)
+    args = parser.parse_args()
+
+    loops = ["asyncio"] + (["uvloop"] if installed("uvloop") and sys.platform != "win32" else [])
+    parsers = ["h11"] + (["httptools"] if installed("httptools") else [])
+    print(f"{'loop':<8} {'http':<10} {'startup':>9} {'favicon req/s':>14} {'page req/s':>11}")
+    for loop in loops:
+        for http in parsers:
+            startup, results = run_case(loop, http, args)
+            print(f"{loop:<8} {http:<10} {startup * 1000:>7.0f}ms "
+                  f"{results['/favicon.ico']:>14.0f} {results['/']:>11.0f}")
+    if len(loops) * len(parsers) == 1:
+        print("install uvloop and httptools to compare them against the defaults")
+
+
+if __name__ == "__main__":
+    main()
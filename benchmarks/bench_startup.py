@@ -0,0 +1,157 @@
+"""
+Startup benchmark: how long `import main` and a server start take.
+
+Run from the project folder (nothing else should be listening on the port):
+    python benchmarks/bench_startup.py --runs 5 --history 50000
+
+Everything runs in fresh interpreters inside a throwaway folder, so your real
+chatter.db and data/ are never touched:
+
+  import          `import main` (what tests, scripts and every worker pay);
+                  also reports any file or folder the import created
+  first start     `python main.py` on an empty folder until `GET /` answers
+                  (creates data/, the schema and the session key)
+  migrating start the same after seeding --history messages in the old
+                  layout (flat media keys, as written by early versions)
+  restart         later starts on the migrated data (median of --runs)
+
+--top N also prints the N slowest modules from `python -X importtime`.
+"""
+
+import argparse
+import os
+import shutil
+import signal
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_SNIPPET = "import time; started = time.perf_counter(); import main; print(time.perf_counter() - started)"
+
+
+def prepare_workdir():
+    """A throwaway copy of what main.py needs next to it."""
+    workdir = tempfile.mkdtemp(prefix="chat-startup-")
+    shutil.copytree(os.path.join(PROJECT_DIR, "static"), os.path.join(workdir, "static"))
+    for name in ("index.html", "call.html"):
+        if os.path.exists(os.path.join(PROJECT_DIR, name)):
+            shutil.copy(os.path.join(PROJECT_DIR, name), workdir)
+    return workdir
+
+
+def environment():
+    return dict(os.environ, PYTHONPATH=PROJECT_DIR, PYTHONDONTWRITEBYTECODE="1",
+                CHAT_LOG_LEVELS="connection=warning,server=warning,system=off")
+
+
+def time_import(workdir):
+    result = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET], cwd=workdir, env=environment(),
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(workdir, top):
+    """(cumulative µs, self µs, module) of the slowest imports under `import main`."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=workdir,
+                            env=environment(), capture_output=True, text=True, check=True)
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, cumulative, module = line[len("import time:"):].split("|")
+        rows.append((int(cumulative), int(own), module.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def wait_until_up(port, proc, timeout=60.0):
+    request = b"GET / HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n"
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1) as sock:
+                sock.sendall(request)
+                if sock.recv(12).startswith(b"HTTP/1.1 200"):
+                    return
+        except OSError:
+            time.sleep(0.01)
+    raise SystemExit("server did not come up")
+
+
+def time_start(workdir, port):
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(PROJECT_DIR, "main.py"), "--host", "127.0.0.1",
+                             "--port", str(port)], cwd=workdir, env=environment(),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port, proc)
+        return time.perf_counter() - started
+    finally:
+        proc.send_signal(signal.SIGINT if sys.platform == "win32" else signal.SIGTERM)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def seed_history(db_path, count):
+    """Messages as old versions stored them: one in ten is media under a flat file name."""
+    conn = sqlite3.connect(db_path, timeout=30)
+    start = datetime(2024, 1, 1)
+    rows = []
+    for i in range(count):
+        media = i % 10 == 0
+        rows.append((str(uuid.uuid4()), f"seed_{i % 20}", f"IMG_{i:06d}.jpg" if media else f"history message {i}",
+                     "image" if media else "text", (start + timedelta(seconds=i)).isoformat()))
+    with conn:
+        conn.executemany("INSERT INTO messages (id, username, message, type, timestamp) VALUES (?,?,?,?,?)", rows)
+    conn.close()
+
+
+def listing(folder):
+    return {os.path.relpath(os.path.join(root, name), folder)
+            for root, dirs, files in os.walk(folder) for name in dirs + files}
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8798)
+    parser.add_argument("--runs", type=int, default=5, help="imports and restarts to take the median of")
+    parser.add_argument("--history", type=int, default=50_000, help="messages seeded before the migrating start")
+    parser.add_argument("--top", type=int, default=0, help="also list the N slowest imports")
+    args = parser.parse_args()
+
+    workdir = prepare_workdir()
+    try:
+        before = listing(workdir)
+        imports = [time_import(workdir) for _ in range(args.runs)]
+        created = sorted(listing(workdir) - before)
+        print(f"{'import':<18} {statistics.median(imports) * 1000:>8.0f}ms  (min {min(imports) * 1000:.0f}ms)")
+        print(f"{'':<18} created by import: {', '.join(created) if created else 'nothing'}")
+
+        print(f"{'first start':<18} {time_start(workdir, args.port) * 1000:>8.0f}ms")
+        seed_history(os.path.join(workdir, "chatter.db"), args.history)
+        print(f"{'migrating start':<18} {time_start(workdir, args.port) * 1000:>8.0f}ms  "
+              f"({args.history:,} messages seeded)")
+        restarts = [time_start(workdir, args.port) for _ in range(args.runs)]
+        print(f"{'restart':<18} {statistics.median(restarts) * 1000:>8.0f}ms  (min {min(restarts) * 1000:.0f}ms)")
+
+        if args.top:
+            print(f"\n{'cumulative':>11} {'self':>9}  module")
+            for cumulative, own, module in slowest_imports(workdir, args.top):
+                print(f"{cumulative / 1000:>9.1f}ms {own / 1000:>7.1f}ms  {module}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main_()
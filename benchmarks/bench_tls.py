@@ -0,0 +1,111 @@
+"""
+TLS handshake benchmark: ECDSA vs RSA certificates, full vs resumed handshakes.
+
+Run from the project folder (needs `cryptography`; nothing else on the port):
+    python benchmarks/bench_tls.py --duration 5
+
+For each key type it generates a throw-away certificate, starts
+`python main.py --ssl`, and then a local client opens as many TLS connections
+as it can, each sending one `GET /favicon.ico`:
+  full     - a fresh handshake every time (first visit)
+  resumed  - the session from the previous connection is offered (reconnect)
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from generate_ssl import generate_certificate  # noqa: E402
+
+REQUEST = b"GET /favicon.ico HTTP/1.1\r\nHost: bench\r\nConnection: close\r\n\r\n"
+
+
+def client_context(max_version=None):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    if max_version is not None:
+        context.maximum_version = max_version
+    return context
+
+
+def one_request(context, port, session=None):
+    with socket.create_connection(("127.0.0.1", port)) as raw:
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with context.wrap_socket(raw, server_hostname="localhost", session=session) as tls:
+            tls.sendall(REQUEST)
+            while tls.recv(4096):  # TLS 1.3 tickets arrive with the response
+                pass
+            return tls.session, tls.session_reused
+
+
+def wait_until_up(port, proc, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        try:
+            one_request(client_context(), port)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise SystemExit("server did not come up")
+
+
+def measure(port, duration, resume, max_version):
+    context = client_context(max_version)
+    session, _ = one_request(context, port)
+    done = reused = 0
+    stop_at = time.perf_counter() + duration
+    while time.perf_counter() < stop_at:
+        new_session, was_reused = one_request(context, port, session if resume else None)
+        if resume:
+            session = new_session
+        done += 1
+        reused += was_reused
+    return done / duration, reused / max(done, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8798)
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per measurement")
+    parser.add_argument("--tls", choices=["1.2", "1.3"], default="1.3",
+                        help="maximum TLS version offered by the client")
+    args = parser.parse_args()
+
+    max_version = ssl.TLSVersion.TLSv1_2 if args.tls == "1.2" else None
+    print(f"{'key':<6} {'handshake':<9} {'conn/s':>8} {'resumed':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for key_type in ("ecdsa", "rsa"):
+            cert, key = os.path.join(tmp, f"{key_type}.pem"), os.path.join(tmp, f"{key_type}.key")
+            with contextlib.redirect_stdout(io.StringIO()):
+                generate_certificate("127.0.0.1", key_type, cert, key)
+            env = dict(os.environ, CHAT_LOG_LEVELS="connection=warning,server=warning,system=off")
+            proc = subprocess.Popen(
+                [sys.executable, "main.py", "--ssl", "--cert", cert, "--key", key,
+                 "--host", "127.0.0.1", "--port", str(args.port)],
+                cwd=PROJECT_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                wait_until_up(args.port, proc)
+                for resume in (False, True):
+                    rate, reused = measure(args.port, args.duration, resume, max_version)
+                    label = "resumed" if resume else "full"
+                    print(f"{key_type:<6} {label:<9} {rate:>8.0f} {reused:>7.0%}")
+            finally:
+                proc.terminate()
+                proc.wait(10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Upload throughput benchmark: streams ~1GB of mixed files to a running server.
+
+Start the server first, then run from the project folder:
+    python benchmarks/bench_upload.py --url http://localhost:8000 --total-mb 1024
+
+Each request carries a few files of different sizes (small images, mid-size
+documents, large videos), like a real gallery drop. The body is generated on
+the fly so the client never holds more than one chunk in memory. The payload
+is random bytes, so thumbnail errors in the server log are expected.
+"""
+
+import argparse
+import http.client
+import os
+import random
+import ssl
+import time
+import uuid
+from urllib.parse import urlparse
+
+CHUNK = 1024 * 1024
+
+# (extension, content type, size in bytes)
+MIX = [
+    ("jpg", "image/jpeg", 300 * 1024),
+    ("png", "image/png", 2 * 1024 * 1024),
+    ("pdf", "application/pdf", 8 * 1024 * 1024),
+    ("mp4", "video/mp4", 60 * 1024 * 1024),
+]
+
+
+def build_batch(rng, batch_bytes):
+    files = []
+    total = 0
+    while total < batch_bytes:
+        ext, ctype, size = rng.choice(MIX)
+        files.append((f"bench-{len(files)}.{ext}", ctype, size))
+        total += size
+    return files
+
+
+def part_header(boundary, name, ctype):
+    return (f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="files"; filename="{name}"\r\n'
+            f"Content-Type: {ctype}\r\n\r\n").encode()
+
+
+def multipart_body(files, boundary, payload):
+    """Yield the multipart body chunk by chunk; payload is a reusable random block."""
+    for name, ctype, size in files:
+        yield part_header(boundary, name, ctype)
+        remaining = size
+        while remaining:
+            n = min(remaining, len(payload))
+            yield payload[:n]
+            remaining -= n
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def body_length(files, boundary):
+    closing = len(f"--{boundary}--\r\n")
+    return closing + sum(len(part_header(boundary, name, ctype)) + size + 2 for name, ctype, size in files)
+
+
+def upload(conn, files):
+    boundary = uuid.uuid4().hex
+    length = body_length(files, boundary)
+    payload = memoryview(os.urandom(CHUNK))
+    conn.putrequest("POST", "/upload")
+    conn.putheader("Content-Type", f"multipart/form-data; boundary={boundary}")
+    conn.putheader("Content-Length", str(length))
+    conn.endheaders()
+    for chunk in multipart_body(files, boundary, payload):
+        conn.send(chunk)
+    response = conn.getresponse()
+    response.read()
+    if response.status != 200:
+        raise SystemExit(f"upload failed: HTTP {response.status}")
+    return length
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--total-mb", type=int, default=1024, help="total payload to send")
+    parser.add_argument("--batch-mb", type=int, default=128, help="payload per request")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    url = urlparse(args.url)
+    if url.scheme == "https":
+        conn = http.client.HTTPSConnection(url.hostname, url.port or 443,
+                                           context=ssl._create_unverified_context())
+    else:
+        conn = http.client.HTTPConnection(url.hostname, url.port or 80)
+
+    rng = random.Random(args.seed)
+    target = args.total_mb * 1024 * 1024
+    sent = files_sent = requests = 0
+    started = time.perf_counter()
+    while sent < target:
+        batch = build_batch(rng, min(args.batch_mb * 1024 * 1024, target - sent))
+        sent += upload(conn, batch)
+        files_sent += len(batch)
+        requests += 1
+    elapsed = time.perf_counter() - started
+
+    print(f"{files_sent} files in {requests} requests, {sent / 1e6:.0f} MB in {elapsed:.2f}s")
+    print(f"throughput: {sent / 1e6 / elapsed:.1f} MB/s")
+    print("note: uploaded files stay in data/media/ - remove them with /api/cleanup-orphans")
+
+
+if __name__ == "__main__":
+    main()
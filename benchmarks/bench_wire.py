@@ -0,0 +1,150 @@
+"""
+Wire format benchmark: JSON vs MessagePack (with and without short keys).
+
+Run from the project folder (pip install msgpack for the binary rows):
+    python benchmarks/bench_wire.py --history 2000 --clients 200
+
+Three workloads, each encoded the way main.py sends it:
+  history    every stored message replayed to one client at login
+  fan-out    one chat message broadcast to --clients sockets (encoded once,
+             decoded by every client)
+  signaling  a video call SDP offer plus its ICE candidates
+
+For each codec it prints bytes on the wire (raw, and after permessage-deflate
+with context takeover, which uvicorn negotiates unless --no-ws-compression)
+and encode/decode CPU time. Decoding runs in Python here; browsers do the
+same work in app.js, so treat those numbers as relative, not absolute.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+USERS = [f"user{i}" for i in range(12)]
+WORDS = ("ok see you at lunch the build is green again can someone review my pull request "
+         "meeting moved to three thanks 👍 on my way did the printer die again").split()
+
+
+def history_messages(count, rng):
+    messages = []
+    for i in range(count):
+        kind = rng.choices(["text", "image", "file", "voice"], [80, 10, 6, 4])[0]
+        if kind == "text":
+            content = " ".join(rng.choices(WORDS, k=rng.randint(2, 25)))
+            original_name = ""
+        else:
+            content = f"{kind}s/{rng.getrandbits(64):016x}.{ {'image': 'jpg', 'file': 'pdf', 'voice': 'webm'}[kind]}"
+            original_name = f"IMG_{i:04d}.jpg" if kind == "image" else ""
+        reactions = {"👍": rng.sample(USERS, 2)} if rng.random() < 0.1 else {}
+        messages.append({
+            "type": kind,
+            "id": f"{rng.getrandbits(128):032x}",
+            "user": rng.choice(USERS),
+            "msg": content,
+            "timestamp": f"2024-05-{1 + i // 5000:02d}T{(i // 60) % 24:02d}:{i % 60:02d}:00.{i:06d}",
+            "reply_to": messages[-1]["id"] if messages and rng.random() < 0.1 else None,
+            "read_by": rng.sample(USERS, rng.randint(0, 6)),
+            "file_size": rng.randint(10_000, 5_000_000) if kind != "text" else 0,
+            "original_name": original_name,
+            "reactions": reactions,
+        })
+    return messages
+
+
+def signaling_frames(rng):
+    lines = ["v=0", f"o=- {rng.getrandbits(62)} 2 IN IP4 127.0.0.1", "s=-", "t=0 0",
+             "a=group:BUNDLE 0 1", "a=msid-semantic: WMS stream"]
+    for mid, kind in enumerate(("audio", "video")):
+        lines += [f"m={kind} 9 UDP/TLS/RTP/SAVPF 111 96 97 98 99 100 101",
+                  "c=IN IP4 0.0.0.0", "a=rtcp:9 IN IP4 0.0.0.0",
+                  f"a=ice-ufrag:{rng.getrandbits(32):08x}", f"a=ice-pwd:{rng.getrandbits(128):032x}",
+                  "a=fingerprint:sha-256 " + ":".join(f"{rng.getrandbits(8):02X}" for _ in range(32)),
+                  "a=setup:actpass", f"a=mid:{mid}", "a=sendrecv", "a=rtcp-mux"]
+        lines += [f"a=rtpmap:{pt} {'opus/48000/2' if kind == 'audio' else 'VP8/90000'}" for pt in (111, 96, 97)]
+        lines += [f"a=rtcp-fb:96 {fb}" for fb in ("goog-remb", "transport-cc", "ccm fir", "nack", "nack pli")]
+        lines += [f"a=ssrc:{rng.getrandbits(31)} cname:{rng.getrandbits(64):016x}" for _ in range(4)]
+    frames = [{"type": "webrtc_offer", "from": "user1",
+               "offer": {"type": "offer", "sdp": "\r\n".join(lines) + "\r\n"}}]
+    for i in range(12):
+        frames.append({"type": "ice_candidate", "from": "user1", "candidate": {
+            "candidate": f"candidate:{rng.getrandbits(32)} 1 udp 2122260223 192.168.1.{i + 2} {50000 + i} typ host generation 0",
+            "sdpMid": str(i % 2), "sdpMLineIndex": i % 2, "usernameFragment": "abcd"}})
+    return frames
+
+
+def codecs():
+    rows = [("json", json.dumps, json.loads)]
+    if msgpack is not None:
+        rows.append(("msgpack", msgpack.packb, lambda frame: msgpack.unpackb(frame, raw=False)))
+        back = main.WIRE_KEYS_BACK
+        # What main.py actually sends to msgpack clients, and what app.js undoes
+        rows.append(("msgpack+short", main.MsgpackCodec.encode,
+                     lambda frame: {back.get(k, k): v for k, v in msgpack.unpackb(frame, raw=False).items()}))
+    return rows
+
+
+def deflated_size(frames):
+    """Bytes after permessage-deflate with context takeover (one stream per socket)."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    total = 0
+    for frame in frames:
+        data = frame.encode() if isinstance(frame, str) else frame
+        total += len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return total
+
+
+def measure(encode, decode, messages, receivers, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        frames = [encode(message) for message in messages]
+    encode_s = (time.perf_counter() - started) / rounds
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for frame in frames:
+            decode(frame)
+    decode_s = (time.perf_counter() - started) / rounds * receivers
+    size = sum(len(frame.encode() if isinstance(frame, str) else frame) for frame in frames)
+    return size * receivers, deflated_size(frames) * receivers, encode_s, decode_s
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--history", type=int, default=2000, help="messages replayed at login")
+    parser.add_argument("--clients", type=int, default=200, help="sockets a broadcast goes to")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    history = history_messages(args.history, rng)
+    workloads = [
+        (f"history ({args.history} msgs)", history, 1),
+        (f"fan-out (x{args.clients})", [history[-1]], args.clients),
+        ("signaling (offer+12 ICE)", signaling_frames(rng), 1),
+    ]
+    if msgpack is None:
+        print("msgpack is not installed: only JSON is measured (pip install msgpack)\n")
+
+    print(f"{'workload':<26} {'codec':<14} {'bytes':>10} {'deflated':>10} {'encode ms':>10} {'decode ms':>10}")
+    for name, messages, receivers in workloads:
+        for codec, encode, decode in codecs():
+            size, deflated, encode_s, decode_s = measure(encode, decode, messages, receivers, args.rounds)
+            print(f"{name:<26} {codec:<14} {size:>10,} {deflated:>10,} "
+                  f"{encode_s * 1000:>10.2f} {decode_s * 1000:>10.2f}")
+        print()
+
+
+if __name__ == "__main__":
+    main_()
@@ -0,0 +1,180 @@
+"""
+Group call load test: N headless participants in one SFU room.
+
+Run from the project folder (needs aiortc and websockets):
+    python benchmarks/load_sfu.py --clients 6 --duration 20
+
+It starts `python sfu.py` and `python main.py` (with CHAT_SFU pointing at it),
+then every client logs in over /ws, sends `sfu_join` (the first one starts
+the room and invites the rest), answers the SFU's
+offers and publishes a synthetic camera + microphone (aiortc test tracks).
+At the end it reports join-to-connected time, the video frame rate each
+client receives from every other participant, and SFU CPU/RSS.
+Use --url to target an already running main.py (with its own SFU) instead.
+
+All synthetic clients share this one Python process, and aiortc encodes and
+decodes in Python too: past 4-5 clients the load generator itself becomes the
+bottleneck, so treat frame rates at higher --clients as a lower bound.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import psutil
+import websockets
+from aiortc import RTCConfiguration, RTCPeerConnection, RTCSessionDescription
+from aiortc.mediastreams import AudioStreamTrack, MediaStreamError, VideoStreamTrack
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Client:
+    def __init__(self, index: int, url: str):
+        self.username = f"sfu_bench_{index}"
+        self.url = url
+        self.pc = RTCPeerConnection(RTCConfiguration(iceServers=[]))
+        self.streams = {}          # mid -> publishing user
+        self.frames = {}           # publishing user -> video frames received
+        self.published = False
+        self.room = None
+        self.join_started = None
+        self.connected_after = None
+
+    async def run(self, stop: asyncio.Event, room: asyncio.Future, invite: Optional[list]):
+        async with websockets.connect(self.url, max_size=None) as ws:
+            await ws.send(json.dumps({"username": self.username, "password": "bench"}))
+            while json.loads(await ws.recv()).get("type") != "login_success":
+                pass
+
+            @self.pc.on("track")
+            def on_track(track):
+                if track.kind == "video":
+                    mid = next(t.mid for t in self.pc.getTransceivers() if t.receiver.track is track)
+                    asyncio.ensure_future(self.count_frames(mid, track))
+
+            @self.pc.on("connectionstatechange")
+            def on_state():
+                if self.pc.connectionState == "connected" and self.connected_after is None:
+                    self.connected_after = time.perf_counter() - self.join_started
+
+            # The server names the room; everyone after the first joins it by invitation
+            join = {"type": "sfu_join", "invite": invite} if invite is not None else {"type": "sfu_join", "room": await room}
+            self.join_started = time.perf_counter()
+            await ws.send(json.dumps(join))
+            receiver = asyncio.ensure_future(self.signaling(ws, room))
+            await stop.wait()
+            receiver.cancel()
+            await ws.send(json.dumps({"type": "sfu_leave", "room": self.room}))
+        await self.pc.close()
+
+    async def signaling(self, ws, room: asyncio.Future):
+        async for raw in ws:
+            message = json.loads(raw)
+            if message.get("type") == "sfu_joined":
+                self.room = message["room"]
+                if not room.done():
+                    room.set_result(self.room)
+                continue
+            if message.get("type") != "sfu_offer":
+                continue
+            self.streams = message["streams"]
+            await self.pc.setRemoteDescription(RTCSessionDescription(message["sdp"], "offer"))
+            if not self.published:
+                # Land on the SFU's two recvonly uplink m-lines
+                for transceiver in self.pc.getTransceivers()[:2]:
+                    track = AudioStreamTrack() if transceiver.kind == "audio" else VideoStreamTrack()
+                    transceiver.sender.replaceTrack(track)
+                    transceiver.direction = "sendonly"
+                self.published = True
+            answer = await self.pc.createAnswer()
+            await self.pc.setLocalDescription(answer)
+            await ws.send(json.dumps({"type": "sfu_answer", "room": self.room, "sdp": self.pc.localDescription.sdp}))
+
+    async def count_frames(self, mid, track):
+        try:
+            while True:
+                await track.recv()
+                user = self.streams.get(mid, "?")
+                self.frames[user] = self.frames.get(user, 0) + 1
+        except MediaStreamError:
+            pass
+
+
+def start(cmd, env=None):
+    return subprocess.Popen(cmd, cwd=PROJECT_DIR, env=dict(os.environ, **(env or {})),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_for_port(port, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise SystemExit(f"nothing listening on {port}")
+
+
+async def main(args):
+    processes = []
+    sfu_process = None
+    url = args.url
+    if url is None:
+        sfu_process = start([sys.executable, "sfu.py", "--port", str(args.sfu_port)])
+        processes.append(sfu_process)
+        await wait_for_port(args.sfu_port)
+        processes.append(start([sys.executable, "main.py", "--host", "127.0.0.1", "--port", str(args.port)],
+                               {"CHAT_SFU": f"127.0.0.1:{args.sfu_port}",
+                                "CHAT_LOG_LEVELS": "connection=warning,call=warning,system=off"}))
+        await wait_for_port(args.port)
+        url = f"ws://127.0.0.1:{args.port}/ws"
+
+    try:
+        stop = asyncio.Event()
+        clients = [Client(i, url) for i in range(args.clients)]
+        room = asyncio.get_running_loop().create_future()
+        tasks = []
+        for client in clients:
+            invite = [other.username for other in clients[1:]] if client is clients[0] else None
+            tasks.append(asyncio.ensure_future(client.run(stop, room, invite)))
+            await asyncio.sleep(args.stagger)
+        sfu_stats = psutil.Process(sfu_process.pid) if sfu_process else None
+        if sfu_stats:
+            sfu_stats.cpu_percent()
+        await asyncio.sleep(args.duration)
+        cpu = sfu_stats.cpu_percent() if sfu_stats else None
+        rss = sfu_stats.memory_info().rss if sfu_stats else None
+        stop.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait(10)
+
+    print(f"{args.clients} clients, {args.duration:.0f}s")
+    for client in clients:
+        connected = f"{client.connected_after * 1000:.0f}ms" if client.connected_after else "never"
+        rates = ", ".join(f"{user[-2:].strip('_')}:{count / args.duration:.0f}"
+                          for user, count in sorted(client.frames.items()))
+        print(f"  {client.username:<14} connected {connected:>7}  fps from peers: {rates or '-'}")
+    if cpu is not None:
+        print(f"SFU process: {cpu:.0f}% CPU, {rss / 1e6:.0f} MB RSS")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=6)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--stagger", type=float, default=0.5, help="seconds between joins")
+    parser.add_argument("--port", type=int, default=8797)
+    parser.add_argument("--sfu-port", type=int, default=8796)
+    parser.add_argument("--url", help="ws:// URL of a running server (skips starting processes)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,380 @@
+"""
+Chat load test: hundreds of simulated clients against /ws and /upload.
+
+Run from the project folder (needs websockets and psutil):
+    python benchmarks/load_test.py --clients 200 --duration 30 --mix mixed
+    python benchmarks/load_test.py --mix text=5,typing=3,read=2 --rate 1
+
+By default it starts its own `python main.py` in a throwaway folder (fresh
+chatter.db and data/, seeded with --history messages), so it never touches
+your real chat. Every client logs in, receives the history, then performs
+random actions from the chosen mix at --rate actions per second:
+
+    text      text message             voice     voice message (key only, no audio)
+    typing    typing_start/typing_stop read      mark_read on recent messages
+    reaction  reaction_add             call      call_initiate + ICE burst + call_end
+    upload    POST /upload (256KB file) followed by a file message
+
+Message contents carry the send time, so every client that receives a
+broadcast records its end-to-end delivery latency. The report shows login and
+history latency, delivery percentiles, throughput and server CPU/RSS.
+
+All clients share this one process: if "generator lag" in the report is high,
+the numbers describe the load generator, not the server. Use --url (and --pid
+for CPU/RSS) to target a server you started yourself.
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
+
+import psutil
+import websockets
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MARKER = "lt:"
+
+MIXES = {
+    "chat": {"text": 6, "typing": 4, "read": 3, "reaction": 1},
+    "mixed": {"text": 5, "voice": 1, "typing": 4, "read": 3, "reaction": 2, "call": 1, "upload": 1},
+    "calls": {"text": 1, "typing": 1, "call": 4},
+    "media": {"text": 2, "voice": 2, "read": 1, "upload": 3},
+}
+UPLOAD_BYTES = 256 * 1024
+ICE_BURST = 15
+
+
+def parse_mix(value):
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for item in value.split(","):
+        action, _, weight = item.partition("=")
+        if action not in MIXES["mixed"]:
+            raise argparse.ArgumentTypeError(f"unknown action {action!r}")
+        mix[action] = float(weight or 1)
+    return mix
+
+
+def percentiles(values):
+    if not values:
+        return "-"
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] * 1000
+    return (f"p50 {pick(0.50):7.1f}  p90 {pick(0.90):7.1f}  "
+            f"p99 {pick(0.99):7.1f}  max {values[-1] * 1000:7.1f} ms  (n={len(values)})")
+
+
+class Stats:
+    def __init__(self):
+        self.login = []
+        self.history = []
+        self.delivery = []
+        self.upload = []
+        self.sent = Counter()
+        self.received = 0
+        self.rate_limited = Counter()
+        self.errors = Counter()
+
+
+class Client:
+    def __init__(self, index, args, stats, online):
+        self.index = index
+        self.username = f"load_{index:04d}"
+        self.args = args
+        self.stats = stats
+        self.online = online          # usernames of logged-in clients (shared)
+        self.rng = random.Random(index)
+        self.recent = []              # ids of recent messages from others
+        self.seq = 0
+
+    async def run(self, stop_at):
+        try:
+            async with websockets.connect(self.args.ws_url, max_size=None) as ws:
+                await self.login(ws)
+                self.online.append(self.username)
+                reader = asyncio.ensure_future(self.read(ws))
+                try:
+                    await self.act(ws, stop_at)
+                finally:
+                    reader.cancel()
+        except (OSError, websockets.WebSocketException) as e:
+            self.stats.errors[type(e).__name__] += 1
+
+    async def login(self, ws):
+        started = time.perf_counter()
+        await ws.send(json.dumps({"username": self.username, "password": "load-test"}))
+        while True:
+            message = json.loads(await ws.recv())
+            if message.get("type") == "login_success":
+                break
+            if message.get("type") == "error":
+                raise websockets.WebSocketException(message.get("msg"))
+        logged_in = time.perf_counter()
+        self.stats.login.append(logged_in - started)
+        # The server replays history before reading our next frame, so the
+        # pong marks the end of it
+        await ws.send(json.dumps({"type": "ping"}))
+        while True:
+            message = json.loads(await ws.recv())
+            if message.get("type") == "pong":
+                break
+            self.remember(message)
+        self.stats.history.append(time.perf_counter() - logged_in)
+
+    def remember(self, message):
+        if message.get("id") and message.get("user") not in (None, self.username):
+            self.recent.append(message["id"])
+            del self.recent[:-50]
+
+    async def read(self, ws):
+        async for raw in ws:
+            self.stats.received += 1
+            message = json.loads(raw)
+            kind = message.get("type")
+            if kind == "rate_limited":
+                self.stats.rate_limited[message.get("action")] += 1
+                continue
+            # text/voice carry the marker in msg, file messages in original_name
+            for content in (message.get("msg"), message.get("original_name")):
+                if isinstance(content, str) and MARKER in content:
+                    sent_at = int(content.rsplit(":", 1)[1].split(".", 1)[0]) / 1e9
+                    self.stats.delivery.append(time.perf_counter() - sent_at)
+            self.remember(message)
+
+    def marker(self):
+        self.seq += 1
+        return f"{MARKER}{self.index}:{self.seq}:{time.perf_counter_ns()}"
+
+    async def act(self, ws, stop_at):
+        actions = list(self.args.mix)
+        weights = [self.args.mix[a] for a in actions]
+        while True:
+            delay = self.rng.expovariate(self.args.rate)
+            if time.perf_counter() + delay >= stop_at:
+                await asyncio.sleep(max(0.0, stop_at - time.perf_counter()))
+                return
+            await asyncio.sleep(delay)
+            action = self.rng.choices(actions, weights)[0]
+            await getattr(self, f"do_{action}")(ws)
+            self.stats.sent[action] += 1
+
+    async def send(self, ws, payload):
+        await ws.send(json.dumps(payload))
+
+    async def do_text(self, ws):
+        await self.send(ws, {"type": "text", "content": self.marker()})
+
+    async def do_voice(self, ws):
+        await self.send(ws, {"type": "voice", "content": f"voice/{self.marker()}.webm"})
+
+    async def do_typing(self, ws):
+        await self.send(ws, {"type": "typing_start"})
+        await asyncio.sleep(self.rng.uniform(0.5, 2.0))
+        await self.send(ws, {"type": "typing_stop"})
+
+    async def do_read(self, ws):
+        if self.recent:
+            await self.send(ws, {"type": "mark_read", "ids": self.recent[-20:]})
+
+    async def do_reaction(self, ws):
+        if self.recent:
+            emoji = self.rng.choice(["👍", "❤️", "😂"])
+            await self.send(ws, {"type": "reaction_add", "id": self.rng.choice(self.recent), "emoji": emoji})
+
+    async def do_call(self, ws):
+        peers = [u for u in self.online if u != self.username]
+        if not peers:
+            return
+        to = self.rng.choice(peers)
+        await self.send(ws, {"type": "call_initiate", "to": to, "callType": "video"})
+        for i in range(ICE_BURST):
+            await self.send(ws, {"type": "ice_candidate", "to": to, "candidate": {
+                "candidate": f"candidate:{i} 1 udp 2122260223 192.0.2.{i} 5{i:04d} typ host",
+                "sdpMid": "0", "sdpMLineIndex": 0}})
+        await self.send(ws, {"type": "call_end", "to": to})
+
+    async def do_upload(self, ws):
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        status, body = await loop.run_in_executor(None, upload, self.args.http_url, self.index)
+        if status == 429:
+            self.stats.rate_limited["upload"] += 1
+            return
+        if status != 200:
+            self.stats.errors[f"upload HTTP {status}"] += 1
+            return
+        self.stats.upload.append(time.perf_counter() - started)
+        for item in json.loads(body)["files"]:
+            await self.send(ws, {"type": "file", "content": item["filename"],
+                                 "file_size": UPLOAD_BYTES, "original_name": self.marker()})
+
+
+def upload(http_url, index):
+    """Blocking multipart POST of one random file (runs in the default executor)."""
+    url = urlparse(http_url)
+    conn = http.client.HTTPConnection(url.hostname, url.port, timeout=60)
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="files"; filename="load-{index}.bin"\r\n'
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    body += os.urandom(UPLOAD_BYTES) + f"\r\n--{boundary}--\r\n".encode()
+    try:
+        conn.request("POST", "/upload", body, {"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+
+async def watch_lag(stop_at, lags, interval=0.1):
+    """How late this process wakes up: the generator's own saturation."""
+    while time.perf_counter() < stop_at:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+def prepare_workdir():
+    """A throwaway copy of what main.py needs, so the real chatter.db stays untouched."""
+    workdir = tempfile.mkdtemp(prefix="chat-load-")
+    shutil.copytree(os.path.join(PROJECT_DIR, "static"), os.path.join(workdir, "static"))
+    for name in ("index.html", "call.html"):
+        if os.path.exists(os.path.join(PROJECT_DIR, name)):
+            shutil.copy(os.path.join(PROJECT_DIR, name), workdir)
+    return workdir
+
+
+def seed_history(db_path, count):
+    conn = sqlite3.connect(db_path, timeout=30)
+    start = datetime(2024, 1, 1)
+    rows = [(str(uuid.uuid4()), f"seed_{i % 20}", f"history message {i} " + "x" * (i % 120),
+             "text", (start + timedelta(seconds=i)).isoformat(), None, "[]", 0, "", "{}")
+            for i in range(count)]
+    with conn:
+        conn.executemany("""INSERT INTO messages (id, username, message, type, timestamp, reply_to,
+                            read_by, file_size, original_name, reactions) VALUES (?,?,?,?,?,?,?,?,?,?)""", rows)
+    conn.close()
+
+
+async def wait_for_port(host, port, proc=None, timeout=30.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise SystemExit(f"server exited with code {proc.returncode}")
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise SystemExit(f"nothing listening on {host}:{port}")
+
+
+async def main(args):
+    server = workdir = None
+    if args.url is None:
+        try:
+            await wait_for_port("127.0.0.1", args.port, timeout=0)
+        except SystemExit:
+            pass
+        else:
+            raise SystemExit(f"port {args.port} is already in use (see --port / --url)")
+        workdir = prepare_workdir()
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(PROJECT_DIR, "main.py"), "--host", "127.0.0.1", "--port", str(args.port)],
+            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, CHAT_LOG_LEVELS="connection=warning,message=warning,typing=off,"
+                                                 "signal=off,call=warning,file=warning,system=off"))
+        await wait_for_port("127.0.0.1", args.port, server)
+        if args.history:
+            seed_history(os.path.join(workdir, "chatter.db"), args.history)
+        args.http_url = f"http://127.0.0.1:{args.port}"
+    else:
+        args.http_url = args.url.rstrip("/")
+    url = urlparse(args.http_url)
+    args.ws_url = f"{'wss' if url.scheme == 'https' else 'ws'}://{url.netloc}/ws"
+
+    pid = server.pid if server else args.pid
+    proc = psutil.Process(pid) if pid else None
+    stats = Stats()
+    online = []
+    lags = []
+    try:
+        if proc:
+            proc.cpu_percent()
+        ramp_started = time.perf_counter()
+        stop_at = ramp_started + args.ramp + args.duration
+        lag_task = asyncio.ensure_future(watch_lag(stop_at, lags))
+        tasks = []
+        for i in range(args.clients):
+            client = Client(i, args, stats, online)
+            tasks.append(asyncio.ensure_future(client.run(stop_at)))
+            await asyncio.sleep(args.ramp / max(1, args.clients))
+        peak_rss = 0
+        while time.perf_counter() < stop_at:
+            if proc:
+                peak_rss = max(peak_rss, proc.memory_info().rss)
+            await asyncio.sleep(0.5)
+        cpu = proc.cpu_percent() if proc else None
+        await asyncio.gather(*tasks, lag_task, return_exceptions=True)
+        elapsed = time.perf_counter() - ramp_started
+    finally:
+        if server:
+            server.terminate()
+            try:
+                server.wait(10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    sent = sum(stats.sent.values())
+    mix = ",".join(f"{action}={weight:g}" for action, weight in args.mix.items())
+    print(f"{len(online)}/{args.clients} clients logged in, {elapsed:.0f}s, mix {mix}")
+    print(f"login      {percentiles(stats.login)}")
+    print(f"history    {percentiles(stats.history)}  ({args.history if server else '?'} messages)")
+    print(f"delivery   {percentiles(stats.delivery)}")
+    if stats.upload:
+        print(f"upload     {percentiles(stats.upload)}")
+    print(f"actions    {sent} sent ({sent / elapsed:.0f}/s): "
+          + ", ".join(f"{k} {v}" for k, v in stats.sent.most_common()))
+    print(f"frames     {stats.received} received ({stats.received / elapsed:.0f}/s)")
+    if stats.rate_limited:
+        print("limited    " + ", ".join(f"{k} {v}" for k, v in stats.rate_limited.most_common()))
+    if stats.errors:
+        print("errors     " + ", ".join(f"{k} {v}" for k, v in stats.errors.most_common()))
+    if proc:
+        print(f"server     {cpu:.0f}% CPU, peak {peak_rss / 1e6:.0f} MB RSS")
+    if lags:
+        lags.sort()
+        print(f"generator lag p99 {lags[int(0.99 * (len(lags) - 1))] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load after the ramp-up")
+    parser.add_argument("--ramp", type=float, default=10.0, help="seconds to connect all clients")
+    parser.add_argument("--rate", type=float, default=0.2, help="actions per client per second")
+    parser.add_argument("--mix", type=parse_mix, default=MIXES["mixed"],
+                        help=f"one of {', '.join(MIXES)} or action=weight,... (default: mixed)")
+    parser.add_argument("--history", type=int, default=500, help="messages seeded before clients log in")
+    parser.add_argument("--port", type=int, default=8798)
+    parser.add_argument("--url", help="http:// URL of a running server (skips starting one)")
+    parser.add_argument("--pid", type=int, help="server process for CPU/RSS when using --url")
+    asyncio.run(main(parser.parse_args()))
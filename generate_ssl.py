@@ -1,6 +1,10 @@
 """
 SSL Certificate Generator for Chatter FilePro
 Generates a self-signed certificate for HTTPS on local network
+
+ECDSA P-256 keys are the default: the handshake signature is far cheaper than
+RSA-2048 for the server and for phones reconnecting after sleep. Use
+--key-type rsa for very old clients that lack ECDSA support.
 """
 
 import os
@@ -8,6 +12,7 @@ import sys
 import subprocess
 import socket
 import ipaddress
+import argparse
 
 def get_local_ip():
     """Get the local IP address of this machine"""
@@ -20,27 +25,57 @@ def get_local_ip():
     except:
         return "127.0.0.1"
 
-def generate_certificate(ip_address=None):
+def get_all_local_ips():
+    """Every IPv4/IPv6 address of this machine's interfaces (loopback included)"""
+    addresses = set()
+    try:
+        import psutil
+        for interface_addresses in psutil.net_if_addrs().values():
+            for addr in interface_addresses:
+                if addr.family in (socket.AF_INET, socket.AF_INET6):
+                    addresses.add(addr.address.split("%", 1)[0])  # drop IPv6 zone id
+    except ImportError:
+        try:
+            for info in socket.getaddrinfo(socket.gethostname(), None):
+                addresses.add(info[4][0].split("%", 1)[0])
+        except socket.gaierror:
+            pass
+    addresses.update(["127.0.0.1", "::1"])
+
+    parsed = []
+    for address in addresses:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            continue
+        if not ip.is_link_local:  # fe80::/10 can't be typed into a browser URL usefully
+            parsed.append(ip)
+    return sorted(parsed, key=lambda ip: (ip.version, int(ip)))
+
+def generate_certificate(ip_address=None, key_type="ecdsa", cert_path="cert.pem", key_path="key.pem"):
     """Generate self-signed SSL certificate"""
     try:
         from cryptography import x509
         from cryptography.x509.oid import NameOID
         from cryptography.hazmat.primitives import hashes
         from cryptography.hazmat.backends import default_backend
-        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.asymmetric import ec, rsa
         from cryptography.hazmat.primitives import serialization
         import datetime
         
         local_ip = ip_address if ip_address else get_local_ip()
         
-        print(f"Generating certificate for IP: {local_ip}")
+        print(f"Generating {key_type.upper()} certificate for IP: {local_ip}")
         
         # Generate private key
-        key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
+        if key_type == "rsa":
+            key = rsa.generate_private_key(
+                public_exponent=65537,
+                key_size=2048,
+                backend=default_backend()
+            )
+        else:
+            key = ec.generate_private_key(ec.SECP256R1(), default_backend())
         
         # Generate certificate
         subject = issuer = x509.Name([
@@ -51,18 +86,20 @@ def generate_certificate(ip_address=None):
             x509.NameAttribute(NameOID.COMMON_NAME, local_ip),
         ])
         
-        # Build Subject Alternative Names
-        san_list = [
-            x509.DNSName("localhost"),
-            x509.DNSName(local_ip),
-            x509.IPAddress(ipaddress.IPv4Address("127.0.0.1")),
-        ]
-        
-        # Add the local IP as IP address SAN
+        # Build Subject Alternative Names: host names plus every interface address,
+        # so the same certificate works over Wi-Fi, Ethernet, VPN and localhost
+        hostname = socket.gethostname()
+        dns_names = ["localhost", hostname, f"{hostname}.local"]
+        ip_list = get_all_local_ips()
         try:
-            san_list.append(x509.IPAddress(ipaddress.IPv4Address(local_ip)))
-        except:
-            pass
+            primary = ipaddress.ip_address(local_ip)
+            if primary not in ip_list:
+                ip_list.insert(0, primary)
+        except ValueError:
+            dns_names.append(local_ip)  # a host name was passed instead of an address
+        
+        san_list = [x509.DNSName(name) for name in dict.fromkeys(dns_names) if name]
+        san_list += [x509.IPAddress(ip) for ip in ip_list]
         
         cert = x509.CertificateBuilder().subject_name(
             subject
@@ -82,18 +119,20 @@ def generate_certificate(ip_address=None):
         ).sign(key, hashes.SHA256(), default_backend())
         
         # Write certificate
-        with open("cert.pem", "wb") as f:
+        with open(cert_path, "wb") as f:
             f.write(cert.public_bytes(serialization.Encoding.PEM))
         
-        # Write private key
-        with open("key.pem", "wb") as f:
+        # Write private key (owner-only on systems that honour the mode)
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
             f.write(key.private_bytes(
                 encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
+                format=serialization.PrivateFormat.PKCS8,
                 encryption_algorithm=serialization.NoEncryption()
             ))
         
-        print(f"✅ Certificate generated for: localhost, {local_ip}")
+        print(f"✅ Certificate generated for: {', '.join(dict.fromkeys(dns_names))}")
+        print(f"   and addresses: {', '.join(str(ip) for ip in ip_list)}")
         return True
         
     except ImportError:
@@ -103,11 +142,19 @@ def generate_certificate(ip_address=None):
         return False
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a self-signed certificate for Local-LAN-Messenger")
+    parser.add_argument("ip", nargs="?", help="address shown as the certificate name (default: detected)")
+    parser.add_argument("--key-type", choices=["ecdsa", "rsa"], default="ecdsa",
+                        help="ecdsa (P-256, fast handshakes, default) or rsa (2048-bit, legacy clients)")
+    parser.add_argument("--cert", default="cert.pem", help="certificate output file")
+    parser.add_argument("--key", default="key.pem", help="private key output file")
+    args = parser.parse_args()
+
     print("🔐 Generating SSL Certificate for Local-LAN-Messenger...")
     print()
     
     # Check if IP was passed as argument
-    ip_arg = sys.argv[1] if len(sys.argv) > 1 else None
+    ip_arg = args.ip
     
     if ip_arg:
         print(f"📍 Using IP from argument: {ip_arg}")
@@ -117,14 +164,14 @@ if __name__ == "__main__":
     
     print()
     
-    if generate_certificate(ip_arg):
+    if generate_certificate(ip_arg, args.key_type, args.cert, args.key):
         print()
         print("=" * 50)
         print("✅ SSL Certificate generated successfully!")
         print()
         print("Files created:")
-        print("  - cert.pem (certificate)")
-        print("  - key.pem (private key)")
+        print(f"  - {args.cert} (certificate)")
+        print(f"  - {args.key} (private key)")
         print()
         print("Now run: start_https_server.bat")
         print("=" * 50)
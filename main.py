@@ -4,26 +4,136 @@ import os
 import shutil
 import uuid
 import asyncio
-import aiofiles
 import hashlib
+import gzip
+import hmac
+import ipaddress
+import base64
 import secrets
+import random
+import re
+import signal
+import socket
 import logging
+import logging.handlers
+import queue
+import ssl
+import threading
+import atexit
 import sys
-import psutil
+import time
+import functools
+import itertools
+import traceback
 from datetime import datetime, timedelta
-from typing import Dict, List, Set, Optional
-from collections import defaultdict
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, HTTPException, Response, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Set, Optional
+from urllib.parse import parse_qs
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Response, Request
+from starlette.concurrency import iterate_in_threadpool
+from starlette.requests import ClientDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
-from contextlib import contextmanager
+import uvicorn
+from contextlib import asynccontextmanager, contextmanager
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
 import io
+import array
+import subprocess
+import zipfile
 
 # ===== BEGINNER-FRIENDLY TERMINAL LOGGING =====
 # This makes the terminal output easy to understand for everyone!
+#
+# Logging never touches stdout on the event loop: ChatLogger only builds a
+# LogRecord and drops it on a queue. A background thread (QueueListener)
+# formats and writes it, so a slow terminal or a pipe can't stall the chat.
+#
+# Tuning through environment variables:
+#   CHAT_LOG_FORMAT=pretty|json        colorful terminal output or JSON lines
+#   CHAT_LOG_LEVELS=message=warning,signal=off
+#                                      per-category minimum level (or "off")
+#   CHAT_LOG_SAMPLE=signal=20,typing=10
+#                                      keep 1 in N info records of a category
+
+# Categories: connection, message, typing, file, call, signal, server, system
+LOG_LEVEL_NAMES = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'off': logging.CRITICAL + 1,
+}
+
+
+def parse_log_settings(spec: str) -> Dict[str, str]:
+    """Parse 'a=1,b=2' style settings into a dict (unknown keys are kept)."""
+    settings = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            key, value = item.split("=", 1)
+            settings[key.strip().lower()] = value.strip().lower()
+    return settings
+
+
+class PrettyFormatter(logging.Formatter):
+    """Colored, emoji-prefixed lines with an optional explanation underneath."""
+
+    def __init__(self, colors: Dict[str, str]):
+        super().__init__()
+        self.colors = colors
+
+    def format(self, record):
+        if getattr(record, 'raw', False):
+            return record.getMessage()
+        c = self.colors.get(record.color, self.colors['white'])
+        r = self.colors['reset']
+        time_str = datetime.fromtimestamp(record.created).strftime("%H:%M:%S")
+        line = f"{c}[{time_str}] {record.emoji} {record.getMessage()}{r}"
+        # Explanation for noobs (in lighter color)
+        if record.explanation:
+            line += f"\n         └─ {self.colors['cyan']}ℹ️  {record.explanation}{r}"
+        return line
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers and grep-friendly production logs."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname.lower(),
+            "category": record.category,
+            "event": record.event,
+            "msg": record.getMessage(),
+        }
+        entry.update(record.fields)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """StreamHandler that lets a record pick its own line ending (title updates use none)."""
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + getattr(record, 'end', '\n'))
+            self.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that skips formatting so it happens on the writer thread."""
+
+    def prepare(self, record):
+        return record
+
 
 class ChatLogger:
     """Colorful, emoji-enhanced logging for the chat server.
@@ -48,153 +158,656 @@ class ChatLogger:
         'bold': '\033[1m',
         'reset': '\033[0m'
     }
-    
-    @staticmethod
-    def _time():
-        return datetime.now().strftime("%H:%M:%S")
-    
+
+    log_format = 'pretty'
+    category_levels: Dict[str, int] = {}
+    sample_rates: Dict[str, int] = {}
+    _sample_counters: Dict[str, int] = {}
+    _logger = logging.getLogger("chatter")
+    _listener = None
+    _listener_lock = threading.Lock()
+
     @classmethod
-    def _print(cls, emoji, message, color='white', explanation=''):
-        """Print a colorful log message with optional explanation."""
-        c = cls.COLORS.get(color, cls.COLORS['white'])
-        r = cls.COLORS['reset']
-        time_str = cls._time()
-        
-        # Main message
-        print(f"{c}[{time_str}] {emoji} {message}{r}")
-        
-        # Explanation for noobs (in lighter color)
-        if explanation:
-            print(f"         └─ {cls.COLORS['cyan']}ℹ️  {explanation}{r}")
+    def configure(cls, log_format=None, levels=None, sample=None):
+        """Apply output format, per-category levels and sampling (e.g. from env/CLI)."""
+        if log_format:
+            cls.log_format = 'json' if log_format.lower() == 'json' else 'pretty'
+        if levels is not None:
+            cls.category_levels = {
+                category: LOG_LEVEL_NAMES.get(level, logging.INFO)
+                for category, level in parse_log_settings(levels).items()
+            }
+        if sample is not None:
+            cls.sample_rates = {
+                category: max(1, int(rate))
+                for category, rate in parse_log_settings(sample).items()
+                if rate.isdigit()
+            }
+        if cls._listener:
+            cls._listener.handlers[0].setFormatter(cls._make_formatter())
+
+    @classmethod
+    def _make_formatter(cls):
+        return JsonLinesFormatter() if cls.log_format == 'json' else PrettyFormatter(cls.COLORS)
+
+    @classmethod
+    def _ensure_listener(cls):
+        """Start the writer thread on first use so importing stays side-effect free."""
+        with cls._listener_lock:
+            if cls._listener:
+                return
+            handler = ConsoleHandler(sys.stdout)
+            handler.setFormatter(cls._make_formatter())
+            log_queue = queue.SimpleQueue()
+            cls._logger.handlers = [DeferredQueueHandler(log_queue)]
+            cls._logger.propagate = False
+            cls._logger.setLevel(logging.DEBUG)
+            cls._listener = logging.handlers.QueueListener(log_queue, handler)
+            cls._listener.start()
+            atexit.register(cls.flush)
+
+    @classmethod
+    def flush(cls):
+        """Stop the writer thread after draining everything still queued."""
+        with cls._listener_lock:
+            if cls._listener:
+                cls._listener.stop()
+                cls._listener = None
+
+    @classmethod
+    def enabled(cls, category, level=logging.INFO) -> bool:
+        """Cheap check callers can use before building expensive messages."""
+        return level >= cls.category_levels.get(category, logging.INFO)
+
+    @classmethod
+    def _print(cls, emoji, message, color='white', explanation='',
+               category='server', level=logging.INFO, event='log', **fields):
+        """Queue a colorful log message with optional explanation."""
+        if level < cls.category_levels.get(category, logging.INFO):
+            return
+        rate = cls.sample_rates.get(category)
+        if rate and level < logging.WARNING:
+            seen = cls._sample_counters.get(category, 0) + 1
+            cls._sample_counters[category] = seen
+            if seen % rate:
+                return
+        if cls._listener is None:
+            cls._ensure_listener()
+        cls._logger.log(level, message, extra={
+            'emoji': emoji,
+            'color': color,
+            'explanation': explanation,
+            'category': category,
+            'event': event,
+            'fields': fields,
+        })
+
+    @classmethod
+    def _raw(cls, text, end='\n'):
+        """Queue pre-formatted terminal output (banners, window title updates)."""
+        if cls._listener is None:
+            cls._ensure_listener()
+        cls._logger.info(text, extra={'raw': True, 'end': end})
     
     # === CONNECTION EVENTS ===
     @classmethod
     def user_connected(cls, username):
         cls._print("👋", f"User '{username}' joined the chat!", 'green',
-                   "Someone opened the app and logged in successfully")
+                   "Someone opened the app and logged in successfully",
+                   category='connection', event='user_connected', user=username)
     
     @classmethod
     def user_disconnected(cls, username):
         cls._print("👋", f"User '{username}' left the chat", 'yellow',
-                   "They closed the browser or lost connection")
+                   "They closed the browser or lost connection",
+                   category='connection', event='user_disconnected', user=username)
     
     @classmethod
     def new_user_registered(cls, username):
         cls._print("🆕", f"New user registered: '{username}'", 'green',
-                   "First time login - account created automatically")
+                   "First time login - account created automatically",
+                   category='connection', event='user_registered', user=username)
     
+    @classmethod
+    def connection_reaped(cls, username, idle_seconds):
+        cls._print("💤", f"Closed silent connection of '{username}' ({idle_seconds:.0f}s without a frame)", 'yellow',
+                   "Phone went to sleep or Wi-Fi dropped without saying goodbye",
+                   category='connection', event='connection_reaped', user=username,
+                   idle_seconds=round(idle_seconds))
+
+    @classmethod
+    def connection_stalled(cls, username):
+        cls._print("🐌", f"Closed stalled connection of '{username}' (send timed out after {WS_SEND_TIMEOUT:g}s)", 'yellow',
+                   "The client stopped reading; its socket buffer is full",
+                   category='connection', event='connection_stalled', user=username)
+
     @classmethod
     def login_failed(cls, username, reason):
         cls._print("🔒", f"Login failed for '{username}': {reason}", 'red',
-                   "Wrong password or other authentication error")
+                   "Wrong password or other authentication error",
+                   category='connection', level=logging.WARNING, event='login_failed',
+                   user=username, reason=reason)
     
     # === MESSAGE EVENTS ===
     @classmethod
     def message_sent(cls, username, msg_type):
         type_emoji = {'text': '💬', 'image': '🖼️', 'video': '🎬', 'file': '📎', 'voice': '🎤'}
         emoji = type_emoji.get(msg_type, '📨')
-        cls._print(emoji, f"{username} sent a {msg_type} message", 'blue')
+        cls._print(emoji, f"{username} sent a {msg_type} message", 'blue',
+                   category='message', event='message_sent', user=username, msg_type=msg_type)
     
     @classmethod
     def message_edited(cls, username):
         cls._print("✏️", f"{username} edited their message", 'blue',
-                   "Users can edit messages within 10 minutes")
+                   "Users can edit messages within 10 minutes",
+                   category='message', event='message_edited', user=username)
     
     @classmethod
     def message_deleted(cls, username, count):
-        cls._print("🗑️", f"{username} deleted {count} message(s)", 'yellow')
+        cls._print("🗑️", f"{username} deleted {count} message(s)", 'yellow',
+                   category='message', event='message_deleted', user=username, count=count)
+    
+    @classmethod
+    def channel_created(cls, username, name, kind):
+        label = f"#{name}" if kind == "channel" else "a direct conversation"
+        cls._print("🧵", f"{username} created {label}", 'cyan',
+                   category='message', event='channel_created', user=username, channel=name, kind=kind)
     
     # === FILE EVENTS ===
     @classmethod
     def file_uploaded(cls, filename, size_mb, file_type):
         cls._print("📤", f"File uploaded: {filename} ({size_mb:.2f} MB) [{file_type}]", 'green',
-                   "File saved to server and ready to share")
+                   "File saved to server and ready to share",
+                   category='file', event='file_uploaded', filename=filename,
+                   size_mb=round(size_mb, 2), file_type=file_type)
+    
+    @classmethod
+    def direct_file_offered(cls, sender, recipient, size):
+        cls._print("📨", f"Direct transfer offered: {sender} → {recipient} ({size / (1024 * 1024):.2f} MB)", 'cyan',
+                   "Sent browser-to-browser; the server only relays signaling",
+                   category='file', event='direct_file_offered', sender=sender,
+                   recipient=recipient, size=size)
     
     @classmethod
     def file_deleted(cls, filename):
         cls._print("🗑️", f"File deleted: {filename}", 'yellow',
-                   "Media file removed from server storage")
+                   "Media file removed from server storage",
+                   category='file', event='file_deleted', filename=filename)
     
     @classmethod
     def upload_failed(cls, filename, error):
         cls._print("❌", f"Upload failed: {filename} - {error}", 'red',
-                   "Check file size (max 100MB) and type")
+                   "Check file size (max 100MB) and type",
+                   category='file', level=logging.ERROR, event='upload_failed',
+                   filename=filename, error=error)
     
     @classmethod
     def thumbnail_created(cls, filename):
-        cls._print("🖼️", f"Thumbnail created for: {filename}", 'cyan')
+        cls._print("🖼️", f"Thumbnail created for: {filename}", 'cyan',
+                   category='file', event='thumbnail_created', filename=filename)
+    
+    @classmethod
+    def voice_transcoded(cls, filename, duration, smaller):
+        cls._print("🎤", f"Voice note processed: {filename} ({duration:.1f}s"
+                         f"{', Opus copy' if smaller else ''})", 'cyan',
+                   category='file', event='voice_transcoded', filename=filename,
+                   duration=duration, opus=smaller)
     
     # === CALL EVENTS ===
     @classmethod
     def call_started(cls, caller, callee, call_type):
         emoji = "📹" if call_type == "video" else "📞"
         cls._print(emoji, f"{caller} is calling {callee} ({call_type} call)", 'purple',
-                   "WebRTC call initiated - waiting for answer")
+                   "WebRTC call initiated - waiting for answer",
+                   category='call', event='call_started', caller=caller, callee=callee,
+                   call_type=call_type)
     
     @classmethod
     def call_accepted(cls, user):
         cls._print("✅", f"{user} accepted the call", 'green',
-                   "Call connected! Audio/video streaming started")
+                   "Call connected! Audio/video streaming started",
+                   category='call', event='call_accepted', user=user)
     
     @classmethod
     def call_rejected(cls, user):
-        cls._print("❌", f"{user} declined the call", 'yellow')
+        cls._print("❌", f"{user} declined the call", 'yellow',
+                   category='call', event='call_rejected', user=user)
     
     @classmethod
     def call_ended(cls, user):
         cls._print("📴", f"Call ended by {user}", 'yellow',
-                   "Call cleaned up properly")
+                   "Call cleaned up properly",
+                   category='call', event='call_ended', user=user)
+    
+    @classmethod
+    def group_call_joined(cls, user, room):
+        cls._print("👥", f"{user} joined group call {room}", 'purple',
+                   "Media goes through the SFU - one upload per person",
+                   category='call', event='group_call_joined', user=user, room=room)
+    
+    @classmethod
+    def group_call_left(cls, user, room):
+        cls._print("👋", f"{user} left group call {room}", 'yellow',
+                   category='call', event='group_call_left', user=user, room=room)
     
     @classmethod
     def webrtc_signal(cls, signal_type, from_user, to_user):
         cls._print("🔗", f"WebRTC {signal_type}: {from_user} → {to_user}", 'cyan',
-                   "Connection negotiation in progress")
+                   "Connection negotiation in progress",
+                   category='signal', event='webrtc_signal', signal=signal_type,
+                   from_user=from_user, to_user=to_user)
     
     # === SERVER EVENTS ===
     @classmethod
     def server_starting(cls):
-        cls._print("🚀", "Local-LAN-Messenger Server Starting...", 'green')
+        cls._print("🚀", "Local-LAN-Messenger Server Starting...", 'green',
+                   event='server_starting')
+    
+    @classmethod
+    def backup_finished(cls, name, db_bytes, media_copied, seconds):
+        cls._print("💾", f"Backup {name}: {db_bytes / (1024 * 1024):.1f} MB database, "
+                         f"{media_copied} new media file(s) in {seconds:.1f}s", 'green',
+                   event='backup_finished', backup=name, db_bytes=db_bytes,
+                   media_copied=media_copied, seconds=round(seconds, 2))
+    
+    @classmethod
+    def server_draining(cls, sockets):
+        cls._print("🚰", f"Draining {sockets} connection(s) before shutdown", 'yellow',
+                   "Clients are told to reconnect after a random delay",
+                   event='server_draining', sockets=sockets)
+    
+    @classmethod
+    def server_replacing(cls, pid):
+        cls._print("🔁", f"Listening; asking the previous server (pid {pid}) to drain", 'cyan',
+                   event='server_replacing', pid=pid)
     
     @classmethod
     def server_ready(cls, http_url, https_url=None):
-        print("")
-        print(f"{cls.COLORS['green']}{'='*50}{cls.COLORS['reset']}")
-        print(f"{cls.COLORS['bold']}{cls.COLORS['green']}  ✓ SERVER IS READY!{cls.COLORS['reset']}")
-        print(f"{cls.COLORS['green']}{'='*50}{cls.COLORS['reset']}")
-        print("")
-        print(f"  {cls.COLORS['cyan']}📍 Access your chat at:{cls.COLORS['reset']}")
-        print(f"     {cls.COLORS['white']}{http_url}{cls.COLORS['reset']}")
+        if cls.log_format == 'json':
+            cls._print("✓", "Server is ready", event='server_ready',
+                       urls=[url for url in (http_url, https_url) if url])
+            return
+        C = cls.COLORS
+        lines = [
+            "",
+            f"{C['green']}{'='*50}{C['reset']}",
+            f"{C['bold']}{C['green']}  ✓ SERVER IS READY!{C['reset']}",
+            f"{C['green']}{'='*50}{C['reset']}",
+            "",
+            f"  {C['cyan']}📍 Access your chat at:{C['reset']}",
+            f"     {C['white']}{http_url}{C['reset']}",
+        ]
         if https_url:
-            print(f"     {cls.COLORS['white']}{https_url}{cls.COLORS['reset']}")
-        print("")
-        print(f"  {cls.COLORS['yellow']}💡 Share the URL with friends to chat!{cls.COLORS['reset']}")
-        print(f"  {cls.COLORS['yellow']}💡 Press Ctrl+C to stop the server{cls.COLORS['reset']}")
-        print("")
-        print(f"{cls.COLORS['green']}{'='*50}{cls.COLORS['reset']}")
-        print("")
-        print(f"{cls.COLORS['cyan']}📊 Live Activity Log (what's happening):{cls.COLORS['reset']}")
-        print(f"{cls.COLORS['cyan']}{'─'*50}{cls.COLORS['reset']}")
+            lines.append(f"     {C['white']}{https_url}{C['reset']}")
+        lines += [
+            "",
+            f"  {C['yellow']}💡 Share the URL with friends to chat!{C['reset']}",
+            f"  {C['yellow']}💡 Press Ctrl+C to stop the server{C['reset']}",
+            "",
+            f"{C['green']}{'='*50}{C['reset']}",
+            "",
+            f"{C['cyan']}📊 Live Activity Log (what's happening):{C['reset']}",
+            f"{C['cyan']}{'─'*50}{C['reset']}",
+        ]
+        cls._raw("\n".join(lines))
+
+    @classmethod
+    def set_title(cls, title):
+        """Show live stats in the terminal title (skipped for JSON logs)."""
+        if cls.log_format == 'pretty':
+            cls._raw(f"\x1b]2;{title}\x07", end='')
     
     @classmethod
     def error(cls, message, detail=''):
-        cls._print("❌", f"Error: {message}", 'red', detail)
+        cls._print("❌", f"Error: {message}", 'red', detail,
+                   level=logging.ERROR, event='error', detail=detail)
     
     @classmethod
     def warning(cls, message):
-        cls._print("⚠️", message, 'yellow')
+        cls._print("⚠️", message, 'yellow', level=logging.WARNING, event='warning')
     
     @classmethod
     def info(cls, message):
-        cls._print("ℹ️", message, 'blue')
+        cls._print("ℹ️", message, 'blue', event='info')
     
+    @classmethod
+    def slow_action(cls, action, username, seconds, finished, thread_stack='', task_stack=''):
+        detail = ""
+        if thread_stack:
+            detail += "Event-loop thread:\n" + thread_stack
+        if task_stack:
+            detail += "Awaiting in:\n" + task_stack
+        state = "took" if finished else "still running after"
+        cls._print("🐢", f"Action '{action}' from {username} {state} {seconds * 1000:.0f} ms",
+                   'yellow', detail, category='system', level=logging.WARNING, event='slow_action',
+                   action=action, user=username, duration_ms=round(seconds * 1000),
+                   finished=finished, thread_stack=thread_stack, task_stack=task_stack)
+
+    @classmethod
+    def loop_lag(cls, seconds):
+        cls._print("⏱️", f"Event loop stalled for {seconds * 1000:.0f} ms", 'yellow',
+                   "Something blocked the server; check chatter_ws_action_seconds",
+                   category='system', level=logging.WARNING, event='loop_lag',
+                   lag_ms=round(seconds * 1000))
+
     @classmethod
     def reaction_added(cls, username, emoji):
-        cls._print("😊", f"{username} reacted with {emoji}", 'blue')
+        cls._print("😊", f"{username} reacted with {emoji}", 'blue',
+                   category='message', event='reaction_added', user=username, emoji=emoji)
     
     @classmethod
     def typing_indicator(cls, username, is_typing):
         if is_typing:
-            cls._print("⌨️", f"{username} is typing...", 'cyan')
+            cls._print("⌨️", f"{username} is typing...", 'cyan',
+                       category='typing', event='typing', user=username)
+
+
+ChatLogger.configure(
+    log_format=os.environ.get("CHAT_LOG_FORMAT", "pretty"),
+    levels=os.environ.get("CHAT_LOG_LEVELS", ""),
+    sample=os.environ.get("CHAT_LOG_SAMPLE", ""),
+)
+
+
+# === METRICS (Prometheus text format) ===
+# Tiny in-process registry so /metrics can be scraped without extra packages.
+# Metrics are updated from the event loop and from executor threads, hence the lock.
+
+def escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _label_str(self, labels: tuple, extra: str = '') -> str:
+        pairs = [f'{k}="{escape_label_value(v)}"' for k, v in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{self._label_str(labels)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels: tuple = ()) -> float:
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, labelnames=(), callback=None):
+        super().__init__(name, help_text, labelnames)
+        self.callback = callback  # computed at scrape time, e.g. open sockets
+
+    def set(self, value: float, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()):
+        self.inc(-amount, labels)
+
+    def value(self, labels: tuple = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        if self.callback is not None:
+            self.set(self.callback())
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, labels: tuple = ()):
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # [per-bucket counts..., +Inf count, sum]
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, labels: tuple = ()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._label_str(labels, le)} {cumulative}")
+            cumulative += state[len(self.buckets)]
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._label_str(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(labels)} {state[-1]}")
+            lines.append(f"{self.name}_count{self._label_str(labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()) -> Counter:
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, help_text, labelnames, callback))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+WS_MESSAGES = metrics.counter("chatter_ws_messages_total", "WebSocket frames received, by action type", ("type",))
+BROADCAST_SECONDS = metrics.histogram("chatter_broadcast_seconds", "Time to fan a frame out to all recipients")
+BROADCAST_RECIPIENTS = metrics.counter("chatter_broadcast_recipients_total", "Frames delivered by broadcasts")
+DB_QUERY_SECONDS = metrics.histogram("chatter_db_query_seconds", "SQLite execute() latency per statement", ("statement",))
+UPLOAD_BYTES = metrics.counter("chatter_upload_bytes_total", "Bytes written by /upload")
+UPLOAD_FILES = metrics.counter("chatter_upload_files_total", "Files stored by /upload")
+UPLOAD_SECONDS = metrics.histogram("chatter_upload_seconds", "Duration of /upload requests",
+                                   buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+WS_REAPED = metrics.counter("chatter_ws_reaped_total", "Idle/half-open WebSockets closed by the heartbeat")
+WS_SEND_TIMEOUTS = metrics.counter("chatter_ws_send_timeouts_total", "Sends dropped because a client stopped reading")
+WS_OVERSIZED_FRAMES = metrics.counter("chatter_ws_oversized_frames_total", "Sockets closed for a frame over CHAT_WS_MAX_FRAME")
+THUMBNAIL_QUEUE = metrics.gauge("chatter_thumbnail_queue_depth", "Thumbnail jobs waiting or running")
+THUMBNAIL_SECONDS = metrics.histogram("chatter_thumbnail_seconds", "Thumbnail generation time")
+LOOP_LAG_SECONDS = metrics.histogram("chatter_event_loop_lag_seconds", "How late the event loop wakes up a 100ms timer")
+WS_ACTION_SECONDS = metrics.histogram("chatter_ws_action_seconds", "Time spent handling a /ws action", ("action",))
+CPU_PERCENT = metrics.gauge("chatter_system_cpu_percent", "System CPU usage")
+RAM_PERCENT = metrics.gauge("chatter_system_ram_percent", "System RAM usage")
+PROCESS_RSS = metrics.gauge("chatter_process_resident_memory_bytes", "Server process resident memory")
+
+
+# === PROFILING HOOKS ===
+# When users report lag we need to know *which* action is slow. Every /ws action
+# is timed into WS_ACTION_SECONDS; a watchdog thread grabs stacks of actions
+# that run past a threshold; a lag sampler measures how late the loop wakes up.
+#
+#   CHAT_SLOW_ACTION_MS=250     log actions slower than this (with stacks)
+#   CHAT_LOOP_LAG_MS=100        log event-loop stalls longer than this
+#   CHAT_ENABLE_PROFILER=1      enable GET /debug/profile?seconds=N
+
+SLOW_ACTION_SECONDS = int(os.environ.get("CHAT_SLOW_ACTION_MS", "250")) / 1000
+LOOP_LAG_WARN_SECONDS = int(os.environ.get("CHAT_LOOP_LAG_MS", "100")) / 1000
+PROFILER_ENABLED = os.environ.get("CHAT_ENABLE_PROFILER", "") == "1"
+
+
+def format_thread_stack(thread_id: int, limit: int = 25) -> str:
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return ""
+    return "".join(traceback.format_stack(frame, limit=limit))
+
+
+class SlowActionWatchdog:
+    """Thread that notices /ws actions running longer than `threshold` seconds.
+
+    The stack of the event-loop thread is captured from the watchdog thread the
+    moment an action overruns, which pinpoints blocking code (sync SQLite, file
+    I/O, Pillow). If the action is merely awaiting, the loop is free and the
+    task's own await chain is appended once the loop picks the report up.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self._running: Dict[int, list] = {}
+        self._ids = itertools.count()
+        self._loop = None
+        self._loop_thread_id = None
+        self._thread = None
+
+    def start(self):
+        if self._thread or self.threshold <= 0:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._watch, name="slow-action-watchdog", daemon=True)
+        self._thread.start()
+
+    def begin(self, action: str, username: str) -> int:
+        token = next(self._ids)
+        # [action, user, start, task, reported, end]
+        self._running[token] = [action, username, time.monotonic(), asyncio.current_task(), False, None]
+        return token
+
+    def end(self, token: int):
+        entry = self._running.pop(token, None)
+        if entry:
+            entry[5] = time.monotonic()
+
+    def running(self) -> int:
+        """Number of /ws actions in progress right now."""
+        return len(self._running)
+
+    def _watch(self):
+        interval = max(self.threshold / 2, 0.01)
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            for entry in list(self._running.values()):
+                if entry[4] or now - entry[2] < self.threshold:
+                    continue
+                entry[4] = True
+                thread_stack = format_thread_stack(self._loop_thread_id)
+                self._loop.call_soon_threadsafe(self._report, entry, thread_stack)
+
+    def _report(self, entry, thread_stack):
+        action, username, started, task, _, ended = entry
+        task_stack = ""
+        if ended is None and task is not None and not task.done():
+            task_stack = "".join(
+                "".join(traceback.format_stack(frame, limit=1)) for frame in task.get_stack(limit=25)
+            )
+        elapsed = (ended or time.monotonic()) - started
+        log.slow_action(action, username, elapsed, ended is not None, thread_stack, task_stack)
+
+
+class LoopLagSampler:
+    """Measure how late the event loop wakes up a short timer."""
+
+    def __init__(self, interval: float = 0.1, warn_after: float = 0.1):
+        self.interval = interval
+        self.warn_after = warn_after
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_warning = 0.0
+        while True:
+            before = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - before - self.interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag >= self.warn_after and loop.time() - last_warning > 10:
+                last_warning = loop.time()
+                log.loop_lag(lag)
+
+
+def sample_stacks(thread_id: int, seconds: float, interval: float) -> Dict[str, int]:
+    """Poll one thread's stack and count identical stacks (runs in a worker thread)."""
+    counts: Dict[str, int] = {}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        if stack:
+            key = ";".join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return counts
+
+
+slow_actions = SlowActionWatchdog(SLOW_ACTION_SECONDS)
+loop_lag = LoopLagSampler(warn_after=LOOP_LAG_WARN_SECONDS)
+profile_lock = asyncio.Lock()
 
 
 # === SYSTEM MONITORING ===
@@ -202,19 +815,27 @@ class HardwareMonitor:
     def __init__(self, log_interval=60):
         self.log_interval = log_interval
         self.running = False
-        self._last_net_io = psutil.net_io_counters()
+        self._last_net_io = None
+        self._process = None
 
     async def start(self):
+        import psutil  # ~10ms to import; only the running server needs it
+        self._last_net_io = psutil.net_io_counters()
+        self._process = psutil.Process()
         self.running = True
         asyncio.create_task(self._monitor_loop())
         log.info("System monitoring started (Stats in window title)")
 
     async def _monitor_loop(self):
+        import psutil
         while self.running:
             try:
                 # 1. Get Stats
                 cpu_percent = psutil.cpu_percent(interval=None)
                 ram = psutil.virtual_memory()
+                CPU_PERCENT.set(cpu_percent)
+                RAM_PERCENT.set(ram.percent)
+                PROCESS_RSS.set(self._process.memory_info().rss)
                 
                 # Network Speed Calculation
                 current_net_io = psutil.net_io_counters()
@@ -227,14 +848,12 @@ class HardwareMonitor:
                 download_speed = self._format_bytes(bytes_recv)
 
                 # 2. Update Console Title (Real-time view)
+                title = f"Local-LAN-Messenger | CPU: {cpu_percent}% | RAM: {ram.percent}% | Net: ↓{download_speed}/s ↑{upload_speed}/s"
                 if sys.platform == 'win32':
-                    title = f"Local-LAN-Messenger | CPU: {cpu_percent}% | RAM: {ram.percent}% | Net: ↓{download_speed}/s ↑{upload_speed}/s"
                     ctypes.windll.kernel32.SetConsoleTitleW(title)
                 else:
-                    # macOS / Linux / Unix - Use ANSI Escape Sequence
-                    title = f"Local-LAN-Messenger | CPU: {cpu_percent}% | RAM: {ram.percent}% | Net: ↓{download_speed}/s ↑{upload_speed}/s"
-                    sys.stdout.write(f"\x1b]2;{title}\x07")
-                    sys.stdout.flush()
+                    # macOS / Linux / Unix - ANSI escape sequence, written by the log thread
+                    log.set_title(title)
 
                 # 3. Periodic Logging (Every log_interval seconds)
                 # We use a simple counter or checking timestamp usually, 
@@ -243,11 +862,13 @@ class HardwareMonitor:
                 # For now, let's just log if second % 60 == 0 roughly
                 now = datetime.now()
                 if now.second == 0:  # Log once a minute
-                   log._print("📊", f"System Load: CPU {cpu_percent}% | RAM {ram.percent}% | Net ↓{download_speed}/s ↑{upload_speed}/s", 'purple')
+                   log._print("📊", f"System Load: CPU {cpu_percent}% | RAM {ram.percent}% | Net ↓{download_speed}/s ↑{upload_speed}/s", 'purple',
+                              category='system', event='system_load', cpu_percent=cpu_percent,
+                              ram_percent=ram.percent, net_sent=bytes_sent, net_recv=bytes_recv)
 
                 await asyncio.sleep(1)
             except Exception as e:
-                print(f"Monitor Error: {e}")
+                log.error("Monitor error", str(e))
                 await asyncio.sleep(5)
 
     def _format_bytes(self, size):
@@ -284,13 +905,7 @@ if sys.platform == 'win32':
             return
         # For other exceptions, use default handler
         loop.default_exception_handler(context)
-    
-    # Apply the custom handler when event loop is available
-    try:
-        loop = asyncio.get_event_loop()
-        loop.set_exception_handler(windows_exception_handler)
-    except RuntimeError:
-        pass  # No event loop yet, will be set later
+    # Installed on the server's loop by lifespan()
 
 # Configure logging to reduce noise from uvicorn
 logging.getLogger("uvicorn.error").setLevel(logging.WARNING)
@@ -312,29 +927,69 @@ app.add_middleware(GZipMiddleware, minimum_size=500)
 
 # --- RATE LIMITING ---
 class RateLimiter:
-    def __init__(self, max_requests: int = 100, window_seconds: int = 60):
+    """Token-bucket limiter keyed by client IP, username or any other string.
+
+    Each key costs two floats (tokens left + last refill time) no matter how
+    many requests it makes. Buckets live in an LRU ordered dict: keys that have
+    been idle long enough to refill completely are dropped on the next sweep,
+    and the least recently used key is evicted once `max_keys` is reached.
+    """
+
+    def __init__(self, max_requests: int = 100, window_seconds: int = 60, max_keys: int = 10000):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests: Dict[str, List[datetime]] = defaultdict(list)
-    
-    def is_allowed(self, client_ip: str) -> bool:
-        now = datetime.now()
-        cutoff = now - timedelta(seconds=self.window_seconds)
-        
-        # Clean old requests
-        self.requests[client_ip] = [
-            req_time for req_time in self.requests[client_ip] 
-            if req_time > cutoff
-        ]
-        
-        if len(self.requests[client_ip]) >= self.max_requests:
+        self.max_keys = max_keys
+        self.rate = max_requests / window_seconds  # tokens refilled per second
+        self.buckets: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._next_sweep = time.monotonic() + window_seconds
+
+    def is_allowed(self, key: str, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._sweep(now)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[key] = [float(self.max_requests), now]
+        else:
+            self.buckets.move_to_end(key)
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            bucket[0] = tokens if tokens < self.max_requests else float(self.max_requests)
+            bucket[1] = now
+
+        if bucket[0] < cost:
             return False
-        
-        self.requests[client_ip].append(now)
+        bucket[0] -= cost
         return True
 
+    def _sweep(self, now: float):
+        """Drop buckets idle long enough to be full again (same as never seen)."""
+        self._next_sweep = now + self.window_seconds
+        cutoff = now - self.window_seconds
+        # Oldest entries sit at the front, so stop at the first recent one
+        while self.buckets:
+            key, (_, last_seen) = next(iter(self.buckets.items()))
+            if last_seen > cutoff:
+                break
+            del self.buckets[key]
+
 rate_limiter = RateLimiter(max_requests=200, window_seconds=60)
 
+# Per-user limits for WebSocket actions, grouped by what a flood would cost us.
+# ICE candidates arrive in bursts while a call connects, so signaling is generous.
+WS_RATE_LIMITS = {
+    "message": RateLimiter(max_requests=30, window_seconds=10),
+    "reaction": RateLimiter(max_requests=40, window_seconds=10),
+    "signaling": RateLimiter(max_requests=300, window_seconds=10),
+    "typing": RateLimiter(max_requests=30, window_seconds=10),
+    "receipt": RateLimiter(max_requests=120, window_seconds=10),
+    "edit": RateLimiter(max_requests=20, window_seconds=10),
+    "presence": RateLimiter(max_requests=10, window_seconds=10),
+    "channel": RateLimiter(max_requests=10, window_seconds=10),
+}
+
 # --- SECURITY HEADERS MIDDLEWARE ---
 from starlette.middleware.base import BaseHTTPMiddleware
 
@@ -356,6 +1011,8 @@ app.add_middleware(SecurityHeadersMiddleware)
 DATA_DIR = "data"
 MEDIA_DIR = os.path.join(DATA_DIR, "media")
 THUMB_DIR = os.path.join(DATA_DIR, "thumbnails")
+DISPLAY_DIR = os.path.join(DATA_DIR, "display")
+OPUS_DIR = os.path.join(DATA_DIR, "opus")
 
 MEDIA_SUBDIRS = {
     "image": "images",
@@ -364,11 +1021,13 @@ MEDIA_SUBDIRS = {
     "voice": "voice",
 }
 
-os.makedirs(MEDIA_DIR, exist_ok=True)
-os.makedirs(THUMB_DIR, exist_ok=True)
-for subdir in MEDIA_SUBDIRS.values():
-    os.makedirs(os.path.join(MEDIA_DIR, subdir), exist_ok=True)
-os.makedirs(os.path.join(THUMB_DIR, MEDIA_SUBDIRS["image"]), exist_ok=True)
+
+def create_storage_folders():
+    for subdir in MEDIA_SUBDIRS.values():
+        os.makedirs(os.path.join(MEDIA_DIR, subdir), exist_ok=True)
+    os.makedirs(os.path.join(THUMB_DIR, MEDIA_SUBDIRS["image"]), exist_ok=True)
+    os.makedirs(os.path.join(DISPLAY_DIR, MEDIA_SUBDIRS["image"]), exist_ok=True)
+    os.makedirs(os.path.join(OPUS_DIR, MEDIA_SUBDIRS["voice"]), exist_ok=True)
 
 
 def migrate_legacy_upload_folders():
@@ -416,6 +1075,14 @@ def thumb_disk_path(relative_path: str) -> str:
     return os.path.join(THUMB_DIR, relative_path)
 
 
+def display_disk_path(relative_path: str) -> str:
+    return os.path.join(DISPLAY_DIR, relative_path + ".webp")
+
+
+def opus_disk_path(relative_path: str) -> str:
+    return os.path.join(OPUS_DIR, relative_path + ".webm")
+
+
 def media_exists(relative_path: str) -> bool:
     if os.path.exists(media_disk_path(relative_path)):
         return True
@@ -460,27 +1127,77 @@ def list_files_recursive(base_dir: str) -> List[str]:
     return paths
 
 
-migrate_legacy_upload_folders()
-
-app.mount("/media", StaticFiles(directory=MEDIA_DIR), name="media")
-app.mount("/thumbs", StaticFiles(directory=THUMB_DIR), name="thumbs")
+# The folders are created at startup (prepare_storage), after these mounts
+app.mount("/media", StaticFiles(directory=MEDIA_DIR, check_dir=False), name="media")
+app.mount("/thumbs", StaticFiles(directory=THUMB_DIR, check_dir=False), name="thumbs")
+app.mount("/opus", StaticFiles(directory=OPUS_DIR, check_dir=False), name="opus")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 DB_NAME = "chatter.db"
 
-# Optimized chunk size for faster uploads (2MB)
+# Uploads are flushed to disk in blocks of this size (one executor hop per block)
 CHUNK_SIZE = 2 * 1024 * 1024
 
 # --- Database Connection Pool ---
+STATEMENT_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+(\w+)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def statement_label(sql: str) -> str:
+    """Metric label for a SQL statement: its verb and first table, e.g. "SELECT messages".
+
+    Deliberately coarse, so statements built with variable-length IN (?,?,...)
+    lists or f-strings don't each become a label of their own.
+    """
+    words = sql.split(None, 1)
+    verb = words[0].upper() if words else "?"
+    table = STATEMENT_TABLE.search(sql)
+    return f"{verb} {table.group(1).lower()}" if table else verb
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records execute() latency (time to first row for SELECTs)."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, (statement_label(sql),))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, (statement_label(sql),))
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts execute on a fresh cursor without going through
+    # Cursor.execute, so route them through a TimedCursor
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_NAME, timeout=30)
+    conn = sqlite3.connect(DB_NAME, timeout=30, factory=TimedConnection)
     conn.row_factory = sqlite3.Row
     try:
         yield conn
     finally:
         conn.close()
 
+DEFAULT_CHANNEL = "general"
+
+
 def init_db():
     with get_db() as conn:
         c = conn.cursor()
@@ -489,7 +1206,19 @@ def init_db():
         c.execute('''CREATE TABLE IF NOT EXISTS messages 
                      (id TEXT PRIMARY KEY, username TEXT, message TEXT, type TEXT, 
                       timestamp TEXT, reply_to TEXT, read_by TEXT DEFAULT '[]',
-                      file_size INTEGER DEFAULT 0, original_name TEXT, reactions TEXT DEFAULT '{}')''')
+                      file_size INTEGER DEFAULT 0, original_name TEXT, reactions TEXT DEFAULT '{}',
+                      channel_id TEXT DEFAULT 'general')''')
+        # Channels: "general", named public channels and two-person direct
+        # conversations. `key` keeps names unique (and one DM per pair).
+        c.execute('''CREATE TABLE IF NOT EXISTS channels
+                     (id TEXT PRIMARY KEY, key TEXT UNIQUE, name TEXT, kind TEXT,
+                      created_by TEXT, created_at TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS channel_members
+                     (channel_id TEXT, username TEXT, PRIMARY KEY (channel_id, username))''')
+        c.execute("CREATE INDEX IF NOT EXISTS idx_channel_members_user ON channel_members(username)")
+        # Duration, waveform and Opus copy size of each transcoded voice note
+        c.execute('''CREATE TABLE IF NOT EXISTS voice_notes
+                     (media_key TEXT PRIMARY KEY, duration REAL, peaks TEXT, opus_size INTEGER DEFAULT 0)''')
         
         # Add new columns if they don't exist (migration)
         try:
@@ -512,17 +1241,25 @@ def init_db():
             c.execute("ALTER TABLE messages ADD COLUMN reactions TEXT DEFAULT '{}'")
         except:
             pass
+        try:
+            # Everything sent before channels existed was in the one global room
+            c.execute("ALTER TABLE messages ADD COLUMN channel_id TEXT DEFAULT 'general'")
+        except:
+            pass
+        c.execute("CREATE INDEX IF NOT EXISTS idx_messages_channel ON messages(channel_id, timestamp)")
+        c.execute("INSERT OR IGNORE INTO channels VALUES (?, ?, ?, 'channel', NULL, ?)",
+                  (DEFAULT_CHANNEL, DEFAULT_CHANNEL, DEFAULT_CHANNEL, datetime.now().isoformat()))
         
         conn.commit()
 
-init_db()
-
 
 def migrate_media_message_paths():
     """Normalize stored media keys in DB from flat filename to bucket/filename."""
     with get_db() as conn:
         c = conn.cursor()
-        c.execute("SELECT id, message, type FROM messages WHERE type IN ('image', 'video', 'file', 'voice')")
+        # Only flat keys need work; runs on every start, so skip the rest in SQL
+        c.execute("""SELECT id, message, type FROM messages
+                     WHERE type IN ('image', 'video', 'file', 'voice') AND instr(message, '/') = 0""")
         rows = c.fetchall()
 
         for row in rows:
@@ -533,167 +1270,1033 @@ def migrate_media_message_paths():
 
         conn.commit()
 
+# --- HOT MESSAGE CACHE ---
+# Replies, edits, deletes, reactions and read receipts almost always target
+# recent messages. The newest CHAT_MESSAGE_CACHE rows (with their read_by and
+# reactions) live in an LRU so those handlers skip the SELECT; a miss falls
+# back to the DB and caches the row. Every write updates the cache after its
+# commit, and all of it runs on the event loop, so there is nothing to lock.
+# Workers don't share it, so it is turned off when --workers > 1.
+#
+#   CHAT_MESSAGE_CACHE    messages kept in memory, default 2000 (0 disables)
 
-migrate_media_message_paths()
+MESSAGE_CACHE_SIZE = max(0, int(os.environ.get("CHAT_MESSAGE_CACHE", "2000")))
+MESSAGE_CACHE_COLUMNS = "id, username, message, type, timestamp, read_by, reactions, channel_id"
+MESSAGE_CACHE_HITS = metrics.counter("chatter_message_cache_hits_total", "Message lookups answered from memory")
+MESSAGE_CACHE_MISSES = metrics.counter("chatter_message_cache_misses_total", "Message lookups that went to the DB")
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[WebSocket, str] = {}
-        self.typing_users: Set[str] = set()
-        self._lock = asyncio.Lock()
 
-    async def connect(self, websocket: WebSocket, username: str):
-        async with self._lock:
-            self.active_connections[websocket] = username
+class MessageCache:
+    """id -> {username, message, type, timestamp, read_by, reactions, channel_id} for recent messages.
 
-    async def disconnect(self, websocket: WebSocket):
-        async with self._lock:
-            if websocket in self.active_connections:
-                del self.active_connections[websocket]
+    Entries are shared: callers build new read_by/reactions values and hand
+    them to update() instead of mutating what get() returned.
+    """
 
-    def get_online_users(self) -> List[str]:
-        return list(set(self.active_connections.values()))
-
-    async def broadcast(self, message_data: dict, exclude: WebSocket = None):
-        disconnected = []
-        for connection in list(self.active_connections.keys()):
-            if connection != exclude:
-                try:
-                    await connection.send_json(message_data)
-                except Exception:
-                    disconnected.append(connection)
-        
-        # Clean up disconnected clients
-        for conn in disconnected:
-            await self.disconnect(conn)
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
 
-    async def broadcast_to_all(self, message_data: dict):
-        disconnected = []
-        for connection in list(self.active_connections.keys()):
-            try:
-                await connection.send_json(message_data)
-            except Exception:
-                disconnected.append(connection)
-        
-        for conn in disconnected:
-            await self.disconnect(conn)
+    @staticmethod
+    def _entry(row) -> dict:
+        return {
+            "username": row["username"],
+            "message": row["message"],
+            "type": row["type"],
+            "timestamp": row["timestamp"],
+            "read_by": json.loads(row["read_by"]) if row["read_by"] else [],
+            "reactions": json.loads(row["reactions"]) if row["reactions"] else {},
+            "channel_id": row["channel_id"] or DEFAULT_CHANNEL,
+        }
 
-manager = ConnectionManager()
+    @staticmethod
+    def _select(conn: sqlite3.Connection, msg_id: str):
+        c = conn.cursor()
+        c.execute(f"SELECT {MESSAGE_CACHE_COLUMNS} FROM messages WHERE id=?", (msg_id,))
+        return c.fetchone()
 
-@app.get("/")
-async def get():
-    async with aiofiles.open("index.html", "r", encoding="utf-8") as f:
-        content = await f.read()
-    return HTMLResponse(content=content)
+    def __len__(self):
+        return len(self._entries)
 
-@app.get("/call")
-async def get_call_page():
-    """Serve the dedicated call screen for popup/separate window calls"""
-    if os.path.exists("call.html"):
-        async with aiofiles.open("call.html", "r", encoding="utf-8") as f:
-            content = await f.read()
-        return HTMLResponse(content=content)
-    else:
-        return HTMLResponse(content="<h1>Call page not found</h1>", status_code=404)
+    def put(self, msg_id: str, entry: dict):
+        if not self.size:
+            return
+        self._entries[msg_id] = entry
+        self._entries.move_to_end(msg_id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
 
-@app.get("/favicon.ico")
-async def favicon():
-    """Return empty favicon to prevent 404 errors in logs"""
-    return Response(status_code=204)
+    def get(self, msg_id: str, conn: Optional[sqlite3.Connection] = None) -> Optional[dict]:
+        """The cached message, or the DB row (then cached); None if it doesn't exist."""
+        entry = self._entries.get(msg_id)
+        if entry is not None:
+            self._entries.move_to_end(msg_id)
+            MESSAGE_CACHE_HITS.inc()
+            return entry
+        MESSAGE_CACHE_MISSES.inc()
+        if conn is None:
+            with get_db() as conn:
+                row = self._select(conn, msg_id)
+        else:
+            row = self._select(conn, msg_id)
+        if row is None:
+            return None
+        entry = self._entry(row)
+        self.put(msg_id, entry)
+        return entry
 
-@app.on_event("startup")
-async def startup_event():
-    """Set up Windows exception handler on startup"""
-    if sys.platform == 'win32':
-        loop = asyncio.get_event_loop()
-        loop.set_exception_handler(windows_exception_handler)
-    
-    # Start hardware monitoring
-    await monitor.start()
+    def update(self, msg_id: str, **fields):
+        """Apply a committed write; rows that aren't cached are left to the next miss."""
+        entry = self._entries.get(msg_id)
+        if entry is not None:
+            self._entries[msg_id] = dict(entry, **fields)
 
-# File upload constraints for security
-MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
-ALLOWED_EXTENSIONS = {
-    'image': ['jpg', 'jpeg', 'png', 'webp', 'gif', 'bmp', 'svg'],
-    'video': ['mp4', 'webm', 'mov', 'avi', 'mkv'],
-    'document': ['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'txt', 'csv'],
-    'archive': ['zip', 'rar', '7z', 'tar', 'gz']
-}
-ALL_ALLOWED_EXTENSIONS = set()
-for exts in ALLOWED_EXTENSIONS.values():
-    ALL_ALLOWED_EXTENSIONS.update(exts)
+    def discard(self, msg_id: str):
+        self._entries.pop(msg_id, None)
 
-# --- OPTIMIZED MULTI-FILE UPLOAD WITH STREAMING ---
-@app.post("/upload")
-async def upload_files(request: Request, files: List[UploadFile] = File(...)):
-    # Rate limiting check
-    client_ip = request.client.host if request.client else "unknown"
-    if not rate_limiter.is_allowed(client_ip):
-        raise HTTPException(status_code=429, detail="Too many requests. Please slow down.")
-    
-    uploaded_results = []
-    thumbnail_tasks = []
-    
-    for file in files:
-        try:
-            # Validate file extension
-            file_extension = file.filename.split(".")[-1].lower() if "." in file.filename else ""
-            if file_extension not in ALL_ALLOWED_EXTENSIONS:
-                print(f"Rejected file with extension: {file_extension}")
-                continue
-            
-            unique_name = f"{uuid.uuid4()}.{file_extension}"
-            if (file.content_type or "").startswith("audio/"):
-                file_type = "voice"
-            elif (file.content_type or "").startswith("image/"):
-                file_type = "image"
-            elif (file.content_type or "").startswith("video/"):
-                file_type = "video"
-            else:
-                file_type = 'image' if file_extension in ['jpg', 'jpeg', 'png', 'webp', 'gif'] else ('video' if file_extension in ['mp4', 'webm', 'mov'] else 'file')
-            media_key = normalize_media_key(unique_name, file_type)
-            file_path = media_disk_path(media_key)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            
-            # Stream file to disk in chunks for better performance
-            file_size = 0
-            async with aiofiles.open(file_path, "wb") as buffer:
-                while True:
-                    chunk = await file.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    file_size += len(chunk)
-                    
-                    # Check file size limit
-                    if file_size > MAX_FILE_SIZE:
-                        await buffer.close()
-                        os.remove(file_path)
-                        raise HTTPException(status_code=413, detail=f"File too large. Max size is {MAX_FILE_SIZE // (1024*1024)}MB")
-                    
-                    await buffer.write(chunk)
-            
-            # Queue thumbnail generation (will be processed in parallel)
-            thumb_task = None
-            if file_extension in ['jpg', 'jpeg', 'png', 'webp', 'gif']:
-                loop = asyncio.get_event_loop()
-                thumb_task = loop.run_in_executor(None, generate_thumbnail, file_path, media_key)
-                thumbnail_tasks.append((len(uploaded_results), thumb_task))
-            
-            # Log successful upload
-            log.file_uploaded(file.filename, file_size / (1024 * 1024), file_type)
-            
-            uploaded_results.append({
-                "filename": media_key,
-                "original_name": file.filename,
-                "ext": file_extension,
-                "size": file_size,
-                "has_thumb": False  # Will be updated after parallel processing
-            })
-        except HTTPException:
-            raise
-        except Exception as e:
-            log.upload_failed(file.filename, str(e))
+    def warm(self):
+        """Load the newest messages (runs in a thread before the server accepts sockets)."""
+        if not self.size:
+            return
+        with get_db() as conn:
+            rows = conn.cursor().execute(
+                f"SELECT {MESSAGE_CACHE_COLUMNS} FROM messages ORDER BY timestamp DESC LIMIT ?", (self.size,)
+            ).fetchall()
+        self._entries = OrderedDict((row["id"], self._entry(row)) for row in reversed(rows))
+
+
+message_cache = MessageCache(MESSAGE_CACHE_SIZE)
+
+metrics.gauge("chatter_message_cache_entries", "Messages held in the hot message cache",
+              callback=lambda: len(message_cache))
+
+# --- PASSWORDS & SESSION TOKENS ---
+# Passwords are stored as salted scrypt hashes. Hashing is deliberately slow,
+# so it runs in a small thread pool (hashlib releases the GIL) instead of on
+# the event loop. After a login the client gets a signed resume token; a
+# reconnect that presents it is verified with one HMAC, no DB or hash work.
+#
+#   CHAT_SESSION_SECRET       HMAC key (default: generated into data/session.key)
+#   CHAT_SESSION_TTL_HOURS    resume token lifetime, default 12
+
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+SESSION_TOKEN_TTL = int(float(os.environ.get("CHAT_SESSION_TTL_HOURS", "12")) * 3600)
+SESSION_KEY_FILE = os.path.join(DATA_DIR, "session.key")
+
+AUTH_EXECUTOR = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix="auth")
+
+
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32)
+    return "scrypt${}${}${}${}${}".format(
+        SCRYPT_N, SCRYPT_R, SCRYPT_P,
+        base64.b64encode(salt).decode(), base64.b64encode(digest).decode(),
+    )
+
+
+def verify_password(password: str, stored: str):
+    """Return (matches, needs_rehash). Plaintext rows from older versions still work once."""
+    if not stored or not stored.startswith("scrypt$"):
+        return secrets.compare_digest((stored or "").encode(), password.encode()), True
+    try:
+        _, n, r, p, salt, expected = stored.split("$")
+        n, r, p = int(n), int(r), int(p)
+        digest = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=n, r=r, p=p,
+                                dklen=len(base64.b64decode(expected)))
+    except (ValueError, TypeError):
+        return False, False
+    matches = secrets.compare_digest(digest, base64.b64decode(expected))
+    return matches, matches and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+@functools.lru_cache(maxsize=1)
+def session_secret() -> bytes:
+    """HMAC key shared by all workers and kept across restarts."""
+    configured = os.environ.get("CHAT_SESSION_SECRET")
+    if configured:
+        return configured.encode()
+    try:
+        with open(SESSION_KEY_FILE, "rb") as f:
+            key = f.read()
+        if len(key) >= 32:
+            return key
+    except FileNotFoundError:
+        pass
+    key = secrets.token_bytes(32)
+    fd = os.open(SESSION_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    return key
+
+
+def _sign(payload: str) -> str:
+    mac = hmac.new(session_secret(), payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).decode().rstrip("=")
+
+
+def issue_session_token(username: str) -> str:
+    user = base64.urlsafe_b64encode(username.encode()).decode().rstrip("=")
+    payload = f"{user}.{int(time.time()) + SESSION_TOKEN_TTL}"
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify_session_token(token: str, username: str) -> bool:
+    """Cheap in-memory check: right signature, right user, not expired."""
+    try:
+        user, expires, signature = token.split(".")
+        # compare_digest refuses non-ASCII str, so compare bytes
+        if not secrets.compare_digest(signature.encode(), _sign(f"{user}.{expires}").encode()):
+            return False
+        user = base64.urlsafe_b64decode(user + "=" * (-len(user) % 4)).decode()
+        return user == username and int(expires) > time.time()
+    except (ValueError, AttributeError, TypeError):
+        return False
+
+
+async def authenticate_user(username: str, password: str) -> bool:
+    """Check a password (registering unknown users), hashing off the event loop."""
+    loop = asyncio.get_event_loop()
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT password FROM users WHERE username=?", (username,))
+        user_record = c.fetchone()
+
+    if not user_record:
+        hashed = await loop.run_in_executor(AUTH_EXECUTOR, hash_password, password)
+        with get_db() as conn:
+            conn.cursor().execute("INSERT INTO users VALUES (?, ?)", (username, hashed))
+            conn.commit()
+        log.new_user_registered(username)
+        return True
+
+    matches, needs_rehash = await loop.run_in_executor(
+        AUTH_EXECUTOR, verify_password, password, user_record['password'])
+    if matches and needs_rehash:
+        hashed = await loop.run_in_executor(AUTH_EXECUTOR, hash_password, password)
+        with get_db() as conn:
+            conn.cursor().execute("UPDATE users SET password=? WHERE username=?", (hashed, username))
+            conn.commit()
+    return matches
+
+
+# Heartbeats: clients quiet for WS_PING_INTERVAL get a ping frame; no frame
+# at all for another WS_PING_TIMEOUT and the socket is reaped. The same values
+# drive uvicorn's transport-level ping/pong when started via `python main.py`.
+WS_PING_INTERVAL = float(os.environ.get("CHAT_WS_PING_INTERVAL", "20"))
+WS_PING_TIMEOUT = float(os.environ.get("CHAT_WS_PING_TIMEOUT", "20"))
+WS_SEND_TIMEOUT = float(os.environ.get("CHAT_WS_SEND_TIMEOUT", "5"))
+
+# Joins/leaves inside this window go out as one presence frame, so a reconnect
+# storm after a restart costs a handful of broadcasts instead of one per client.
+PRESENCE_BATCH_SECONDS = 0.25
+
+# --- WIRE FORMAT ---
+# JSON text frames by default. A client that lists "msgpack" in `codecs` at
+# login gets binary MessagePack frames instead (when the module is installed),
+# with the hottest fields under short keys. Binary frames from the client are
+# always MessagePack, text frames always JSON, so both ends can mix them.
+try:
+    import msgpack
+except ImportError:  # optional: pip install msgpack
+    msgpack = None
+
+# Anything larger is not a chat frame (SDP for a 10-person SFU call is ~30KB);
+# uvicorn's --ws-max-size caps the transport separately
+WS_MAX_FRAME_BYTES = int(os.environ.get("CHAT_WS_MAX_FRAME", str(256 * 1024)))
+
+# Top-level keys only; static/js/app.js keeps the same table
+WIRE_KEYS = {
+    "type": "t", "id": "i", "user": "u", "msg": "m", "timestamp": "ts",
+    "reply_to": "r", "reply_data": "rd", "read_by": "rb", "file_size": "fs",
+    "original_name": "on", "reactions": "rx", "content": "ct", "ids": "is",
+    "from": "f", "to": "o", "candidate": "c", "offer": "of", "answer": "an",
+    "channel": "ch",
+}
+WIRE_KEYS_BACK = {short: key for key, short in WIRE_KEYS.items()}
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+# Stored messages are replayed as plain tuples in this column order (history
+# can be 100k rows per login). read_by and reactions stay the JSON text they
+# are stored as: the JSON codec splices them into the frame unparsed.
+class MessageRecord(NamedTuple):
+    id: str
+    username: str
+    message: str
+    type: str
+    timestamp: str
+    reply_to: Optional[str]
+    read_by: str
+    file_size: Optional[int]
+    original_name: Optional[str]
+    reactions: str
+    channel_id: str
+    duration: Optional[float]   # voice notes, from voice_notes
+    peaks: Optional[str]
+    opus_size: Optional[int]
+
+
+MESSAGE_RECORD_SELECT = """SELECT m.id, m.username, m.message, m.type, m.timestamp, m.reply_to, m.read_by,
+    m.file_size, m.original_name, m.reactions, m.channel_id, v.duration, v.peaks, v.opus_size
+    FROM messages m LEFT JOIN voice_notes v ON m.type = 'voice' AND v.media_key = m.message"""
+
+# Frame keys of a message, in MessageRecord order (audio is added separately)
+MESSAGE_FRAME_KEYS = ("id", "user", "msg", "type", "timestamp", "reply_to", "read_by",
+                      "file_size", "original_name", "reactions", "channel")
+_json_string = json.encoder.encode_basestring_ascii  # what json.dumps uses for str
+_message_json = ('{{"type":{3},"id":{0},"user":{1},"msg":{2},"timestamp":{4},"reply_to":{5},"read_by":{6},'
+                 '"file_size":{7},"original_name":{8},"reactions":{9},"channel":{10}{11}}}').format
+
+
+class JsonCodec:
+    name = "json"
+
+    @staticmethod
+    def encode(message: dict) -> str:
+        return json.dumps(message)
+
+    @staticmethod
+    def encode_record(record) -> str:
+        """The frame for a stored message (a MessageRecord or plain row tuple), without building a dict."""
+        (msg_id, user, msg, kind, timestamp, reply_to, read_by, file_size,
+         original_name, reactions, channel, duration, peaks, opus_size) = record
+        return _message_json(
+            _json_string(msg_id), _json_string(user), _json_string(msg), _json_string(kind),
+            _json_string(timestamp), "null" if reply_to is None else _json_string(reply_to),
+            read_by or "[]", "null" if file_size is None else int(file_size),
+            "null" if original_name is None else _json_string(original_name), reactions or "{}",
+            _json_string(channel),
+            "" if duration is None else ',"audio":' + json.dumps(audio_info(msg, duration, peaks, opus_size)))
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    record_keys = tuple(WIRE_KEYS.get(key, key) for key in MESSAGE_FRAME_KEYS)
+
+    @staticmethod
+    def encode(message: dict) -> bytes:
+        return msgpack.packb({WIRE_KEYS.get(key, key): value for key, value in message.items()})
+
+    @classmethod
+    def encode_record(cls, record) -> bytes:
+        frame = dict(zip(cls.record_keys, record))  # stops at channel: audio columns are left out
+        rb, rx = WIRE_KEYS["read_by"], WIRE_KEYS["reactions"]
+        frame[rb] = json.loads(frame[rb]) if frame[rb] else []
+        frame[rx] = json.loads(frame[rx]) if frame[rx] else {}
+        if record[11] is not None:
+            frame["audio"] = audio_info(record[2], record[11], record[12], record[13])
+        return msgpack.packb(frame)
+
+
+JSON_CODEC = JsonCodec()
+WS_CODECS = {"json": JSON_CODEC}
+if msgpack is not None:
+    WS_CODECS["msgpack"] = MsgpackCodec()
+
+
+def negotiate_codec(offered) -> JsonCodec:
+    """First codec from the client's login `codecs` list that we support."""
+    if isinstance(offered, list):
+        for name in offered:
+            if isinstance(name, str) and name in WS_CODECS:
+                return WS_CODECS[name]
+    return JSON_CODEC
+
+
+def decode_frame(message: dict):
+    """Turn one ASGI websocket.receive message into a request dict."""
+    data = message.get("bytes")
+    if data is not None:
+        if len(data) > WS_MAX_FRAME_BYTES:
+            raise FrameTooLarge(len(data))
+        if msgpack is None:
+            raise ValueError("binary frame but msgpack is not installed")
+        decoded = msgpack.unpackb(data, raw=False)
+        if not isinstance(decoded, dict):
+            return decoded
+        return {WIRE_KEYS_BACK.get(key, key): value for key, value in decoded.items()}
+    text = message.get("text") or ""
+    # len() counts characters; a UTF-8 frame can only be larger than that
+    if len(text) > WS_MAX_FRAME_BYTES:
+        raise FrameTooLarge(len(text))
+    return json.loads(text)
+
+
+async def receive_frame(websocket: WebSocket):
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return decode_frame(message)
+
+
+class ConnectionManager:
+    def __init__(self):
+        self.active_connections: Dict[WebSocket, str] = {}
+        self.typing_users: Dict[str, Set[str]] = {}  # channel -> users typing in it
+        # Channel subscriptions, both directions: who gets a channel's traffic,
+        # and what to clean up when a socket goes away
+        self.channel_sockets: Dict[str, Set[WebSocket]] = {}
+        self.socket_channels: Dict[WebSocket, Set[str]] = {}
+        self._lock = asyncio.Lock()
+        # Presence: open sockets per user, so a second tab/phone isn't a "join"
+        self.user_sockets: Dict[str, int] = {}
+        self.presence_version = 0
+        self._pending_joins: Set[str] = set()
+        self._pending_leaves: Set[str] = set()
+        self._presence_flush = None
+        self.last_seen: Dict[WebSocket, float] = {}
+        self.codecs: Dict[WebSocket, JsonCodec] = {}
+        self._heartbeat_task = None
+        self.draining = False  # set on shutdown; new sockets are turned away
+
+    async def connect(self, websocket: WebSocket, username: str, codec: JsonCodec = JSON_CODEC):
+        async with self._lock:
+            self.active_connections[websocket] = username
+            self.last_seen[websocket] = time.monotonic()
+            self.codecs[websocket] = codec
+            count = self.user_sockets.get(username, 0) + 1
+            self.user_sockets[username] = count
+            if count == 1:
+                self._queue_presence(username, joined=True)
+
+    async def disconnect(self, websocket: WebSocket):
+        async with self._lock:
+            username = self.active_connections.pop(websocket, None)
+            self.last_seen.pop(websocket, None)
+            self.codecs.pop(websocket, None)
+            for channel in self.socket_channels.pop(websocket, ()):
+                self._drop_subscriber(channel, websocket)
+            if username is None:
+                return
+            count = self.user_sockets.get(username, 1) - 1
+            if count > 0:
+                self.user_sockets[username] = count
+            else:
+                self.user_sockets.pop(username, None)
+                for typing in self.typing_users.values():
+                    typing.discard(username)
+                self._queue_presence(username, joined=False)
+
+    # --- CHANNEL SUBSCRIPTIONS ---
+    def subscribe(self, websocket: WebSocket, channels):
+        for channel in channels:
+            self.channel_sockets.setdefault(channel, set()).add(websocket)
+            self.socket_channels.setdefault(websocket, set()).add(channel)
+
+    def unsubscribe(self, websocket: WebSocket, channel: str):
+        self.socket_channels.get(websocket, set()).discard(channel)
+        self._drop_subscriber(channel, websocket)
+
+    def _drop_subscriber(self, channel: str, websocket: WebSocket):
+        sockets = self.channel_sockets.get(channel)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets:
+                del self.channel_sockets[channel]
+                self.typing_users.pop(channel, None)
+
+    def is_subscribed(self, websocket: WebSocket, channel: str) -> bool:
+        return channel in self.socket_channels.get(websocket, ())
+
+    def sockets_of(self, username: str) -> List[WebSocket]:
+        return [ws for ws, user in self.active_connections.items() if user == username]
+
+    def typing_in(self, channel: str) -> Set[str]:
+        return self.typing_users.setdefault(channel, set())
+
+    def get_online_users(self) -> List[str]:
+        return list(self.user_sockets)
+
+    def presence_snapshot(self) -> dict:
+        """Full presence state; sent at login and when a client sees a version gap."""
+        return {
+            "type": "presence_snapshot",
+            "v": self.presence_version,
+            "online_users": self.get_online_users(),
+            "devices": dict(self.user_sockets),
+        }
+
+    def _queue_presence(self, username: str, joined: bool):
+        adds, removes = (self._pending_joins, self._pending_leaves) if joined else \
+            (self._pending_leaves, self._pending_joins)
+        if username in removes:
+            # Left and came back (or the reverse) within the window: nothing to tell
+            removes.discard(username)
+        else:
+            adds.add(username)
+        if self._presence_flush is None:
+            self._presence_flush = asyncio.get_running_loop().call_later(
+                PRESENCE_BATCH_SECONDS, lambda: asyncio.ensure_future(self._flush_presence()))
+
+    async def _flush_presence(self):
+        self._presence_flush = None
+        if not self._pending_joins and not self._pending_leaves:
+            return
+        self.presence_version += 1
+        delta = {
+            "type": "presence",
+            "v": self.presence_version,
+            "joined": sorted(self._pending_joins),
+            "left": sorted(self._pending_leaves),
+            "online_count": len(self.user_sockets),
+        }
+        self._pending_joins.clear()
+        self._pending_leaves.clear()
+        await self.broadcast(delta)
+
+    async def _send_frame(self, websocket: WebSocket, frame) -> bool:
+        """Send one encoded frame; a client that can't take it within WS_SEND_TIMEOUT is dropped."""
+        send = websocket.send_bytes if isinstance(frame, bytes) else websocket.send_text
+        try:
+            await asyncio.wait_for(send(frame), WS_SEND_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            WS_SEND_TIMEOUTS.inc()
+            if websocket in self.active_connections:
+                # Closing can itself block on the stuck transport, so don't wait for it here
+                asyncio.create_task(self.reap(websocket))
+            return False
+        except Exception:
+            return False
+
+    async def send(self, websocket: WebSocket, message_data: dict) -> bool:
+        """Send one message to one socket in the codec it negotiated."""
+        codec = self.codecs.get(websocket, JSON_CODEC)
+        return await self._send_frame(websocket, codec.encode(message_data))
+
+    async def send_record(self, websocket: WebSocket, record) -> bool:
+        """Send a stored message (MessageRecord row) to one socket."""
+        codec = self.codecs.get(websocket, JSON_CODEC)
+        return await self._send_frame(websocket, codec.encode_record(record))
+
+    async def broadcast(self, message_data: dict, exclude: WebSocket = None, channel: Optional[str] = None):
+        """Send to every socket, or only to the subscribers of `channel`."""
+        sockets = self.active_connections if channel is None else self.channel_sockets.get(channel, ())
+        targets = [ws for ws in sockets if ws is not exclude]
+        if not targets:
+            return
+        # Encode once per codec, then send concurrently so one stalled client
+        # doesn't make everybody behind it wait for its timeout
+        frames = {}
+        for ws in targets:
+            codec = self.codecs.get(ws, JSON_CODEC)
+            if codec not in frames:
+                frames[codec] = codec.encode(message_data)
+        with BROADCAST_SECONDS.time():
+            if len(targets) == 1:
+                results = [await self._send_frame(targets[0], next(iter(frames.values())))]
+            else:
+                results = await asyncio.gather(*(
+                    self._send_frame(ws, frames[self.codecs.get(ws, JSON_CODEC)]) for ws in targets))
+        disconnected = [ws for ws, ok in zip(targets, results) if not ok]
+        BROADCAST_RECIPIENTS.inc(len(targets) - len(disconnected))
+        
+        # Clean up disconnected clients
+        for conn in disconnected:
+            await self.disconnect(conn)
+
+    async def broadcast_to_all(self, message_data: dict):
+        await self.broadcast(message_data)
+
+    async def broadcast_to_channel(self, channel: str, message_data: dict, exclude: WebSocket = None):
+        await self.broadcast(message_data, exclude, channel)
+
+    async def send_to_user(self, username: str, message_data: dict) -> bool:
+        """Send to the first open socket of `username` (used for call signaling)."""
+        for ws, user in list(self.active_connections.items()):
+            if user == username:
+                return await self.send(ws, message_data)
+        return False
+
+    # --- HEARTBEATS ---
+    def touch(self, websocket: WebSocket):
+        """Record that a client is alive (any frame counts)."""
+        self.last_seen[websocket] = time.monotonic()
+
+    def start_heartbeat(self):
+        if self._heartbeat_task is None and WS_PING_INTERVAL > 0:
+            self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        """Ping quiet clients and reap the ones that stopped answering.
+
+        Transport-level pings are configured on uvicorn (see __main__); this
+        catches half-open sockets the app would otherwise keep until a
+        broadcast to them happened to fail.
+        """
+        while True:
+            await asyncio.sleep(WS_PING_INTERVAL / 2)
+            await self.check_heartbeats()
+
+    async def check_heartbeats(self):
+        """One heartbeat pass: ping quiet sockets, reap expired ones (all at once, not in turn)."""
+        ping = {"type": "ping"}
+        now = time.monotonic()
+        expired = []
+        for ws in list(self.active_connections):
+            idle = now - self.last_seen.get(ws, now)
+            if idle >= WS_PING_INTERVAL + WS_PING_TIMEOUT:
+                expired.append(self.reap(ws, idle))
+            elif idle >= WS_PING_INTERVAL:
+                asyncio.ensure_future(self.send(ws, ping))
+        if expired:
+            await asyncio.gather(*expired)
+
+    async def reap(self, websocket: WebSocket, idle: Optional[float] = None):
+        """Drop and close a socket: silent for `idle` seconds, or (idle None) a send to it timed out."""
+        username = self.active_connections.get(websocket)
+        if idle is None:
+            log.connection_stalled(username)
+        else:
+            WS_REAPED.inc()
+            log.connection_reaped(username, idle)
+        await self.disconnect(websocket)
+        try:
+            await asyncio.wait_for(websocket.close(code=1001), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+manager = ConnectionManager()
+
+metrics.gauge("chatter_ws_connections", "Open WebSocket connections",
+              callback=lambda: len(manager.active_connections))
+metrics.gauge("chatter_online_users", "Distinct users with at least one open socket",
+              callback=lambda: len(manager.get_online_users()))
+metrics.gauge("chatter_active_channels", "Channels with at least one subscribed socket",
+              callback=lambda: len(manager.channel_sockets))
+
+# --- PAGE & ASSET CACHE ---
+# index.html, call.html and the main JS/CSS are read once, compressed once
+# (gzip, plus brotli when that module is installed) and answered from memory
+# with an ETag. Pages link the assets as /assets/<content hash>/..., so
+# browsers may keep those forever: a changed file simply gets a new URL.
+# With CHAT_DEV=1 file mtimes are re-checked on every request so edits show
+# up on a plain reload.
+
+try:
+    import brotli
+except ImportError:  # optional: pip install brotli
+    brotli = None
+
+DEV_MODE = os.environ.get("CHAT_DEV", "").lower() in ("1", "true", "yes")
+
+CACHED_ASSETS = {
+    "js/app.js": "application/javascript; charset=utf-8",
+    "css/app.css": "text/css; charset=utf-8",
+}
+ASSET_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def accepted_encodings(header: str) -> Set[str]:
+    encodings = set()
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0"):
             continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def etag_matches(if_none_match: Optional[str], tag: str) -> bool:
+    """True if If-None-Match names this file in any of its encodings."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        candidate = candidate.strip('"')
+        if candidate == "*" or candidate.split("-", 1)[0] == tag:
+            return True
+    return False
+
+
+class CachedFile:
+    """One file held in memory as identity, gzip and (optionally) brotli bodies."""
+
+    __slots__ = ("body", "gzip", "br", "etag", "content_type", "stamp")
+
+    def __init__(self, body: bytes, content_type: str, stamp):
+        self.body = body
+        self.content_type = content_type
+        self.stamp = stamp
+        self.etag = hashlib.sha256(body).hexdigest()[:16]
+        self.gzip = gzip.compress(body, compresslevel=9)
+        self.br = brotli.compress(body, quality=11) if brotli else None
+
+    def response(self, request: Request, cache_control: str) -> Response:
+        encodings = accepted_encodings(request.headers.get("accept-encoding", ""))
+        if self.br is not None and "br" in encodings:
+            body, encoding = self.br, "br"
+        elif "gzip" in encodings:
+            body, encoding = self.gzip, "gzip"
+        else:
+            body, encoding = self.body, None
+
+        # Each encoding is a different representation, so it gets its own tag
+        headers = {
+            "ETag": f'"{self.etag}-{encoding}"' if encoding else f'"{self.etag}"',
+            "Cache-Control": cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if etag_matches(request.headers.get("if-none-match"), self.etag):
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=self.content_type, headers=headers)
+
+
+class PageCache:
+    """In-memory pages and assets; rebuilt only when a file (or an asset a page links) changes."""
+
+    def __init__(self, dev: bool = False):
+        self.dev = dev
+        self._files: Dict[str, CachedFile] = {}
+
+    @staticmethod
+    def _stamp(path: str):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def _load(self, path: str, content_type: str, replacements: Optional[Dict[str, str]] = None) -> CachedFile:
+        stamp = (self._stamp(path), tuple(sorted(replacements.items())) if replacements else None)
+        entry = self._files.get(path)
+        if entry is not None and entry.stamp == stamp:
+            return entry
+        with open(path, "rb") as f:
+            body = f.read()
+        for old, new in (replacements or {}).items():
+            body = body.replace(f'"{old}"'.encode(), f'"{new}"'.encode())
+        entry = CachedFile(body, content_type, stamp)
+        self._files[path] = entry
+        return entry
+
+    def asset(self, name: str) -> CachedFile:
+        path = os.path.join("static", name)
+        entry = self._files.get(path)
+        if entry is not None and not self.dev:
+            return entry
+        return self._load(path, CACHED_ASSETS[name])
+
+    def page(self, filename: str) -> CachedFile:
+        entry = self._files.get(filename)
+        if entry is not None and not self.dev:
+            return entry
+        urls = {f"/static/{name}": f"/assets/{self.asset(name).etag}/{name}" for name in CACHED_ASSETS}
+        return self._load(filename, "text/html; charset=utf-8", urls)
+
+    def warm(self):
+        for filename in ("index.html", "call.html"):
+            try:
+                self.page(filename)
+            except FileNotFoundError:
+                pass
+
+
+page_cache = PageCache(dev=DEV_MODE)
+
+
+@app.get("/")
+async def get(request: Request):
+    return page_cache.page("index.html").response(request, "no-cache")
+
+@app.get("/call")
+async def get_call_page(request: Request):
+    """Serve the dedicated call screen for popup/separate window calls"""
+    try:
+        entry = page_cache.page("call.html")
+    except FileNotFoundError:
+        return HTMLResponse(content="<h1>Call page not found</h1>", status_code=404)
+    return entry.response(request, "no-cache")
+
+@app.get("/assets/{version}/{name:path}")
+async def get_asset(version: str, name: str, request: Request):
+    """Content-hashed app.js / app.css, cacheable forever"""
+    if name not in CACHED_ASSETS:
+        raise HTTPException(status_code=404, detail="Not found")
+    entry = page_cache.asset(name)
+    # A page from before the last edit may still ask for the old hash: answer, but don't pin it
+    return entry.response(request, ASSET_CACHE_CONTROL if version == entry.etag else "no-cache")
+
+@app.get("/favicon.ico")
+async def favicon():
+    """Return empty favicon to prevent 404 errors in logs"""
+    return Response(status_code=204)
+
+# --- STARTUP ---
+# Importing main has no side effects: folders, schema, data migrations and the
+# session key are set up by prepare_storage() when the server starts. With
+# --workers > 1 the parent process runs it once before forking and sets
+# CHAT_STORAGE_READY=1, so workers don't repeat (or race) the migrations.
+
+def prepare_storage():
+    """Create folders and the schema, migrate old data; safe to run again."""
+    create_storage_folders()
+    migrate_legacy_upload_folders()
+    init_db()
+    migrate_media_message_paths()
+    session_secret()  # one key file, before several workers could each write one
+
+
+@asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_event_loop()
+    if sys.platform == 'win32':
+        loop.set_exception_handler(windows_exception_handler)
+
+    if os.environ.get("CHAT_STORAGE_READY") != "1":
+        await loop.run_in_executor(None, prepare_storage)
+
+    # Start hardware monitoring
+    await monitor.start()
+    loop_lag.start()
+    slow_actions.start()
+    manager.start_heartbeat()
+
+    # Read and compress the pages once, off the event loop
+    await loop.run_in_executor(None, page_cache.warm)
+    await loop.run_in_executor(None, message_cache.warm)
+
+    if BACKUP_INTERVAL > 0:
+        asyncio.create_task(backup_loop())
+    yield
+    monitor.running = False
+
+
+app.router.lifespan_context = lifespan
+
+# File upload constraints for security
+MAX_FILE_SIZE = 100 * 1024 * 1024  # 100MB
+ALLOWED_EXTENSIONS = {
+    'image': ['jpg', 'jpeg', 'png', 'webp', 'gif', 'bmp', 'svg'],
+    'video': ['mp4', 'webm', 'mov', 'avi', 'mkv'],
+    'document': ['pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'txt', 'csv'],
+    'archive': ['zip', 'rar', '7z', 'tar', 'gz']
+}
+ALL_ALLOWED_EXTENSIONS = set()
+for exts in ALLOWED_EXTENSIONS.values():
+    ALL_ALLOWED_EXTENSIONS.update(exts)
+
+# --- STREAMING MULTI-FILE UPLOAD ---
+# The multipart body is parsed as it arrives and each file part is written
+# straight into its final place under data/media/ - no SpooledTemporaryFile
+# and no second copy. Disallowed parts are never written, and the size limit
+# is enforced while streaming rather than after the file is on disk.
+
+MAX_FILES_PER_UPLOAD = 20
+UPLOAD_BODY_LIMIT = MAX_FILE_SIZE * MAX_FILES_PER_UPLOAD
+
+
+def classify_upload(filename: str, content_type: str):
+    """Return (extension, message type) for an uploaded file, or (ext, None) if not allowed."""
+    file_extension = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    if file_extension not in ALL_ALLOWED_EXTENSIONS:
+        return file_extension, None
+    if content_type.startswith("audio/"):
+        file_type = "voice"
+    elif content_type.startswith("image/"):
+        file_type = "image"
+    elif content_type.startswith("video/"):
+        file_type = "video"
+    else:
+        file_type = 'image' if file_extension in ['jpg', 'jpeg', 'png', 'webp', 'gif'] else ('video' if file_extension in ['mp4', 'webm', 'mov'] else 'file')
+    return file_extension, file_type
+
+
+def write_all(fd: int, data) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+class UploadPart:
+    """One file part being streamed to disk."""
+
+    def __init__(self, filename: str, content_type: str):
+        self.filename = filename
+        self.content_type = content_type
+        self.ext, self.file_type = classify_upload(filename, content_type)
+        self.media_key = None
+        self.path = None
+        self.fd = None
+        self.size = 0
+        self.buffer = bytearray()
+
+    def open(self, size_hint: Optional[int]):
+        unique_name = f"{uuid.uuid4()}.{self.ext}"
+        self.media_key = normalize_media_key(unique_name, self.file_type)
+        self.path = media_disk_path(self.media_key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+        if size_hint and hasattr(os, "posix_fallocate"):
+            # Reserve the blocks up front (one extent, no ENOSPC halfway); trimmed on close
+            try:
+                os.posix_fallocate(self.fd, 0, size_hint)
+            except OSError:
+                pass
+
+    def finish(self):
+        os.ftruncate(self.fd, self.size)
+        os.close(self.fd)
+        self.fd = None
+
+    def discard(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def receive_multipart_files(request: Request) -> List[UploadPart]:
+    """Stream a multipart/form-data body, writing each allowed file part to disk."""
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected multipart/form-data")
+    content_length = int(request.headers.get("content-length") or 0)
+
+    loop = asyncio.get_event_loop()
+    events = []
+    header = {"field": b"", "value": b"", "headers": {}}
+
+    def on_header_field(data, start, end):
+        header["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        header["value"] += data[start:end]
+
+    def on_header_end():
+        header["headers"][header["field"].lower()] = header["value"]
+        header["field"] = header["value"] = b""
+
+    def on_headers_finished():
+        events.append(("begin", header["headers"]))
+        header["headers"] = {}
+
+    def on_part_data(data, start, end):
+        events.append(("data", data[start:end]))
+
+    def on_part_end():
+        events.append(("end", None))
+
+    parser = MultipartParser(boundary, {
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    parts: List[UploadPart] = []
+    current: Optional[UploadPart] = None
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            parser.write(chunk)
+            for kind, payload in events:
+                if kind == "begin":
+                    _, disposition = parse_options_header(payload.get(b"content-disposition", b""))
+                    filename = disposition.get(b"filename", b"").decode("utf-8", "replace")
+                    current = None
+                    if disposition.get(b"name") != b"files" or not filename:
+                        continue
+                    part = UploadPart(os.path.basename(filename.replace("\\", "/")),
+                                      payload.get(b"content-type", b"").decode("latin-1"))
+                    if part.file_type is None:
+                        log.warning(f"Rejected file with extension: {part.ext}")
+                        continue
+                    if len(parts) >= MAX_FILES_PER_UPLOAD:
+                        log.warning(f"Rejected {part.filename}: more than {MAX_FILES_PER_UPLOAD} files")
+                        continue
+                    # What's left of the body bounds this part's size
+                    remaining = content_length - received + len(chunk) if content_length else None
+                    try:
+                        part.open(min(remaining, MAX_FILE_SIZE) if remaining else None)
+                    except OSError as e:
+                        log.upload_failed(part.filename, str(e))
+                        continue
+                    parts.append(part)
+                    current = part
+                elif kind == "data" and current is not None:
+                    current.size += len(payload)
+                    if current.size > MAX_FILE_SIZE:
+                        raise HTTPException(status_code=413, detail=f"File too large. Max size is {MAX_FILE_SIZE // (1024*1024)}MB")
+                    current.buffer += payload
+                    if len(current.buffer) >= CHUNK_SIZE:
+                        data, current.buffer = current.buffer, bytearray()
+                        await loop.run_in_executor(None, write_all, current.fd, data)
+                elif kind == "end" and current is not None:
+                    data, current.buffer = current.buffer, bytearray()
+                    await loop.run_in_executor(None, write_all, current.fd, data)
+                    current.finish()
+                    current = None
+            events.clear()
+        parser.finalize()
+    except BaseException:
+        for part in parts:
+            part.discard()
+        raise
+    # Parts cut off by a truncated body are not usable
+    for part in parts:
+        if part.fd is not None:
+            part.discard()
+    return [part for part in parts if part.path and os.path.exists(part.path)]
+
+
+@app.post("/upload")
+async def upload_files(request: Request):
+    # Rate limiting check
+    client_ip = request.client.host if request.client else "unknown"
+    if not rate_limiter.is_allowed(client_ip):
+        raise HTTPException(status_code=429, detail="Too many requests. Please slow down.")
+
+    # Refuse obviously oversized requests before reading a single byte
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_BODY_LIMIT:
+        raise HTTPException(status_code=413, detail=f"Upload too large. Max size is {MAX_FILE_SIZE // (1024*1024)}MB per file")
+    
+    started = time.perf_counter()
+    uploaded_results = []
+    thumbnail_tasks = []
+    
+    try:
+        parts = await receive_multipart_files(request)
+    except ClientDisconnect:
+        log.upload_failed("(request)", "client disconnected")
+        return Response(status_code=400)
+
+    loop = asyncio.get_event_loop()
+    for part in parts:
+        # Queue thumbnail generation (will be processed in parallel)
+        if part.ext in ['jpg', 'jpeg', 'png', 'webp', 'gif']:
+            THUMBNAIL_QUEUE.inc()
+            thumb_task = loop.run_in_executor(None, generate_thumbnail, part.path, part.media_key)
+            thumb_task.add_done_callback(lambda _: THUMBNAIL_QUEUE.dec())
+            thumbnail_tasks.append((len(uploaded_results), thumb_task))
+        # Voice notes are re-encoded in the background (see VOICE NOTES)
+        elif part.file_type == "voice":
+            schedule_voice_note(part.media_key)
+        
+        # Log successful upload
+        log.file_uploaded(part.filename, part.size / (1024 * 1024), part.file_type)
+        UPLOAD_BYTES.inc(part.size)
+        UPLOAD_FILES.inc()
+        
+        uploaded_results.append({
+            "filename": part.media_key,
+            "original_name": part.filename,
+            "ext": part.ext,
+            "size": part.size,
+            "has_thumb": False  # Will be updated after parallel processing
+        })
     
     # Process all thumbnail generations in parallel
     if thumbnail_tasks:
@@ -706,12 +2309,57 @@ async def upload_files(request: Request, files: List[UploadFile] = File(...)):
         except Exception as e:
             log.error("Thumbnail batch processing failed", str(e))
             
+    UPLOAD_SECONDS.observe(time.perf_counter() - started)
     return {"files": uploaded_results}
 
+# --- IMAGE VARIANTS ---
+# Every image gets a 300px thumbnail. Photos that are big in pixels or bytes
+# also get a "display" copy (max 1600px WebP, EXIF orientation applied, all
+# metadata dropped) that the chat shows by default; /media/ keeps the original.
+DISPLAY_MAX_SIDE = 1600
+DISPLAY_MIN_BYTES = 512 * 1024
+DISPLAY_QUALITY = 80
+DISPLAY_SOURCE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'webp', 'bmp'}  # GIFs keep their animation
+
+
+def open_oriented_image(file_path: str, max_side: int = DISPLAY_MAX_SIDE):
+    """Open an image upright; JPEGs are decoded at reduced scale when that still covers max_side."""
+    from PIL import Image, ImageOps  # imported on first use: Pillow is the slowest import here
+    img = Image.open(file_path)
+    if img.format == 'JPEG':
+        img.draft('RGB', (max_side, max_side))
+    return ImageOps.exif_transpose(img)
+
+
+def generate_display_variant(img, file_path: str, media_key: str) -> bool:
+    """Write the display copy if the original is worth shrinking. Returns whether one exists."""
+    from PIL import Image
+    ext = media_key.rsplit(".", 1)[-1].lower()
+    if ext not in DISPLAY_SOURCE_EXTENSIONS:
+        return False
+    if max(img.size) <= DISPLAY_MAX_SIDE and os.path.getsize(file_path) <= DISPLAY_MIN_BYTES:
+        return False
+    display = img.convert('RGBA' if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info else 'RGB')
+    display.thumbnail((DISPLAY_MAX_SIDE, DISPLAY_MAX_SIDE), Image.Resampling.LANCZOS)
+    display_path = display_disk_path(media_key)
+    os.makedirs(os.path.dirname(display_path), exist_ok=True)
+    # Write beside the target and rename, so a concurrent reader never sees half a file
+    tmp_path = f"{display_path}.{uuid.uuid4().hex}.tmp"
+    display.save(tmp_path, 'WEBP', quality=DISPLAY_QUALITY, method=4)
+    os.replace(tmp_path, display_path)
+    return True
+
+
 def generate_thumbnail(file_path: str, media_key: str) -> bool:
-    """Generate thumbnail for image files"""
+    """Generate the thumbnail (and display copy) for an image file"""
+    from PIL import Image
+    started = time.perf_counter()
     try:
-        img = Image.open(file_path)
+        img = open_oriented_image(file_path)
+        try:
+            generate_display_variant(img, file_path, media_key)
+        except Exception as e:
+            log.error(f"Display copy failed for {media_key}", str(e))
         # Convert to RGB if necessary (for PNG with alpha)
         if img.mode in ('RGBA', 'P'):
             img = img.convert('RGB')
@@ -721,561 +2369,1960 @@ def generate_thumbnail(file_path: str, media_key: str) -> bool:
         img.save(thumb_path, quality=85, optimize=True)
         return True
     except Exception as e:
-        print(f"Thumbnail error: {e}")
+        log.error(f"Thumbnail failed for {media_key}", str(e))
         return False
+    finally:
+        THUMBNAIL_SECONDS.observe(time.perf_counter() - started)
+
+
+def display_variant_needed(file_path: str) -> bool:
+    """Whether an image is big enough for a display copy, from its header alone (no decode)."""
+    if os.path.getsize(file_path) > DISPLAY_MIN_BYTES:
+        return True
+    from PIL import Image
+    with Image.open(file_path) as img:
+        return max(img.size) > DISPLAY_MAX_SIDE
+
+
+def ensure_display_variant(file_path: str, media_key: str) -> bool:
+    """Create the display copy for an image uploaded before variants existed."""
+    try:
+        if not display_variant_needed(file_path):
+            return False
+        return generate_display_variant(open_oriented_image(file_path), file_path, media_key)
+    except Exception as e:
+        log.error(f"Display copy failed for {media_key}", str(e))
+        return False
+
+
+@app.get("/display/{media_key:path}")
+async def get_display_image(media_key: str):
+    """Chat-sized copy of an image; falls back to the original when it is small already"""
+    media_key = os.path.normpath(media_key).replace("\\", "/")
+    if media_key.startswith(("..", "/")) or os.path.isabs(media_key):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    display_path = display_disk_path(media_key)
+    if os.path.isfile(display_path):
+        return FileResponse(display_path, media_type="image/webp")
+
+    media_path = media_disk_path(media_key)
+    if not os.path.isfile(media_path):
+        raise HTTPException(status_code=404, detail="Not found")
+    if media_key.rsplit(".", 1)[-1].lower() in DISPLAY_SOURCE_EXTENSIONS:
+        loop = asyncio.get_event_loop()
+        if await loop.run_in_executor(None, ensure_display_variant, media_path, media_key):
+            return FileResponse(display_path, media_type="image/webp")
+    return FileResponse(media_path)
+
+
+def media_variants(media_key: str, msg_type: str, has_thumb: bool) -> dict:
+    """URLs of every stored rendition of a media file"""
+    variants = {"original": f"/media/{media_key}"}
+    if msg_type == "image":
+        variants["display"] = f"/display/{media_key}"
+    if has_thumb:
+        variants["thumb"] = f"/thumbs/{media_key}"
+    return variants
+
+# --- VOICE NOTES ---
+# The recorder uploads whatever the browser produces (WebM/Opus at 64-128
+# kbps, or AAC on Safari). A background worker re-encodes each voice note to
+# mono Opus at VOICE_BITRATE and measures its duration and a coarse waveform
+# in the same ffmpeg pass. Messages carry that as `audio`, so bubbles render
+# at their final size with no download, and playback fetches the small copy
+# from /opus/ (the original stays in /media/). Needs ffmpeg on the PATH;
+# without it voice notes play as before.
+#
+#   CHAT_FFMPEG         ffmpeg binary to use, default "ffmpeg" ("off" disables)
+#   CHAT_VOICE_BITRATE  Opus bitrate for voice notes, default 24k
+
+FFMPEG = os.environ.get("CHAT_FFMPEG", "ffmpeg")
+FFMPEG_PATH = shutil.which(FFMPEG) if FFMPEG != "off" else None
+VOICE_BITRATE = os.environ.get("CHAT_VOICE_BITRATE", "24k")
+VOICE_PEAKS = 48            # waveform bars per voice note
+VOICE_PEAK_RATE = 4000      # Hz of the mono PCM the waveform is measured on
+VOICE_TIMEOUT = 120         # seconds before a stuck ffmpeg is killed
+
+VOICE_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 4), thread_name_prefix="voice")
+VOICE_QUEUE = metrics.gauge("chatter_voice_queue_depth", "Voice notes waiting for or being transcoded")
+VOICE_SECONDS = metrics.histogram("chatter_voice_transcode_seconds", "Voice note transcode + waveform time")
+VOICE_BYTES_SAVED = metrics.counter("chatter_voice_bytes_saved_total", "Bytes the Opus copies save over the uploads")
+voice_jobs: Set[asyncio.Task] = set()
+
+
+def compute_peaks(pcm: bytes, count: int = VOICE_PEAKS) -> List[int]:
+    """Loudest sample of each of `count` slices of 16-bit mono PCM, scaled to 0-100."""
+    samples = array.array('h')
+    samples.frombytes(pcm[:len(pcm) // 2 * 2])
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    if not samples:
+        return []
+    step = max(1, len(samples) // count)
+    peaks = [max(max(chunk), -min(chunk)) for chunk in
+             (samples[i:i + step] for i in range(0, min(len(samples), step * count), step))]
+    loudest = max(peaks) or 1
+    return [round(peak * 100 / loudest) for peak in peaks]
+
+
+def transcode_voice_note(media_key: str):
+    """Write the Opus copy and store duration/peaks. Returns (audio info, [(message id, channel)])."""
+    source = media_disk_path(media_key)
+    target = opus_disk_path(media_key)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = f"{target}.{uuid.uuid4().hex}.tmp"
+    result = subprocess.run(
+        [FFMPEG_PATH, "-nostdin", "-v", "error", "-y", "-i", source,
+         "-map", "0:a:0", "-ac", "1", "-c:a", "libopus", "-b:a", VOICE_BITRATE, "-application", "voip",
+         "-f", "webm", partial,
+         "-map", "0:a:0", "-ac", "1", "-ar", str(VOICE_PEAK_RATE), "-f", "s16le", "pipe:1"],
+        capture_output=True, timeout=VOICE_TIMEOUT)
+    if result.returncode != 0:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise RuntimeError(result.stderr.decode(errors="replace").strip()[-300:] or f"ffmpeg exited {result.returncode}")
+    opus_size = os.path.getsize(partial)
+    original_size = os.path.getsize(source)
+    if opus_size < original_size:
+        os.replace(partial, target)
+        VOICE_BYTES_SAVED.inc(original_size - opus_size)
+    else:
+        os.remove(partial)  # the upload was already small: keep serving it
+        opus_size = 0
+    duration = round(len(result.stdout) / 2 / VOICE_PEAK_RATE, 2)
+    peaks = compute_peaks(result.stdout)
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT OR REPLACE INTO voice_notes VALUES (?, ?, ?, ?)",
+                  (media_key, duration, json.dumps(peaks), opus_size))
+        conn.commit()
+        c.execute("SELECT id, channel_id FROM messages WHERE message = ? AND type = 'voice'", (media_key,))
+        messages = [(row["id"], row["channel_id"]) for row in c.fetchall()]
+    return audio_info(media_key, duration, peaks, opus_size), messages
+
+
+def audio_info(media_key: str, duration: float, peaks, opus_size: int) -> dict:
+    """The `audio` field of a voice message frame."""
+    if isinstance(peaks, str):
+        peaks = json.loads(peaks)
+    info = {"duration": duration, "peaks": peaks}
+    if opus_size:
+        info["src"] = f"/opus/{media_key}.webm"
+    return info
+
+
+def lookup_audio_info(media_key: str) -> Optional[dict]:
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT duration, peaks, opus_size FROM voice_notes WHERE media_key = ?", (media_key,))
+        row = c.fetchone()
+    return audio_info(media_key, row["duration"], row["peaks"], row["opus_size"]) if row else None
+
+
+async def process_voice_note(media_key: str):
+    VOICE_QUEUE.inc()
+    started = time.perf_counter()
+    try:
+        info, messages = await asyncio.get_event_loop().run_in_executor(VOICE_EXECUTOR, transcode_voice_note, media_key)
+    except Exception as e:
+        log.error(f"Voice transcode failed for {media_key}", str(e))
+        return
+    finally:
+        VOICE_QUEUE.dec()
+        VOICE_SECONDS.observe(time.perf_counter() - started)
+    log.voice_transcoded(media_key, info["duration"], bool(info.get("src")))
+    # The message may already be out (the upload finished before the
+    # transcode); tell its channel. Otherwise it picks the info up when sent.
+    for msg_id, channel in messages:
+        await manager.broadcast_to_channel(channel, {"type": "media_update", "id": msg_id,
+                                                     "audio": info, "channel": channel})
+
+
+def schedule_voice_note(media_key: str):
+    """Transcode in the background; the upload response doesn't wait for it."""
+    if FFMPEG_PATH is None:
+        return
+    task = asyncio.get_event_loop().create_task(process_voice_note(media_key))
+    voice_jobs.add(task)
+    task.add_done_callback(voice_jobs.discard)
+
+# --- MEDIA GALLERY API ---
+@app.get("/api/media")
+async def get_media_gallery(
+    user: str,
+    token: str,
+    media_type: Optional[str] = None,
+    sort: str = "newest"
+):
+    """Get the media files of the user's channels for gallery view, sorted by date"""
+    if not verify_session_token(token, user):
+        raise HTTPException(status_code=403, detail="Invalid or expired token")
+    channels = [c["id"] for c in user_channels(user) if c["joined"]]
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        query = f"""SELECT id, username, message, type, timestamp, file_size, original_name 
+                   FROM messages WHERE type IN ('image', 'video', 'file')
+                   AND channel_id IN ({','.join('?' * len(channels))})"""
+        params = list(channels)
+        
+        if media_type and media_type != 'all':
+            query += " AND type = ?"
+            params.append(media_type)
+        
+        order = "DESC" if sort == "newest" else "ASC"
+        query += f" ORDER BY timestamp {order}"
+        
+        c.execute(query, params)
+        rows = c.fetchall()
+        
+        media_items = []
+        for row in rows:
+            media_key = normalize_media_key(row['message'], row['type'])
+            if not media_exists(media_key):
+                continue
+
+            has_thumb = thumb_exists(media_key)
+            variants = media_variants(media_key, row['type'], has_thumb)
+            media_items.append({
+                "id": row['id'],
+                "user": row['username'],
+                "filename": media_key,
+                "type": row['type'],
+                "timestamp": row['timestamp'],
+                "size": row['file_size'] or 0,
+                "original_name": row['original_name'] or os.path.basename(media_key),
+                "has_thumb": has_thumb,
+                "media_url": variants["original"],
+                "display_url": variants.get("display", variants["original"]),
+                "thumb_url": variants.get("thumb"),
+                "variants": variants
+            })
+        
+        return {"media": media_items, "total": len(media_items)}
+
+# --- MEDIA ARCHIVES ---
+# ZIPs are built while they are sent: zipfile writes into a non-seekable sink
+# that is drained after every chunk, so memory stays at about one chunk per
+# download no matter how many files are selected. Photos, videos and archives
+# are stored as-is; recompressing them costs CPU and saves nothing.
+#
+#   CHAT_ARCHIVE_BUILDS   ZIP downloads (gallery and export) built at once, default 2
+
+ARCHIVE_BUILDS = max(1, int(os.environ.get("CHAT_ARCHIVE_BUILDS", "2")))
+ARCHIVE_MAX_FILES = 5000
+ARCHIVE_CHUNK = 1024 * 1024
+STORED_EXTENSIONS = (set(ALLOWED_EXTENSIONS['image']) | set(ALLOWED_EXTENSIONS['video'])
+                     | set(ALLOWED_EXTENSIONS['archive'])
+                     | {'docx', 'xlsx', 'pptx', 'mp3', 'ogg', 'opus', 'm4a', 'aac', 'heic', 'avif'}) - {'bmp', 'svg'}
+
+ARCHIVE_DOWNLOADS = metrics.counter("chatter_archive_downloads_total", "ZIP downloads started", ("kind",))
+ARCHIVE_BYTES = metrics.counter("chatter_archive_bytes_total", "Bytes streamed in ZIP downloads")
+archive_slots = asyncio.Semaphore(ARCHIVE_BUILDS)
+
+
+class ZipSink(io.RawIOBase):
+    """Write-only, non-seekable file for zipfile: collects bytes until drained.
+
+    zipfile notices it can't seek and writes data descriptors after each
+    member instead of patching local headers, so the archive can be streamed.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        ARCHIVE_BYTES.inc(len(data))
+        return data
+
+
+def iter_zip(files: Iterable[tuple], texts: Optional[Dict[str, Iterable[str]]] = None):
+    """Yield a ZIP of `texts` and `files`, chunk by chunk.
+
+    `texts` maps member names to a string or to an iterable of string chunks
+    (written as they come); `files` is (name, disk path) pairs and is only
+    iterated once the texts are written.
+    """
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, content in (texts or {}).items():
+            if isinstance(content, str):
+                archive.writestr(name, content)
+            else:
+                with archive.open(name, "w", force_zip64=True) as member:
+                    for chunk in content:
+                        member.write(chunk.encode())
+                        yield sink.drain()
+            yield sink.drain()
+        for name, path in files:
+            try:
+                stamp = time.localtime(os.path.getmtime(path))[:6]
+            except OSError:
+                continue  # deleted since the selection was made
+            info = zipfile.ZipInfo(name, max(stamp, (1980, 1, 1, 0, 0, 0)))
+            ext = name.rsplit(".", 1)[-1].lower() if "." in name else ""
+            info.compress_type = zipfile.ZIP_STORED if ext in STORED_EXTENSIONS else zipfile.ZIP_DEFLATED
+            with open(path, "rb") as source, archive.open(info, "w", force_zip64=True) as member:
+                while True:
+                    chunk = source.read(ARCHIVE_CHUNK)
+                    if not chunk:
+                        break
+                    member.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()  # central directory, written on close
+
+
+def archive_response(kind: str, files: Iterable[tuple], filename: str,
+                     texts: Optional[Dict[str, Iterable[str]]] = None):
+    """StreamingResponse for iter_zip, holding one of the ARCHIVE_BUILDS slots while it streams."""
+    if archive_slots.locked():
+        raise HTTPException(status_code=503, detail="Too many downloads are being prepared, try again shortly",
+                            headers={"Retry-After": "10"})
+    ARCHIVE_DOWNLOADS.inc(labels=(kind,))
+
+    async def stream():
+        async with archive_slots:
+            # File reads and compression run in the threadpool, off the event loop
+            async for chunk in iterate_in_threadpool(iter_zip(files, texts)):
+                if chunk:
+                    yield chunk
+
+    return StreamingResponse(stream(), media_type="application/zip",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+def is_message_id(value: str) -> bool:
+    """Message ids are uuid4 strings."""
+    try:
+        return len(value) == 36 and str(uuid.UUID(value)) == value
+    except ValueError:
+        return False
+
+
+def unique_archive_name(name: str, taken: Set[str]) -> str:
+    """`name`, or `name (2)`, `name (3)`... if the archive already has it."""
+    stem, dot, ext = name.rpartition(".")
+    if not dot:
+        stem, ext = name, ""
+    candidate, n = name, 1
+    while candidate.lower() in taken:
+        n += 1
+        candidate = f"{stem} ({n}).{ext}" if dot else f"{stem} ({n})"
+    taken.add(candidate.lower())
+    return candidate
+
+
+@app.post("/api/media/archive")
+async def download_media_archive(request: Request):
+    """Stream a ZIP of gallery files chosen by id, or by type/sender/date range.
+
+    Takes a form or JSON body authenticated like /api/export (`user` and the
+    resume `token`), plus `ids` (list or comma-separated), or any of
+    `media_type` (image/video/file/voice), `sender`, `start` and `end` (dates,
+    inclusive). Only files from the caller's channels are included.
+    """
+    try:
+        if request.headers.get("content-type", "").startswith("application/json"):
+            fields = await request.json()
+        else:
+            fields = {k: v[-1] for k, v in parse_qs((await request.body()).decode()).items()}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body must be a form or a JSON object")
+    if not isinstance(fields, dict):
+        raise HTTPException(status_code=400, detail="Body must be a form or a JSON object")
+    for name in ("user", "token", "media_type", "sender", "start", "end"):
+        if not isinstance(fields.get(name) or "", str):
+            raise HTTPException(status_code=400, detail=f"'{name}' must be a string")
+    user = fields.get("user") or ""
+    if not verify_session_token(fields.get("token") or "", user):
+        raise HTTPException(status_code=403, detail="Invalid or expired token")
+
+    ids = fields.get("ids") or []
+    if isinstance(ids, str):
+        ids = [i for i in ids.split(",") if i]
+    if not isinstance(ids, list) or not all(isinstance(i, str) and is_message_id(i) for i in ids):
+        raise HTTPException(status_code=400, detail="'ids' must be a list of message ids")
+    if len(ids) > ARCHIVE_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {ARCHIVE_MAX_FILES} files per download")
+
+    query = "SELECT username, message, type, original_name FROM messages WHERE type IN ('image', 'video', 'file', 'voice')"
+    params: list = []
+    if ids:
+        query += f" AND id IN ({','.join('?' * len(ids))})"
+        params += ids
+    media_type = fields.get("media_type")
+    if media_type and media_type != "all":
+        query += " AND type = ?"
+        params.append(media_type)
+    if fields.get("sender"):
+        query += " AND username = ?"
+        params.append(fields["sender"])
+    if fields.get("start"):
+        query += " AND timestamp >= ?"
+        params.append(parse_export_date(fields["start"], "start").isoformat())
+    if fields.get("end"):
+        until = parse_export_date(fields["end"], "end")
+        if len(fields["end"]) <= 10:
+            until += timedelta(days=1)
+        query += " AND timestamp < ?"
+        params.append(until.isoformat())
+    if not params:
+        raise HTTPException(status_code=400, detail="Select files by 'ids' or a filter")
+    channels = [c["id"] for c in user_channels(user) if c["joined"]]
+    query += f" AND channel_id IN ({','.join('?' * len(channels))})"
+    params += channels
+    query += f" ORDER BY timestamp LIMIT {ARCHIVE_MAX_FILES + 1}"
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(query, params)
+        rows = c.fetchall()
+    if len(rows) > ARCHIVE_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"At most {ARCHIVE_MAX_FILES} files per download, narrow the filter")
+
+    files, taken, seen = [], set(), set()
+    for row in rows:
+        media_key = normalize_media_key(row['message'], row['type'])
+        if media_key in seen or not media_exists(media_key):
+            continue
+        seen.add(media_key)
+        name = os.path.basename(row['original_name'] or media_key).strip() or os.path.basename(media_key)
+        files.append((unique_archive_name(f"{MEDIA_SUBDIRS[row['type']]}/{name}", taken), media_disk_path(media_key)))
+    if not files:
+        raise HTTPException(status_code=404, detail="No files match")
+    return archive_response("gallery", files, f"chatter-media-{datetime.now():%Y%m%d-%H%M%S}.zip")
+
+
+def parse_export_date(value: str, name: str) -> datetime:
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"'{name}' must be a date like 2024-05-31")
+
+
+# --- CLEANUP ORPHAN FILES ---
+@app.post("/api/cleanup-orphans")
+async def cleanup_orphan_files():
+    """Remove files that exist on disk but not in database"""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT message, type FROM messages WHERE type IN ('image', 'video', 'file', 'voice')")
+        db_files = set(normalize_media_key(row[0], row[1]) for row in c.fetchall())
+    
+    cleaned_media = 0
+    cleaned_thumbs = 0
+    cleaned_display = 0
+    cleaned_opus = 0
+    
+    # Clean orphan media files
+    for filename in list_files_recursive(MEDIA_DIR):
+        if filename not in db_files:
+            try:
+                os.remove(media_disk_path(filename))
+                cleaned_media += 1
+            except Exception as e:
+                log.error(f"Could not remove orphan media {filename}", str(e))
+    
+    # Clean orphan thumbnails
+    for filename in list_files_recursive(THUMB_DIR):
+        if filename not in db_files:
+            try:
+                os.remove(thumb_disk_path(filename))
+                cleaned_thumbs += 1
+            except Exception as e:
+                log.error(f"Could not remove orphan thumbnail {filename}", str(e))
+
+    # Clean orphan display copies (<media key>.webp)
+    for filename in list_files_recursive(DISPLAY_DIR):
+        if filename[:-len(".webp")] not in db_files:
+            try:
+                os.remove(os.path.join(DISPLAY_DIR, filename))
+                cleaned_display += 1
+            except Exception as e:
+                log.error(f"Could not remove orphan display copy {filename}", str(e))
+
+    # Clean orphan Opus copies (<media key>.webm) and their waveforms
+    for filename in list_files_recursive(OPUS_DIR):
+        if filename[:-len(".webm")] not in db_files:
+            try:
+                os.remove(os.path.join(OPUS_DIR, filename))
+                cleaned_opus += 1
+            except Exception as e:
+                log.error(f"Could not remove orphan Opus copy {filename}", str(e))
+    with get_db() as conn:
+        conn.cursor().execute("DELETE FROM voice_notes WHERE media_key NOT IN "
+                              "(SELECT message FROM messages WHERE type = 'voice')")
+        conn.commit()
+    
+    return {
+        "status": "success",
+        "cleaned_media": cleaned_media,
+        "cleaned_thumbs": cleaned_thumbs,
+        "cleaned_display": cleaned_display,
+        "cleaned_opus": cleaned_opus
+    }
+
+# --- GET STORAGE STATS ---
+@app.get("/api/storage-stats")
+async def get_storage_stats():
+    """Get storage usage statistics"""
+    def get_folder_size(folder):
+        total = 0
+        for filename in list_files_recursive(folder):
+            filepath = os.path.join(folder, filename)
+            if os.path.isfile(filepath):
+                total += os.path.getsize(filepath)
+        return total
+    
+    media_size = get_folder_size(MEDIA_DIR)
+    thumb_size = get_folder_size(THUMB_DIR)
+    display_size = get_folder_size(DISPLAY_DIR)
+    media_count = len(list_files_recursive(MEDIA_DIR))
+    thumb_count = len(list_files_recursive(THUMB_DIR))
+    
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM messages WHERE type IN ('image', 'video', 'file', 'voice')")
+        db_count = c.fetchone()[0]
+    
+    return {
+        "media_size_bytes": media_size,
+        "thumb_size_bytes": thumb_size,
+        "display_size_bytes": display_size,
+        "media_count": media_count,
+        "thumb_count": thumb_count,
+        "db_media_count": db_count,
+        "orphan_files": media_count - db_count if media_count > db_count else 0
+    }
+
+# --- BACKUP & EXPORT ---
+# Copying chatter.db while the server writes can capture a torn file. Backups
+# use SQLite's online backup API instead: BACKUP_PAGES pages per step, in a
+# worker thread that sleeps BACKUP_STEP_PAUSE between steps (in the progress
+# callback), so chat gets the DB lock in between. A write from another
+# connection restarts a stepped copy from the first page; after
+# BACKUP_ATTEMPTS restarts the copy is done in a single step instead, which
+# holds the read lock until it finishes but can't be restarted, so a busy chat
+# delays its writes briefly rather than starving the backup. Media files never
+# change once stored, so a manifest of what was already copied makes every
+# later media backup incremental. Thumbnails and display copies are rebuilt
+# on demand and skipped.
+#
+#   CHAT_BACKUP_DIR              where backups go, default ./backups
+#   CHAT_BACKUP_INTERVAL_HOURS   run one automatically every N hours (0: only POST /api/backup)
+#   CHAT_BACKUP_KEEP             database snapshots to keep, default 7
+#   CHAT_BACKUP_TOKEN            lets POST /api/backup in from other machines
+#                                (Authorization: Bearer <token>); loopback needs none
+
+BACKUP_DIR = os.environ.get("CHAT_BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.environ.get("CHAT_BACKUP_INTERVAL_HOURS", "0")) * 3600
+BACKUP_KEEP = max(1, int(os.environ.get("CHAT_BACKUP_KEEP", "7")))
+BACKUP_PAGES = 256          # 1MB with the default 4KB page size
+BACKUP_STEP_PAUSE = 0.005   # seconds between steps, lets writers in
+BACKUP_ATTEMPTS = 3         # stepped copies restarted by writers before copying in one step
+BACKUP_TOKEN = os.environ.get("CHAT_BACKUP_TOKEN", "")
+EXPORT_BATCH = 1000         # messages read per query while an export streams
+
+BACKUP_SECONDS = metrics.histogram("chatter_backup_seconds", "Duration of database + media backups",
+                                   buckets=(1, 5, 15, 60, 300, 900, 3600))
+BACKUP_LAST_SUCCESS = metrics.gauge("chatter_backup_last_success_timestamp", "Unix time of the last successful backup")
+backup_lock = asyncio.Lock()
+# Manual backups only; each one prunes, so this also guards the snapshot history
+manual_backup_limiter = RateLimiter(max_requests=2, window_seconds=3600)
+
+
+class BackupRestarted(Exception):
+    """A write from another connection sent the stepped copy back to page one."""
+
+
+def backup_progress(status: int, remaining: int, total: int, state: dict):
+    # `sleep=` of Connection.backup only applies after SQLITE_BUSY/LOCKED, so pause here
+    if "remaining" in state and remaining >= state["remaining"]:
+        raise BackupRestarted()  # no progress since the last step: it started over
+    state["remaining"] = remaining
+    if remaining:
+        time.sleep(BACKUP_STEP_PAUSE)
+
+
+def backup_database(target: str) -> int:
+    """Snapshot DB_NAME into `target` with the online backup API; returns its size."""
+    partial = target + ".partial"
+    source = sqlite3.connect(DB_NAME, timeout=30)
+    try:
+        for attempt in range(BACKUP_ATTEMPTS + 1):
+            destination = sqlite3.connect(partial)
+            try:
+                if attempt < BACKUP_ATTEMPTS:
+                    state: dict = {}
+                    source.backup(destination, pages=BACKUP_PAGES,
+                                  progress=lambda *step: backup_progress(*step, state))
+                else:
+                    source.backup(destination)  # one step: can't be restarted
+                break
+            except BackupRestarted:
+                continue
+            finally:
+                destination.close()
+    finally:
+        source.close()
+    os.replace(partial, target)
+    return os.path.getsize(target)
+
+
+def backup_media(media_target: str, manifest_path: str) -> Dict[str, int]:
+    """Copy media files not in the manifest (or changed since); returns counts."""
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    copied = copied_bytes = 0
+    for key in list_files_recursive(MEDIA_DIR):
+        source = media_disk_path(key)
+        try:
+            st = os.stat(source)
+        except FileNotFoundError:
+            continue  # deleted while we were walking
+        stamp = [st.st_size, st.st_mtime_ns]
+        if manifest.get(key) == stamp:
+            continue
+        destination = os.path.join(media_target, key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.copy2(source, destination)
+        manifest[key] = stamp
+        copied += 1
+        copied_bytes += st.st_size
+    partial = manifest_path + ".partial"
+    with open(partial, "w") as f:
+        json.dump(manifest, f)
+    os.replace(partial, manifest_path)
+    return {"media_copied": copied, "media_copied_bytes": copied_bytes, "media_total": len(manifest)}
+
+
+def prune_database_backups(folder: str, keep: int):
+    snapshots = sorted(name for name in os.listdir(folder) if name.startswith("chatter-") and name.endswith(".db"))
+    for name in snapshots[:-keep]:
+        os.remove(os.path.join(folder, name))
+
+
+async def run_backup() -> dict:
+    """One database snapshot plus an incremental media copy, off the event loop."""
+    async with backup_lock:
+        loop = asyncio.get_event_loop()
+        started = time.perf_counter()
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        name = f"chatter-{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}.db"
+        db_bytes = await loop.run_in_executor(None, backup_database, os.path.join(BACKUP_DIR, name))
+        media = await loop.run_in_executor(None, backup_media, os.path.join(BACKUP_DIR, "media"),
+                                           os.path.join(BACKUP_DIR, "media-manifest.json"))
+        await loop.run_in_executor(None, prune_database_backups, BACKUP_DIR, BACKUP_KEEP)
+        elapsed = time.perf_counter() - started
+        BACKUP_SECONDS.observe(elapsed)
+        BACKUP_LAST_SUCCESS.set(time.time())
+        log.backup_finished(name, db_bytes, media["media_copied"], elapsed)
+        return {"status": "success", "database": name, "database_bytes": db_bytes,
+                "seconds": round(elapsed, 2), **media}
+
+
+async def backup_loop():
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        try:
+            await run_backup()
+        except Exception as e:
+            log.error("Scheduled backup failed", str(e))
+
+
+def backup_allowed(request: Request) -> bool:
+    """Loopback callers, or anyone presenting CHAT_BACKUP_TOKEN as a bearer token."""
+    if BACKUP_TOKEN:
+        scheme, _, credentials = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and secrets.compare_digest(credentials.encode(), BACKUP_TOKEN.encode()):
+            return True
+    try:
+        return request.client is not None and ipaddress.ip_address(request.client.host).is_loopback
+    except ValueError:
+        return False
+
+
+@app.post("/api/backup")
+async def create_backup(request: Request):
+    """Back up the database and any new media into CHAT_BACKUP_DIR"""
+    if not backup_allowed(request):
+        raise HTTPException(status_code=403, detail="Backups can be started from this machine or with CHAT_BACKUP_TOKEN")
+    if backup_lock.locked():
+        raise HTTPException(status_code=409, detail="A backup is already running")
+    if not manual_backup_limiter.is_allowed("manual"):
+        raise HTTPException(status_code=429, detail="Too many manual backups, try again later",
+                            headers={"Retry-After": "1800"})
+    return await run_backup()
+
+
+@app.get("/api/export")
+async def export_messages(user: str, token: str, start: str, end: str, channel: Optional[str] = None):
+    """Stream a ZIP of the user's messages between two dates (inclusive) and their media.
+
+    Authenticated with the resume token from login_success, and limited to
+    channels the user belongs to (or one of them with `channel`).
+    """
+    if not verify_session_token(token, user):
+        raise HTTPException(status_code=403, detail="Invalid or expired token")
+    since = parse_export_date(start, "start")
+    until = parse_export_date(end, "end")
+    if len(end) <= 10:  # a bare date means the whole day
+        until += timedelta(days=1)
+    channels = [c["id"] for c in user_channels(user) if c["joined"]]
+    if channel is not None:
+        if channel not in channels:
+            raise HTTPException(status_code=403, detail="Not a member of that channel")
+        channels = [channel]
+    media_keys: Dict[str, None] = {}  # filled while messages.json is written
+
+    def messages_json() -> Iterator[str]:
+        # Same objects as the history frames, one per line
+        separator = "[\n"
+        for batch in export_batches(channels, since, until):
+            for record in batch:
+                if record[3] in MEDIA_SUBDIRS:
+                    media_keys[normalize_media_key(record[2], record[3])] = None
+            yield separator + ",\n".join(JsonCodec.encode_record(record) for record in batch)
+            separator = ",\n"
+        yield ("[\n" if separator == "[\n" else "") + "\n]\n"
+
+    def media_files() -> Iterator[tuple]:
+        for key in media_keys:
+            yield "media/" + key, media_disk_path(key)
+
+    return archive_response("export", media_files(), f"chatter-export-{since:%Y%m%d}-{until:%Y%m%d}.zip",
+                            texts={"messages.json": messages_json()})
+
+
+def export_batches(channels: List[str], since: datetime, until: datetime) -> Iterator[list]:
+    """MessageRecord tuples of `channels` in [since, until), EXPORT_BATCH at a time, oldest first.
+
+    Every batch is its own short query (keyset on timestamp, id), so no read
+    transaction stays open while the ZIP streams, and each can run on whichever
+    threadpool thread iter_zip happens to be on.
+    """
+    after = ("", "")
+    while True:
+        with get_db() as conn:
+            c = conn.cursor()
+            c.row_factory = None  # plain tuples in MessageRecord order
+            c.execute(f"""{MESSAGE_RECORD_SELECT}
+                          WHERE m.channel_id IN ({','.join('?' * len(channels))})
+                          AND m.timestamp >= ? AND m.timestamp < ? AND (m.timestamp, m.id) > (?, ?)
+                          ORDER BY m.timestamp, m.id LIMIT {EXPORT_BATCH}""",
+                      (*channels, since.isoformat(), until.isoformat(), *after))
+            batch = c.fetchall()
+        if not batch:
+            return
+        yield batch
+        after = (batch[-1][4], batch[-1][0])
+
+# --- PROMETHEUS METRICS ---
+@app.get("/metrics")
+async def get_metrics():
+    """Counters and histograms in Prometheus text exposition format"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# --- SAMPLING PROFILER (opt-in) ---
+@app.get("/debug/profile")
+async def get_profile(seconds: float = 10, interval_ms: float = 5):
+    """Sample the event-loop thread for N seconds and return folded stacks.
+
+    The output ("frame;frame;frame count" per line) loads directly into
+    speedscope or flamegraph.pl. Disabled unless CHAT_ENABLE_PROFILER=1.
+    """
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Profiler disabled (set CHAT_ENABLE_PROFILER=1)")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    seconds = min(max(seconds, 1), 60)
+    interval = min(max(interval_ms, 1), 100) / 1000
+    async with profile_lock:
+        loop = asyncio.get_event_loop()
+        counts = await loop.run_in_executor(None, sample_stacks, threading.get_ident(), seconds, interval)
+    body = "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+    return Response(content=body, media_type="text/plain; charset=utf-8",
+                    headers={"Content-Disposition": 'attachment; filename="chatter-profile.folded"'})
+
+def delete_media_files(filename: str, msg_type: str = "file"):
+    """Safely delete media and thumbnail files"""
+    media_key = normalize_media_key(filename, msg_type)
+    media_path = media_disk_path(media_key)
+    thumb_path = thumb_disk_path(media_key)
+    
+    try:
+        if os.path.exists(media_path):
+            os.remove(media_path)
+            log.file_deleted(filename)
+    except Exception as e:
+        log.error(f"Could not delete media {filename}", str(e))
+    
+    try:
+        if os.path.exists(thumb_path):
+            os.remove(thumb_path)
+    except Exception as e:
+        log.error(f"Could not delete thumbnail {filename}", str(e))
+
+    try:
+        display_path = display_disk_path(media_key)
+        if os.path.exists(display_path):
+            os.remove(display_path)
+    except Exception as e:
+        log.error(f"Could not delete display copy {filename}", str(e))
+
+    try:
+        opus_path = opus_disk_path(media_key)
+        if os.path.exists(opus_path):
+            os.remove(opus_path)
+    except Exception as e:
+        log.error(f"Could not delete Opus copy {filename}", str(e))
+
+    # Backward compatibility for old flat folders
+    try:
+        legacy_media = os.path.join("uploaded_media", os.path.basename(filename))
+        if os.path.exists(legacy_media):
+            os.remove(legacy_media)
+    except Exception:
+        pass
+
+    try:
+        legacy_thumb = os.path.join("uploaded_thumbnails", os.path.basename(filename))
+        if os.path.exists(legacy_thumb):
+            os.remove(legacy_thumb)
+    except Exception:
+        pass
+
+# --- WEBSOCKET ACTION HANDLERS ---
+# Every /ws action is a small async function registered in WS_ACTIONS, so the
+# receive loop is a single dict lookup and each handler can be called (and
+# benchmarked) on its own with a fake socket.
+
+class WsContext:
+    """Per-connection state handed to every action handler."""
+    __slots__ = ("websocket", "username")
+
+    def __init__(self, websocket: WebSocket, username: str):
+        self.websocket = websocket
+        self.username = username
+
+
+class WsAction:
+    __slots__ = ("name", "handler", "fields", "limiter")
+
+    def __init__(self, name, handler, fields, limiter):
+        self.name = name
+        self.handler = handler
+        self.fields = fields  # [(field, accepted types, required, list item types or None), ...]
+        self.limiter = limiter
+
+
+WS_ACTIONS: Dict[str, WsAction] = {}
+
+
+def compile_schema(required: Optional[dict], optional: Optional[dict]) -> list:
+    fields = []
+    for spec, is_required in ((required or {}, True), (optional or {}, False)):
+        for name, types in spec.items():
+            items = None
+            if isinstance(types, list):  # [str]: a list whose items are all str
+                types, items = list, tuple(types)
+            types = types if isinstance(types, tuple) else (types,)
+            if not is_required:
+                types += (type(None),)
+            fields.append((name, types, is_required, items))
+    return fields
+
+
+def ws_action(*names, required=None, optional=None, limit=None):
+    """Register a handler(ctx, data) for one or more /ws action types.
+
+    `required`/`optional` map field names to accepted types (`[str]` for a
+    list of strings) and are checked once before the handler runs; `limit`
+    picks a WS_RATE_LIMITS group.
+    """
+    def decorator(handler):
+        fields = compile_schema(required, optional)
+        limiter = WS_RATE_LIMITS[limit] if limit else None
+        for name in names:
+            WS_ACTIONS[name] = WsAction(name, handler, fields, limiter)
+        return handler
+    return decorator
+
+
+def type_matches(value, types: tuple) -> bool:
+    # bool is an int subclass; don't let True pass as a size or an id
+    return isinstance(value, types) and (bool in types or not isinstance(value, bool))
+
+
+def validate_payload(action: WsAction, data: dict) -> Optional[str]:
+    """Return a human readable problem with `data`, or None when it is valid."""
+    for name, types, is_required, items in action.fields:
+        if name not in data:
+            if is_required:
+                return f"'{action.name}' needs '{name}'"
+            continue
+        value = data[name]
+        if not type_matches(value, types):
+            return f"'{action.name}' got a bad '{name}'"
+        if items is not None and value is not None and not all(type_matches(item, items) for item in value):
+            return f"'{action.name}' got a bad item in '{name}'"
+    return None
+
+
+async def dispatch_ws_action(ctx: WsContext, data: dict):
+    """Validate, rate limit, time and run one incoming /ws frame."""
+    action_type = data.get("type", "") if isinstance(data, dict) else ""
+    action = WS_ACTIONS.get(action_type)
+    if action is None:
+        WS_MESSAGES.inc(labels=("other",))
+        return
+    WS_MESSAGES.inc(labels=(action.name,))
+
+    if action.limiter is not None and not action.limiter.is_allowed(ctx.username):
+        await manager.send(ctx.websocket, {"type": "rate_limited", "action": action.name})
+        return
+
+    problem = validate_payload(action, data)
+    if problem:
+        await manager.send(ctx.websocket, {"type": "error", "msg": f"Invalid request: {problem}"})
+        return
+
+    started = time.perf_counter()
+    watch_token = slow_actions.begin(action.name, ctx.username)
+    try:
+        await action.handler(ctx, data)
+    finally:
+        slow_actions.end(watch_token)
+        WS_ACTION_SECONDS.observe(time.perf_counter() - started, (action.name,))
+
+
+# --- TYPING INDICATOR ---
+@ws_action("typing_start", "typing_stop", optional={"channel": str}, limit="typing")
+async def handle_typing(ctx: WsContext, data: dict):
+    channel = data.get("channel") or DEFAULT_CHANNEL
+    if not manager.is_subscribed(ctx.websocket, channel):
+        return
+    typing = manager.typing_in(channel)
+    if data["type"] == "typing_start":
+        typing.add(ctx.username)
+    else:
+        typing.discard(ctx.username)
+    await manager.broadcast_to_channel(channel, {
+        "type": "typing_update",
+        "channel": channel,
+        "typing_users": list(typing)
+    }, exclude=ctx.websocket)
+
+
+# --- MARK MESSAGE AS READ ---
+@ws_action("mark_read", required={"ids": [str]}, limit="receipt")
+async def handle_mark_read(ctx: WsContext, data: dict):
+    username = ctx.username
+    updates = []
+    with get_db() as conn:
+        c = conn.cursor()
+        for msg_id in data["ids"]:
+            result = message_cache.get(msg_id, conn)
+            if (result and result['username'] != username and username not in result['read_by']
+                    and manager.is_subscribed(ctx.websocket, result['channel_id'])):
+                read_by = result['read_by'] + [username]
+                c.execute("UPDATE messages SET read_by=? WHERE id=?", (json.dumps(read_by), msg_id))
+                updates.append((msg_id, read_by, result['channel_id']))
+        conn.commit()
+    for msg_id, read_by, _ in updates:
+        message_cache.update(msg_id, read_by=read_by)
+
+    # Broadcast only after the commit: awaiting with the write transaction
+    # open left every other connect() blocking the event loop on the lock
+    for msg_id, read_by, channel in updates:
+        await manager.broadcast_to_channel(channel, {
+            "type": "read_update",
+            "id": msg_id,
+            "read_by": read_by
+        })
+
+
+# --- EDIT MESSAGE ---
+@ws_action("edit", required={"id": str, "content": str}, limit="edit")
+async def handle_edit(ctx: WsContext, data: dict):
+    msg_id = data["id"]
+    new_text = data["content"]
+    with get_db() as conn:
+        c = conn.cursor()
+        result = message_cache.get(msg_id, conn)
+        if result and result['username'] == ctx.username:
+            msg_time = datetime.fromisoformat(result['timestamp'])
+            if datetime.now() - msg_time < timedelta(minutes=10):
+                c.execute("UPDATE messages SET message=? WHERE id=?", (new_text, msg_id))
+                conn.commit()
+                message_cache.update(msg_id, message=new_text)
+                log.message_edited(ctx.username)
+                await manager.broadcast_to_channel(result['channel_id'],
+                                                   {"type": "edit_confirmed", "id": msg_id, "new_msg": new_text})
+            else:
+                await manager.send(ctx.websocket, {"type": "error", "msg": "Cannot edit messages older than 10 minutes"})
+
+
+# --- DELETE MESSAGES WITH PROPER FILE CLEANUP ---
+@ws_action("delete", required={"ids": [str]}, limit="edit")
+async def handle_delete(ctx: WsContext, data: dict):
+    deleted_ids = []
+    by_channel: Dict[str, List[str]] = {}
+
+    with get_db() as conn:
+        c = conn.cursor()
+        for msg_id in data["ids"]:
+            result = message_cache.get(msg_id, conn)
+            if result and result['username'] == ctx.username:
+                filename = result['message']
+                msg_type = result['type']
+
+                # Delete associated files for media messages
+                if msg_type in MEDIA_SUBDIRS:
+                    delete_media_files(filename, msg_type)
+                if msg_type == "voice":
+                    c.execute("DELETE FROM voice_notes WHERE media_key=?", (normalize_media_key(filename, msg_type),))
+
+                c.execute("DELETE FROM messages WHERE id=?", (msg_id,))
+                deleted_ids.append(msg_id)
+                by_channel.setdefault(result['channel_id'], []).append(msg_id)
+        conn.commit()
+    for msg_id in deleted_ids:
+        message_cache.discard(msg_id)
+
+    if deleted_ids:
+        log.message_deleted(ctx.username, len(deleted_ids))
+        for channel, ids in by_channel.items():
+            await manager.broadcast_to_channel(channel, {"type": "delete_confirmed", "ids": ids})
+
+
+# --- CALL & WEBRTC SIGNALING ---
+# These only forward a frame to the other party: action -> (frame type sent
+# to the target, {field copied from the request: default}, optional logger).
+SIGNAL_RELAYS = {
+    "call_initiate": ("call_incoming", {"callType": "voice"},
+                      lambda user, data: log.call_started(user, data["to"], data.get("callType", "voice"))),
+    "call_accept": ("call_accepted", {}, lambda user, data: log.call_accepted(user)),
+    "call_reject": ("call_rejected", {"reason": "declined"}, lambda user, data: log.call_rejected(user)),
+    "call_cancel": ("call_cancelled", {}, None),
+    "call_end": ("call_ended", {}, lambda user, data: log.call_ended(user)),
+    "webrtc_offer": ("webrtc_offer", {"offer": None},
+                     lambda user, data: log.webrtc_signal("offer", user, data["to"])),
+    "webrtc_answer": ("webrtc_answer", {"answer": None},
+                      lambda user, data: log.webrtc_signal("answer", user, data["to"])),
+    "ice_candidate": ("ice_candidate", {"candidate": None}, None),
+    # Direct (browser-to-browser) file transfer over a WebRTC data channel:
+    # file bytes never touch the server, only this handshake does
+    "p2p_file_offer": ("p2p_file_offer",
+                       {"transfer": None, "name": "", "size": 0, "mime": "", "modified": 0},
+                       lambda user, data: log.direct_file_offered(
+                           user, data["to"], data["size"] if isinstance(data.get("size"), int) else 0)),
+    "p2p_file_accept": ("p2p_file_accept", {"transfer": None, "offset": 0}, None),
+    "p2p_file_cancel": ("p2p_file_cancel", {"transfer": None, "reason": "cancelled"}, None),
+    "p2p_signal": ("p2p_signal", {"transfer": None, "description": None, "candidate": None}, None),
+}
+
+
+def register_relay(action: str, forward_type: str, copy_fields: dict, log_event=None):
+    @ws_action(action, required={"to": str}, limit="signaling")
+    async def relay(ctx: WsContext, data: dict):
+        if log_event:
+            log_event(ctx.username, data)
+        payload = {"type": forward_type, "from": ctx.username}
+        for field, default in copy_fields.items():
+            payload[field] = data.get(field, default)
+        await manager.send_to_user(data["to"], payload)
+    relay.__name__ = f"relay_{action}"
+    return relay
+
+
+for _action, (_forward_type, _fields, _log_event) in SIGNAL_RELAYS.items():
+    register_relay(_action, _forward_type, _fields, _log_event)
+del _action, _forward_type, _fields, _log_event
+
+
+# --- GROUP CALLS (SFU) ---
+# Optional. With CHAT_SFU=host:port pointing at a running `python sfu.py`,
+# group calls upload each camera/mic once to the SFU instead of to every
+# other participant. Signaling stays on /ws; this bridge forwards it over the
+# SFU's local JSON-lines control socket (protocol documented in sfu.py).
+# The server names each room (an unguessable token) when its first member
+# joins and only lets invited users in; the room is forgotten once empty.
+SFU_ADDRESS = os.environ.get("CHAT_SFU", "")
+SFU_LINE_LIMIT = 1024 * 1024  # a 10-person offer is tens of KB
+MAX_GROUP_INVITES = 16
+SFU_ROOM_MAX = 64
+
+
+class SfuBridge:
+    """Control link to sfu.py; one SFU peer per (socket, room)."""
+
+    def __init__(self, address: str):
+        self.address = address
+        self.peers: Dict[str, WebSocket] = {}
+        self.memberships: Dict[WebSocket, Dict[str, str]] = {}  # socket -> {room: peer id}
+        self.rooms: Dict[str, Set[str]] = {}  # room -> users allowed to join
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connect_lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.address)
+
+    async def _send(self, message: dict):
+        async with self._connect_lock:
+            if self._writer is None or self._writer.is_closing():
+                host, _, port = self.address.rpartition(":")
+                reader, self._writer = await asyncio.open_connection(host or "127.0.0.1", int(port),
+                                                                     limit=SFU_LINE_LIMIT)
+                asyncio.create_task(self._read_loop(reader))
+            self._writer.write(json.dumps(message).encode() + b"\n")
+            await self._writer.drain()
+
+    async def _read_loop(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                websocket = self.peers.get(message.get("peer"))
+                if websocket is None:
+                    continue
+                if message["op"] == "offer":
+                    await manager.send(websocket, {
+                        "type": "sfu_offer", "room": message["room"],
+                        "sdp": message["sdp"], "streams": message.get("streams", {}),
+                    })
+                elif message["op"] == "closed":
+                    self._forget(websocket, message["room"])
+                    await manager.send(websocket, {"type": "sfu_closed", "room": message["room"]})
+        except (ConnectionError, ValueError) as e:
+            log.error("SFU control link failed", str(e))
+        finally:
+            # The SFU drops every room when the link goes away; tell the browsers
+            log.warning("SFU control link closed")
+            for websocket, rooms in list(self.memberships.items()):
+                for room in rooms:
+                    await manager.send(websocket, {"type": "sfu_closed", "room": room})
+            self.peers.clear()
+            self.memberships.clear()
+            self.rooms.clear()
+
+    def _forget(self, websocket: WebSocket, room: str) -> Optional[str]:
+        rooms = self.memberships.get(websocket, {})
+        peer = rooms.pop(room, None)
+        if not rooms:
+            self.memberships.pop(websocket, None)
+        self.peers.pop(peer, None)
+        if peer is not None and not any(room in rooms for rooms in self.memberships.values()):
+            self.rooms.pop(room, None)
+        return peer
+
+    def create_room(self, owner: str) -> str:
+        room = secrets.token_urlsafe(16)
+        self.rooms[room] = {owner}
+        return room
+
+    def invite(self, room: str, usernames: List[str]):
+        self.rooms[room].update(usernames)
+
+    def may_join(self, room: str, username: str) -> bool:
+        return username in self.rooms.get(room, ())
+
+    async def join(self, websocket: WebSocket, username: str, room: str):
+        old_peer = self._forget(websocket, room)
+        if old_peer:
+            await self._send({"op": "leave", "room": room, "peer": old_peer})
+        peer = uuid.uuid4().hex
+        self.peers[peer] = websocket
+        self.memberships.setdefault(websocket, {})[room] = peer
+        await self._send({"op": "join", "room": room, "peer": peer, "user": username})
+
+    async def answer(self, websocket: WebSocket, room: str, sdp: str) -> bool:
+        peer = self.memberships.get(websocket, {}).get(room)
+        if peer is None:
+            return False
+        await self._send({"op": "answer", "room": room, "peer": peer, "sdp": sdp})
+        return True
+
+    async def leave(self, websocket: WebSocket, room: str) -> bool:
+        peer = self._forget(websocket, room)
+        if peer is None:
+            return False
+        await self._send({"op": "leave", "room": room, "peer": peer})
+        return True
+
+    async def leave_all(self, websocket: WebSocket):
+        """Called when a socket closes: free its SFU peers."""
+        for room in list(self.memberships.get(websocket, {})):
+            try:
+                await self.leave(websocket, room)
+            except OSError:
+                pass
+
+
+sfu = SfuBridge(SFU_ADDRESS)
+
+
+async def sfu_room(ctx: WsContext, data: dict) -> Optional[str]:
+    """The frame's room id, or None (after an error frame) unless it has 1-SFU_ROOM_MAX characters."""
+    room = data["room"]
+    if not room or len(room) > SFU_ROOM_MAX:
+        await manager.send(ctx.websocket, {"type": "error", "msg": f"Room ids need 1-{SFU_ROOM_MAX} characters"})
+        return None
+    return room
+
+
+@ws_action("sfu_join", optional={"room": str, "invite": [str], "callType": str}, limit="signaling")
+async def handle_sfu_join(ctx: WsContext, data: dict):
+    """Join a group call, or start one when no `room` is given; `invite` adds users to it."""
+    if not sfu.enabled:
+        await manager.send(ctx.websocket, {"type": "error", "msg": "Group calls are not enabled on this server"})
+        return
+    invitees = [user for user in (data.get("invite") or [])[:MAX_GROUP_INVITES] if user != ctx.username]
+    if data.get("room") is None:
+        room = sfu.create_room(ctx.username)
+    else:
+        room = await sfu_room(ctx, data)
+        if room is None:
+            return
+        if not sfu.may_join(room, ctx.username):
+            await manager.send(ctx.websocket, {"type": "error", "msg": "That group call has ended or you weren't invited"})
+            return
+    sfu.invite(room, invitees)
+    await manager.send(ctx.websocket, {"type": "sfu_joined", "room": room})
+    try:
+        await sfu.join(ctx.websocket, ctx.username, room)
+    except OSError as e:
+        log.error("SFU unreachable", str(e))
+        await manager.send(ctx.websocket, {"type": "error", "msg": "Group call server is not running"})
+        return
+    log.group_call_joined(ctx.username, room)
+    invite = {"type": "sfu_invite", "room": room, "from": ctx.username,
+              "callType": data.get("callType", "video")}
+    for username in invitees:
+        await manager.send_to_user(username, invite)
+
+
+@ws_action("sfu_answer", required={"room": str, "sdp": str}, limit="signaling")
+async def handle_sfu_answer(ctx: WsContext, data: dict):
+    if not sfu.enabled:
+        return
+    room = await sfu_room(ctx, data)
+    if room is not None:
+        await sfu.answer(ctx.websocket, room, data["sdp"])
+
+
+@ws_action("sfu_leave", required={"room": str}, limit="signaling")
+async def handle_sfu_leave(ctx: WsContext, data: dict):
+    if not sfu.enabled:
+        return
+    room = await sfu_room(ctx, data)
+    if room is not None and await sfu.leave(ctx.websocket, room):
+        log.group_call_left(ctx.username, room)
+
+
+# --- PRESENCE ---
+@ws_action("presence_sync", limit="presence")
+async def handle_presence_sync(ctx: WsContext, data: dict):
+    # Client missed a presence version; send the whole picture once
+    await manager.send(ctx.websocket, manager.presence_snapshot())
+
+
+@ws_action("ping")
+async def handle_ping(ctx: WsContext, data: dict):
+    # Client-side heartbeat (call window); any frame already refreshed last_seen
+    await manager.send(ctx.websocket, {"type": "pong"})
+
+
+@ws_action("pong")
+async def handle_pong(ctx: WsContext, data: dict):
+    # Answer to the server's heartbeat ping; receiving it was the point
+    pass
+
+
+# --- CHANNELS ---
+# Messages live in a channel: "general" (everyone is a member), named public
+# channels anyone can join, or a two-person direct conversation. Each socket
+# is subscribed to its user's channels at login; messages, edits, deletes,
+# reactions, receipts and typing only go to that channel's subscribers, and
+# history replay only covers them. Presence and call signaling stay global.
+
+CHANNEL_NAME_MAX = 40
+
+
+def user_channels(username: str) -> List[dict]:
+    """Every public channel (with `joined`) plus the user's direct conversations."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("INSERT OR IGNORE INTO channel_members VALUES (?, ?)", (DEFAULT_CHANNEL, username))
+        conn.commit()
+        c.execute("""SELECT ch.id, ch.name, ch.kind, m.username IS NOT NULL AS joined
+                     FROM channels ch LEFT JOIN channel_members m ON m.channel_id = ch.id AND m.username = ?
+                     WHERE ch.kind = 'channel' OR m.username IS NOT NULL
+                     ORDER BY ch.created_at""", (username,))
+        channels = [{"id": row["id"], "name": row["name"], "kind": row["kind"], "joined": bool(row["joined"])}
+                    for row in c.fetchall()]
+        dms = [channel for channel in channels if channel["kind"] == "dm"]
+        if dms:
+            c.execute(f"SELECT channel_id, username FROM channel_members WHERE channel_id IN "
+                      f"({','.join('?' * len(dms))})", [channel["id"] for channel in dms])
+            members: Dict[str, List[str]] = {}
+            for row in c.fetchall():
+                members.setdefault(row["channel_id"], []).append(row["username"])
+            for channel in dms:
+                channel["members"] = sorted(members.get(channel["id"], []))
+    return channels
+
+
+def find_or_create_channel(key: str, name: str, kind: str, creator: str, members: List[str]):
+    """Return (channel info, created) for `key`, creating it with `members` if it is new."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, name, kind FROM channels WHERE key=?", (key,))
+        row = c.fetchone()
+        if row is not None:
+            return {"id": row["id"], "name": row["name"], "kind": row["kind"]}, False
+        channel_id = str(uuid.uuid4())
+        c.execute("INSERT INTO channels VALUES (?, ?, ?, ?, ?, ?)",
+                  (channel_id, key, name, kind, creator, datetime.now().isoformat()))
+        c.executemany("INSERT OR IGNORE INTO channel_members VALUES (?, ?)",
+                      [(channel_id, member) for member in members])
+        conn.commit()
+    return {"id": channel_id, "name": name, "kind": kind}, True
+
+
+async def send_history(websocket: WebSocket, channels) -> bool:
+    """Replay the stored messages of `channels` to one socket, oldest first."""
+    channels = list(channels)
+    if not channels:
+        return True
+    with get_db() as conn:
+        c = conn.cursor()
+        c.row_factory = None  # plain tuples in MessageRecord order
+        c.execute(f"""{MESSAGE_RECORD_SELECT}
+                    WHERE m.channel_id IN ({','.join('?' * len(channels))}) ORDER BY m.timestamp""", channels)
+        for record in c.fetchall():
+            if not await manager.send_record(websocket, record):
+                return False
+    return True
+
+
+async def add_to_channel(username: str, channel: dict, focus: bool = False):
+    """Subscribe every open socket of `username` and bring each one up to date."""
+    for ws in manager.sockets_of(username):
+        if manager.is_subscribed(ws, channel["id"]):
+            continue
+        manager.subscribe(ws, [channel["id"]])
+        await manager.send(ws, {"type": "channel_added", "channel": dict(channel, joined=True), "focus": focus})
+        await send_history(ws, [channel["id"]])
+
+
+@ws_action("channel_create", required={"name": str}, limit="channel")
+async def handle_channel_create(ctx: WsContext, data: dict):
+    name = " ".join(data["name"].split()).lstrip("#")
+    if not name or len(name) > CHANNEL_NAME_MAX:
+        await manager.send(ctx.websocket, {"type": "error",
+                                           "msg": f"Channel names need 1-{CHANNEL_NAME_MAX} characters"})
+        return
+    if name.lower().startswith("dm:"):
+        # Channel keys share a namespace with direct conversations ("dm:[...]")
+        await manager.send(ctx.websocket, {"type": "error", "msg": "Channel names can't start with dm:"})
+        return
+    channel, created = find_or_create_channel(name.lower(), name, "channel", ctx.username, [ctx.username])
+    if channel["kind"] != "channel":
+        await manager.send(ctx.websocket, {"type": "error", "msg": "That name is taken"})
+        return
+    if created:
+        log.channel_created(ctx.username, name, "channel")
+        await manager.broadcast_to_all({"type": "channel_created", "channel": dict(channel, joined=False)})
+    else:
+        with get_db() as conn:
+            conn.cursor().execute("INSERT OR IGNORE INTO channel_members VALUES (?, ?)", (channel["id"], ctx.username))
+            conn.commit()
+    await add_to_channel(ctx.username, channel, focus=True)
+
+
+@ws_action("channel_join", required={"channel": str}, limit="channel")
+async def handle_channel_join(ctx: WsContext, data: dict):
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, name, kind FROM channels WHERE id=? AND kind='channel'", (data["channel"],))
+        row = c.fetchone()
+        if row is None:
+            await manager.send(ctx.websocket, {"type": "error", "msg": "No such channel"})
+            return
+        c.execute("INSERT OR IGNORE INTO channel_members VALUES (?, ?)", (row["id"], ctx.username))
+        conn.commit()
+    await add_to_channel(ctx.username, {"id": row["id"], "name": row["name"], "kind": row["kind"]}, focus=True)
 
-# --- MEDIA GALLERY API ---
-@app.get("/api/media")
-async def get_media_gallery(
-    media_type: Optional[str] = None,
-    sort: str = "newest"
-):
-    """Get all media files for gallery view, sorted by date"""
+
+@ws_action("channel_leave", required={"channel": str}, limit="channel")
+async def handle_channel_leave(ctx: WsContext, data: dict):
+    channel = data["channel"]
+    if channel == DEFAULT_CHANNEL:
+        return
     with get_db() as conn:
         c = conn.cursor()
-        
-        query = """SELECT id, username, message, type, timestamp, file_size, original_name 
-                   FROM messages WHERE type IN ('image', 'video', 'file')"""
-        params = []
-        
-        if media_type and media_type != 'all':
-            query += " AND type = ?"
-            params.append(media_type)
-        
-        order = "DESC" if sort == "newest" else "ASC"
-        query += f" ORDER BY timestamp {order}"
-        
-        c.execute(query, params)
-        rows = c.fetchall()
-        
-        media_items = []
-        for row in rows:
-            media_key = normalize_media_key(row['message'], row['type'])
-            if not media_exists(media_key):
-                continue
+        # Direct conversations can't be left, only public channels
+        c.execute("""DELETE FROM channel_members WHERE channel_id=? AND username=?
+                     AND channel_id IN (SELECT id FROM channels WHERE kind='channel')""", (channel, ctx.username))
+        conn.commit()
+        left = c.rowcount > 0
+    if left:
+        for ws in manager.sockets_of(ctx.username):
+            manager.unsubscribe(ws, channel)
+            await manager.send(ws, {"type": "channel_removed", "channel": channel})
 
-            has_thumb = thumb_exists(media_key)
-            media_items.append({
-                "id": row['id'],
-                "user": row['username'],
-                "filename": media_key,
-                "type": row['type'],
-                "timestamp": row['timestamp'],
-                "size": row['file_size'] or 0,
-                "original_name": row['original_name'] or os.path.basename(media_key),
-                "has_thumb": has_thumb,
-                "media_url": f"/media/{media_key}",
-                "thumb_url": f"/thumbs/{media_key}" if has_thumb else None
+
+@ws_action("dm_open", required={"user": str}, limit="channel")
+async def handle_dm_open(ctx: WsContext, data: dict):
+    other = data["user"]
+    if other == ctx.username:
+        return
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM users WHERE username=?", (other,))
+        exists = c.fetchone() is not None
+    if not exists:
+        await manager.send(ctx.websocket, {"type": "error", "msg": f"No user named {other}"})
+        return
+    members = sorted([ctx.username, other])
+    channel, created = find_or_create_channel("dm:" + json.dumps(members), "", "dm", ctx.username, members)
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("SELECT username FROM channel_members WHERE channel_id=?", (channel["id"],))
+        current = {row["username"] for row in c.fetchall()}
+        # Only ever hand out a real two-person conversation, never whatever else owns the key
+        if channel["kind"] != "dm" or not current <= set(members):
+            await manager.send(ctx.websocket, {"type": "error", "msg": "Can't open that conversation"})
+            return
+        c.executemany("INSERT OR IGNORE INTO channel_members VALUES (?, ?)",
+                      [(channel["id"], member) for member in members])
+        conn.commit()
+    if created:
+        log.channel_created(ctx.username, other, "dm")
+    channel["members"] = members
+    await add_to_channel(ctx.username, channel, focus=True)
+    await add_to_channel(other, channel)
+
+
+# --- REACTION HANDLING ---
+@ws_action("reaction_add", required={"id": str, "emoji": str}, limit="reaction")
+async def handle_reaction_add(ctx: WsContext, data: dict):
+    msg_id = data["id"]
+    emoji = data["emoji"]
+
+    with get_db() as conn:
+        c = conn.cursor()
+        result = message_cache.get(msg_id, conn)
+        if result and manager.is_subscribed(ctx.websocket, result['channel_id']):
+            reactions = {key: list(users) for key, users in result['reactions'].items()}
+            if emoji not in reactions:
+                reactions[emoji] = []
+            if ctx.username not in reactions[emoji]:
+                reactions[emoji].append(ctx.username)
+            c.execute("UPDATE messages SET reactions=? WHERE id=?", (json.dumps(reactions), msg_id))
+            conn.commit()
+            message_cache.update(msg_id, reactions=reactions)
+            await manager.broadcast_to_channel(result['channel_id'], {
+                "type": "reaction_update",
+                "id": msg_id,
+                "reactions": reactions
             })
-        
-        return {"media": media_items, "total": len(media_items)}
 
-# --- CLEANUP ORPHAN FILES ---
-@app.post("/api/cleanup-orphans")
-async def cleanup_orphan_files():
-    """Remove files that exist on disk but not in database"""
+
+@ws_action("reaction_remove", required={"id": str, "emoji": str}, limit="reaction")
+async def handle_reaction_remove(ctx: WsContext, data: dict):
+    msg_id = data["id"]
+    emoji = data["emoji"]
+
     with get_db() as conn:
         c = conn.cursor()
-        c.execute("SELECT message, type FROM messages WHERE type IN ('image', 'video', 'file', 'voice')")
-        db_files = set(normalize_media_key(row[0], row[1]) for row in c.fetchall())
-    
-    cleaned_media = 0
-    cleaned_thumbs = 0
-    
-    # Clean orphan media files
-    for filename in list_files_recursive(MEDIA_DIR):
-        if filename not in db_files:
-            try:
-                os.remove(media_disk_path(filename))
-                cleaned_media += 1
-            except Exception as e:
-                print(f"Error removing media {filename}: {e}")
-    
-    # Clean orphan thumbnails
-    for filename in list_files_recursive(THUMB_DIR):
-        if filename not in db_files:
-            try:
-                os.remove(thumb_disk_path(filename))
-                cleaned_thumbs += 1
-            except Exception as e:
-                print(f"Error removing thumbnail {filename}: {e}")
-    
-    return {
-        "status": "success",
-        "cleaned_media": cleaned_media,
-        "cleaned_thumbs": cleaned_thumbs
-    }
+        result = message_cache.get(msg_id, conn)
+        if result and manager.is_subscribed(ctx.websocket, result['channel_id']):
+            reactions = {key: list(users) for key, users in result['reactions'].items()}
+            if emoji in reactions and ctx.username in reactions[emoji]:
+                reactions[emoji].remove(ctx.username)
+                if len(reactions[emoji]) == 0:
+                    del reactions[emoji]
+            c.execute("UPDATE messages SET reactions=? WHERE id=?", (json.dumps(reactions), msg_id))
+            conn.commit()
+            message_cache.update(msg_id, reactions=reactions)
+            await manager.broadcast_to_channel(result['channel_id'], {
+                "type": "reaction_update",
+                "id": msg_id,
+                "reactions": reactions
+            })
+
+
+# --- HANDLE FILE/IMAGE/VIDEO/TEXT/VOICE MESSAGES ---
+@ws_action("text", "image", "video", "file", "voice",
+           required={"content": str},
+           optional={"reply_to": str, "file_size": int, "original_name": str, "channel": str},
+           limit="message")
+async def handle_chat_message(ctx: WsContext, data: dict):
+    username = ctx.username
+    action_type = data["type"]
+    msg_content = data["content"]
+    channel = data.get("channel") or DEFAULT_CHANNEL
+    if not manager.is_subscribed(ctx.websocket, channel):
+        await manager.send(ctx.websocket, {"type": "error", "msg": "You are not a member of that channel"})
+        return
+    reply_to = data.get("reply_to", None)
+    file_size = data.get("file_size") or 0
+    original_name = data.get("original_name") or ""
+    if action_type in ["image", "video", "file", "voice"]:
+        msg_content = normalize_media_key(msg_content, action_type)
+    msg_id = str(uuid.uuid4())
+    timestamp = datetime.now().isoformat()
+
+    # Stop typing when sending message
+    manager.typing_in(channel).discard(username)
 
-# --- GET STORAGE STATS ---
-@app.get("/api/storage-stats")
-async def get_storage_stats():
-    """Get storage usage statistics"""
-    def get_folder_size(folder):
-        total = 0
-        for filename in list_files_recursive(folder):
-            filepath = os.path.join(folder, filename)
-            if os.path.isfile(filepath):
-                total += os.path.getsize(filepath)
-        return total
-    
-    media_size = get_folder_size(MEDIA_DIR)
-    thumb_size = get_folder_size(THUMB_DIR)
-    media_count = len(list_files_recursive(MEDIA_DIR))
-    thumb_count = len(list_files_recursive(THUMB_DIR))
-    
     with get_db() as conn:
         c = conn.cursor()
-        c.execute("SELECT COUNT(*) FROM messages WHERE type IN ('image', 'video', 'file', 'voice')")
-        db_count = c.fetchone()[0]
-    
-    return {
-        "media_size_bytes": media_size,
-        "thumb_size_bytes": thumb_size,
-        "media_count": media_count,
-        "thumb_count": thumb_count,
-        "db_media_count": db_count,
-        "orphan_files": media_count - db_count if media_count > db_count else 0
-    }
+        c.execute("""INSERT INTO messages 
+                    (id, username, message, type, timestamp, reply_to, read_by, file_size, original_name, reactions,
+                     channel_id) 
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
+                  (msg_id, username, msg_content, action_type, timestamp, reply_to, '[]', file_size, original_name, '{}',
+                   channel))
+        conn.commit()
+    message_cache.put(msg_id, {"username": username, "message": msg_content, "type": action_type,
+                               "timestamp": timestamp, "read_by": [], "reactions": {}, "channel_id": channel})
 
-def delete_media_files(filename: str, msg_type: str = "file"):
-    """Safely delete media and thumbnail files"""
-    media_key = normalize_media_key(filename, msg_type)
-    media_path = media_disk_path(media_key)
-    thumb_path = thumb_disk_path(media_key)
-    
-    try:
-        if os.path.exists(media_path):
-            os.remove(media_path)
-            log.file_deleted(filename)
-    except Exception as e:
-        log.error(f"Could not delete media {filename}", str(e))
-    
-    try:
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
-    except Exception as e:
-        log.error(f"Could not delete thumbnail {filename}", str(e))
+    # Log the message
+    log.message_sent(username, action_type)
 
-    # Backward compatibility for old flat folders
-    try:
-        legacy_media = os.path.join("uploaded_media", os.path.basename(filename))
-        if os.path.exists(legacy_media):
-            os.remove(legacy_media)
-    except Exception:
-        pass
+    # Get reply content if replying
+    reply_data = None
+    if reply_to:
+        reply_result = message_cache.get(reply_to)
+        # Quoting needs a message from the same conversation
+        if reply_result and reply_result['channel_id'] == channel:
+            reply_data = {
+                "id": reply_to,
+                "user": reply_result['username'],
+                "msg": reply_result['message'],
+                "type": reply_result['type']
+            }
+
+    frame = {
+        "type": action_type, 
+        "id": msg_id, 
+        "user": username, 
+        "msg": msg_content, 
+        "timestamp": timestamp,
+        "reply_to": reply_to, 
+        "reply_data": reply_data, 
+        "read_by": [],
+        "file_size": file_size,
+        "original_name": original_name,
+        "reactions": {},
+        "channel": channel
+    }
+    if action_type == "voice":
+        # Set if the transcode finished before the message was sent
+        audio = lookup_audio_info(msg_content)
+        if audio:
+            frame["audio"] = audio
+    await manager.broadcast_to_channel(channel, frame)
 
-    try:
-        legacy_thumb = os.path.join("uploaded_thumbnails", os.path.basename(filename))
-        if os.path.exists(legacy_thumb):
-            os.remove(legacy_thumb)
-    except Exception:
-        pass
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     current_username = None
-    current_password = None
+    if manager.draining:
+        await websocket.close(code=1012)  # service restart: try again shortly
+        return
     
     try:
-        data = await websocket.receive_text()
-        login_data = json.loads(data)
-        username = login_data['username'].strip()
-        password = login_data['password']
+        login_data = await receive_frame(websocket)
+        if not isinstance(login_data, dict):
+            raise ValueError("login frame is not an object")
+        username = str(login_data.get('username') or '').strip()
+        password = str(login_data.get('password') or '')
+        token = login_data.get('token')
         
         if not username:
             await websocket.send_json({"type": "error", "msg": "Username cannot be empty!"})
             await websocket.close()
             return
         
-        try:
-            with get_db() as conn:
-                c = conn.cursor()
-                c.execute("SELECT * FROM users WHERE username=?", (username,))
-                user_record = c.fetchone()
-                
-                if user_record and user_record['password'] != password:
+        # Reconnects present the token from login_success: HMAC check only
+        login_started = time.perf_counter()
+        resumed = isinstance(token, str) and verify_session_token(token, username)
+        if not resumed:
+            try:
+                if not await authenticate_user(username, password):
                     log.login_failed(username, "Wrong password")
                     await websocket.send_json({"type": "error", "msg": "Wrong Password!"})
                     await websocket.close()
                     return
-                elif not user_record:
-                    c.execute("INSERT INTO users VALUES (?, ?)", (username, password))
-                    conn.commit()
-                    log.new_user_registered(username)
-        except Exception as db_e:
-            log.error(f"Database error for user {username}", str(db_e))
-            await websocket.send_json({"type": "error", "msg": "Server Database Error. Please try again."})
-            await websocket.close()
-            return
+            except Exception as db_e:
+                log.error(f"Database error for user {username}", str(db_e))
+                await websocket.send_json({"type": "error", "msg": "Server Database Error. Please try again."})
+                await websocket.close()
+                return
+        WS_ACTION_SECONDS.observe(time.perf_counter() - login_started, ("resume" if resumed else "login",))
 
         current_username = username
-        current_password = password
-        await manager.connect(websocket, username)
+        codec = negotiate_codec(login_data.get('codecs'))
+        channels = user_channels(username)
+        joined = [channel["id"] for channel in channels if channel["joined"]]
+        await manager.connect(websocket, username, codec)
+        manager.subscribe(websocket, joined)
         log.user_connected(username)
         
-        # Send login success with online users
+        # Send login success with the presence snapshot; others get a batched delta.
+        # Always JSON: it is how the client learns which codec the rest will use.
         await websocket.send_json({
             "type": "login_success", 
             "username": username,
-            "online_users": manager.get_online_users()
+            "online_users": manager.get_online_users(),
+            "presence_version": manager.presence_version,
+            "token": issue_session_token(username),
+            "token_ttl": SESSION_TOKEN_TTL,
+            "sfu": sfu.enabled,
+            "codec": codec.name,
+            "channels": channels
         })
         
-        # Broadcast user joined to others
-        await manager.broadcast({
-            "type": "user_joined",
-            "username": username,
-            "online_users": manager.get_online_users()
-        }, exclude=websocket)
-        
-        # Send chat history
-        with get_db() as conn:
-            c = conn.cursor()
-            c.execute("""SELECT id, username, message, type, timestamp, reply_to, read_by, 
-                        file_size, original_name, reactions FROM messages ORDER BY timestamp""")
-            for msg in c.fetchall():
-                read_by = json.loads(msg['read_by']) if msg['read_by'] else []
-                reactions = json.loads(msg['reactions']) if msg['reactions'] else {}
-                await websocket.send_json({
-                    "type": msg['type'], 
-                    "id": msg['id'], 
-                    "user": msg['username'], 
-                    "msg": msg['message'], 
-                    "timestamp": msg['timestamp'],
-                    "reply_to": msg['reply_to'], 
-                    "read_by": read_by,
-                    "file_size": msg['file_size'],
-                    "original_name": msg['original_name'],
-                    "reactions": reactions
-                })
+        # Send chat history (only the channels this user is in)
+        history_started = time.perf_counter()
+        await send_history(websocket, joined)
+        WS_ACTION_SECONDS.observe(time.perf_counter() - history_started, ("history",))
 
+        ctx = WsContext(websocket, username)
         while True:
-            data_text = await websocket.receive_text()
-            data_json = json.loads(data_text)
-            action_type = data_json.get("type", "")
-            
-            # --- TYPING INDICATOR ---
-            if action_type == "typing_start":
-                manager.typing_users.add(username)
-                await manager.broadcast({
-                    "type": "typing_update",
-                    "typing_users": list(manager.typing_users)
-                }, exclude=websocket)
-            
-            elif action_type == "typing_stop":
-                manager.typing_users.discard(username)
-                await manager.broadcast({
-                    "type": "typing_update",
-                    "typing_users": list(manager.typing_users)
-                }, exclude=websocket)
-            
-            # --- MARK MESSAGE AS READ ---
-            elif action_type == "mark_read":
-                msg_ids = data_json.get("ids", [])
-                with get_db() as conn:
-                    c = conn.cursor()
-                    for msg_id in msg_ids:
-                        c.execute("SELECT read_by, username FROM messages WHERE id=?", (msg_id,))
-                        result = c.fetchone()
-                        if result and result['username'] != username:
-                            read_by = json.loads(result['read_by']) if result['read_by'] else []
-                            if username not in read_by:
-                                read_by.append(username)
-                                c.execute("UPDATE messages SET read_by=? WHERE id=?", (json.dumps(read_by), msg_id))
-                                await manager.broadcast_to_all({
-                                    "type": "read_update",
-                                    "id": msg_id,
-                                    "read_by": read_by
-                                })
-                    conn.commit()
-            
-            # --- EDIT MESSAGE ---
-            elif action_type == "edit":
-                msg_id = data_json["id"]
-                new_text = data_json["content"]
-                with get_db() as conn:
-                    c = conn.cursor()
-                    c.execute("SELECT username, timestamp FROM messages WHERE id=?", (msg_id,))
-                    result = c.fetchone()
-                    if result and result['username'] == username:
-                        msg_time = datetime.fromisoformat(result['timestamp'])
-                        if datetime.now() - msg_time < timedelta(minutes=10):
-                            c.execute("UPDATE messages SET message=? WHERE id=?", (new_text, msg_id))
-                            conn.commit()
-                            log.message_edited(username)
-                            await manager.broadcast_to_all({"type": "edit_confirmed", "id": msg_id, "new_msg": new_text})
-                        else:
-                            await websocket.send_json({"type": "error", "msg": "Cannot edit messages older than 10 minutes"})
-
-            # --- DELETE MESSAGES WITH PROPER FILE CLEANUP ---
-            elif action_type == "delete":
-                ids_to_delete = data_json["ids"]
-                deleted_ids = []
-                
-                with get_db() as conn:
-                    c = conn.cursor()
-                    for msg_id in ids_to_delete:
-                        c.execute("SELECT username, message, type FROM messages WHERE id=?", (msg_id,))
-                        result = c.fetchone()
-                        if result and result['username'] == username:
-                            filename = result['message']
-                            msg_type = result['type']
-                            
-                            # Delete associated files for media messages
-                            if msg_type in ["image", "video", "file"]:
-                                delete_media_files(filename, msg_type)
-                            
-                            c.execute("DELETE FROM messages WHERE id=?", (msg_id,))
-                            deleted_ids.append(msg_id)
-                    conn.commit()
-                
-                if deleted_ids:
-                    log.message_deleted(username, len(deleted_ids))
-                    await manager.broadcast_to_all({"type": "delete_confirmed", "ids": deleted_ids})
-
-            # --- CALL SIGNALING ---
-            elif action_type == "call_initiate":
-                target_user = data_json.get("to")
-                call_type = data_json.get("callType", "voice")
-                log.call_started(username, target_user, call_type)
-                # Find target user's websocket and send call notification
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "call_incoming",
-                                "from": username,
-                                "callType": call_type
-                            })
-                        except:
-                            pass
-                        break
-            
-            elif action_type == "call_accept":
-                target_user = data_json.get("to")
-                log.call_accepted(username)
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "call_accepted",
-                                "from": username
-                            })
-                        except:
-                            pass
-                        break
-            
-            elif action_type == "call_reject":
-                target_user = data_json.get("to")
-                log.call_rejected(username)
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "call_rejected",
-                                "from": username,
-                                "reason": data_json.get("reason", "declined")
-                            })
-                        except:
-                            pass
-                        break
-            
-            elif action_type == "call_cancel":
-                target_user = data_json.get("to")
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "call_cancelled",
-                                "from": username
-                            })
-                        except:
-                            pass
-                        break
-            
-            elif action_type == "call_end":
-                target_user = data_json.get("to")
-                log.call_ended(username)
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "call_ended",
-                                "from": username
-                            })
-                        except:
-                            pass
-                        break
-
-            # --- WEBRTC SIGNALING ---
-            elif action_type == "webrtc_offer":
-                target_user = data_json.get("to")
-                offer = data_json.get("offer")
-                log.webrtc_signal("offer", username, target_user)
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "webrtc_offer",
-                                "from": username,
-                                "offer": offer
-                            })
-                        except:
-                            pass
-                        break
-            
-            elif action_type == "webrtc_answer":
-                target_user = data_json.get("to")
-                answer = data_json.get("answer")
-                log.webrtc_signal("answer", username, target_user)
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "webrtc_answer",
-                                "from": username,
-                                "answer": answer
-                            })
-                        except:
-                            pass
-                        break
-            
-            elif action_type == "ice_candidate":
-                target_user = data_json.get("to")
-                candidate = data_json.get("candidate")
-                for ws, user in manager.active_connections.items():
-                    if user == target_user:
-                        try:
-                            await ws.send_json({
-                                "type": "ice_candidate",
-                                "from": username,
-                                "candidate": candidate
-                            })
-                        except:
-                            pass
-                        break
-
-
-            elif action_type == "ping":
-                # Heartbeat to keep connection alive
-                await websocket.send_json({"type": "pong"})
-
-            # --- REACTION HANDLING ---
-            elif action_type == "reaction_add":
-                msg_id = data_json.get("id")
-                emoji = data_json.get("emoji")
-                
-                with get_db() as conn:
-                    c = conn.cursor()
-                    c.execute("SELECT reactions FROM messages WHERE id=?", (msg_id,))
-                    result = c.fetchone()
-                    if result:
-                        reactions = json.loads(result['reactions']) if result['reactions'] else {}
-                        if emoji not in reactions:
-                            reactions[emoji] = []
-                        if username not in reactions[emoji]:
-                            reactions[emoji].append(username)
-                        c.execute("UPDATE messages SET reactions=? WHERE id=?", (json.dumps(reactions), msg_id))
-                        conn.commit()
-                        await manager.broadcast_to_all({
-                            "type": "reaction_update",
-                            "id": msg_id,
-                            "reactions": reactions
-                        })
-            
-            elif action_type == "reaction_remove":
-                msg_id = data_json.get("id")
-                emoji = data_json.get("emoji")
-                
-                with get_db() as conn:
-                    c = conn.cursor()
-                    c.execute("SELECT reactions FROM messages WHERE id=?", (msg_id,))
-                    result = c.fetchone()
-                    if result:
-                        reactions = json.loads(result['reactions']) if result['reactions'] else {}
-                        if emoji in reactions and username in reactions[emoji]:
-                            reactions[emoji].remove(username)
-                            if len(reactions[emoji]) == 0:
-                                del reactions[emoji]
-                        c.execute("UPDATE messages SET reactions=? WHERE id=?", (json.dumps(reactions), msg_id))
-                        conn.commit()
-                        await manager.broadcast_to_all({
-                            "type": "reaction_update",
-                            "id": msg_id,
-                            "reactions": reactions
-                        })
-
-            # --- HANDLE FILE/IMAGE/VIDEO/TEXT/VOICE MESSAGES ---
-            elif action_type in ["text", "image", "video", "file", "voice"]:
-                msg_content = data_json["content"]
-                reply_to = data_json.get("reply_to", None)
-                file_size = data_json.get("file_size", 0)
-                original_name = data_json.get("original_name", "")
-                if action_type in ["image", "video", "file", "voice"]:
-                    msg_content = normalize_media_key(msg_content, action_type)
-                msg_id = str(uuid.uuid4())
-                timestamp = datetime.now().isoformat()
-                
-                # Stop typing when sending message
-                manager.typing_users.discard(username)
-                
-                with get_db() as conn:
-                    c = conn.cursor()
-                    c.execute("""INSERT INTO messages 
-                                (id, username, message, type, timestamp, reply_to, read_by, file_size, original_name, reactions) 
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", 
-                              (msg_id, username, msg_content, action_type, timestamp, reply_to, '[]', file_size, original_name, '{}'))
-                    conn.commit()
-                
-                # Log the message
-                log.message_sent(username, action_type)
-                
-                # Get reply content if replying
-                reply_data = None
-                if reply_to:
-                    with get_db() as conn:
-                        c = conn.cursor()
-                        c.execute("SELECT username, message, type FROM messages WHERE id=?", (reply_to,))
-                        reply_result = c.fetchone()
-                        if reply_result:
-                            reply_data = {
-                                "id": reply_to,
-                                "user": reply_result['username'],
-                                "msg": reply_result['message'],
-                                "type": reply_result['type']
-                            }
-                
-                await manager.broadcast_to_all({
-                    "type": action_type, 
-                    "id": msg_id, 
-                    "user": username, 
-                    "msg": msg_content, 
-                    "timestamp": timestamp,
-                    "reply_to": reply_to, 
-                    "reply_data": reply_data, 
-                    "read_by": [],
-                    "file_size": file_size,
-                    "original_name": original_name,
-                    "reactions": {}
-                })
+            data = await receive_frame(websocket)
+            manager.touch(websocket)
+            await dispatch_ws_action(ctx, data)
 
     except WebSocketDisconnect:
         if current_username:
-            manager.typing_users.discard(current_username)
             log.user_disconnected(current_username)
         await manager.disconnect(websocket)
-        if current_username:
-            await manager.broadcast_to_all({
-                "type": "user_left",
-                "username": current_username,
-                "online_users": manager.get_online_users()
-            })
+        await sfu.leave_all(websocket)
+    except FrameTooLarge as e:
+        WS_OVERSIZED_FRAMES.inc()
+        log.warning(f"Closing {current_username or 'anonymous'} socket: {e.args[0]} byte frame "
+                    f"(limit {WS_MAX_FRAME_BYTES})")
+        await manager.disconnect(websocket)
+        await sfu.leave_all(websocket)
+        try:
+            await websocket.close(code=1009)  # message too big
+        except Exception:
+            pass
     except Exception as e:
         log.error(f"WebSocket error", str(e))
         await manager.disconnect(websocket)
+        await sfu.leave_all(websocket)
+
+# --- GRACEFUL DRAIN ---
+# Restarts used to drop every socket at once, and every client reconnected and
+# replayed history in the same second. On SIGTERM / Ctrl+C the server closes
+# its listening socket, lets running /ws actions (each commits its own DB
+# writes) and thumbnail jobs finish, then tells every client to come back after
+# its own random delay and closes it with 1012 (service restart).
+#
+#   CHAT_DRAIN_TIMEOUT      seconds to wait for in-flight work, default 10
+#   CHAT_RECONNECT_SPREAD   clients reconnect spread over this many seconds, default 15
+
+DRAIN_TIMEOUT = float(os.environ.get("CHAT_DRAIN_TIMEOUT", "10"))
+RECONNECT_SPREAD = max(1.0, float(os.environ.get("CHAT_RECONNECT_SPREAD", "15")))
+
+
+async def wait_until(predicate, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+async def drain_connections():
+    """Close every chat socket politely. Called once the listening socket is closed."""
+    manager.draining = True
+    log.server_draining(len(manager.active_connections))
+    idle = await wait_until(lambda: slow_actions.running() == 0 and THUMBNAIL_QUEUE.value() <= 0
+                            and VOICE_QUEUE.value() <= 0, DRAIN_TIMEOUT)
+    if not idle:
+        log.warning(f"Drain: work still running after {DRAIN_TIMEOUT:.0f}s, closing sockets anyway")
+
+    async def close(websocket: WebSocket):
+        await manager.send(websocket, {"type": "server_restarting",
+                                       "reconnect_in": round(random.uniform(0.5, RECONNECT_SPREAD), 2)})
+        try:
+            await asyncio.wait_for(websocket.close(code=1012), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    await asyncio.gather(*(close(ws) for ws in list(manager.active_connections)))
+
+
+# --- TLS ---
+# Phones drop their socket whenever the screen locks, so most HTTPS handshakes
+# are reconnects. Session tickets (TLS 1.2) / PSK tickets (TLS 1.3) let those
+# skip the certificate signature and key exchange entirely.
+TLS_SESSION_TICKETS = int(os.environ.get("CHAT_TLS_TICKETS", "2"))
+tls_context: Optional[ssl.SSLContext] = None
+
+
+def tune_ssl_context(context: ssl.SSLContext) -> ssl.SSLContext:
+    """Harden uvicorn's server context and make sure session resumption is on."""
+    global tls_context
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= ssl.OP_NO_COMPRESSION | ssl.OP_CIPHER_SERVER_PREFERENCE
+    context.options &= ~ssl.OP_NO_TICKET
+    if hasattr(context, "num_tickets"):  # TLS 1.3 tickets sent after each full handshake
+        context.num_tickets = TLS_SESSION_TICKETS
+    tls_context = context
+    return context
+
+
+class ChatServerConfig(uvicorn.Config):
+    """uvicorn Config that tunes the SSLContext after uvicorn builds it."""
+
+    def load(self):
+        super().load()
+        if self.ssl is not None:
+            tune_ssl_context(self.ssl)
+
+
+def tls_stat(name: str) -> float:
+    return tls_context.session_stats().get(name, 0) if tls_context is not None else 0
+
+
+metrics.gauge("chatter_tls_handshakes", "TLS handshakes completed (this worker)",
+              callback=lambda: tls_stat("accept_good"))
+metrics.gauge("chatter_tls_resumed", "TLS handshakes that resumed an earlier session (this worker)",
+              callback=lambda: tls_stat("hits"))
+
+
+def served_module():
+    """The module whose app is being served: "main:app" workers import `main`; a plain run is this one."""
+    return sys.modules.get("main") or sys.modules[__name__]
+
+
+class ChatServer(uvicorn.Server):
+    """uvicorn Server that drains chat sockets before uvicorn closes connections."""
+
+    def __init__(self, config: uvicorn.Config, on_started=None):
+        super().__init__(config)
+        self.on_started = on_started
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        if self.started and self.on_started is not None:
+            self.on_started()
+
+    async def shutdown(self, sockets=None):
+        # Stop accepting first (uvicorn would do it next anyway), so that with
+        # --replace the kernel hands every new connection to the new process
+        for server in self.servers:
+            server.close()
+        for sock in sockets or []:
+            sock.close()
+        if not self.force_exit:
+            await served_module().drain_connections()
+        await super().shutdown(sockets=sockets)
+        # uvicorn re-raises the signal once serve() returns, so atexit won't run
+        if self.on_started is not None:
+            release_pid_file()
+
+
+try:
+    from uvicorn.supervisors.multiprocess import Process as UvicornWorker
+except ImportError:  # uvicorn < 0.30: Multiprocess takes the worker target instead
+    UvicornWorker = None
+
+if UvicornWorker is not None:
+    class ChatWorker(UvicornWorker):
+        """A --workers child that runs ChatServer, so it drains like a single process does."""
+
+        @property
+        def server(self) -> uvicorn.Server:
+            if self._server is None:
+                self._server = ChatServer(self.config)
+            return self._server
+
+
+# --- ZERO-DOWNTIME RESTART ---
+# `--reuse-port` binds with SO_REUSEPORT and records the PID in data/server.pid.
+# `--replace` starts a second instance on the same port; once it is listening
+# it sends SIGTERM to the recorded PID, which drains as above while new
+# connections already land on the new process.
+PID_FILE = os.path.join(DATA_DIR, "server.pid")
+
+
+def bind_reuse_port(host: str, port: int, backlog: int) -> socket.socket:
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("--reuse-port/--replace need SO_REUSEPORT (Linux, macOS, BSD)")
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    # Listen right away: connections queue here even before a worker accepts
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def read_pid_file() -> Optional[int]:
+    try:
+        with open(PID_FILE) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def release_pid_file():
+    if read_pid_file() == os.getpid():
+        os.remove(PID_FILE)
+
+
+def take_over(replace: bool):
+    """Record this process as the running server; with `replace`, drain the previous one."""
+    previous = read_pid_file()
+    with open(PID_FILE, "w") as f:
+        f.write(str(os.getpid()))
+    atexit.register(release_pid_file)
+    import psutil
+    if replace and previous and previous != os.getpid() and psutil.pid_exists(previous):
+        log.server_replacing(previous)
+        os.kill(previous, signal.SIGTERM)
+
+
+def run_server(app_ref, options: dict, reuse_port: bool = False, replace: bool = False):
+    """uvicorn.run() equivalent that goes through ChatServerConfig and ChatServer."""
+    config = ChatServerConfig(app_ref, **options)
+    sockets = [bind_reuse_port(config.host, config.port, config.backlog)] if reuse_port or replace else None
+    on_started = functools.partial(take_over, replace) if sockets and config.workers == 1 else None
+    server = ChatServer(config, on_started)
+    if config.workers > 1:
+        from uvicorn.supervisors import Multiprocess, multiprocess
+        sock = sockets[0] if sockets else config.bind_socket()
+        if UvicornWorker is not None:
+            # Multiprocess builds its workers from this name (including restarts)
+            multiprocess.Process = ChatWorker
+            supervisor = Multiprocess(config, sockets=[sock])
+        else:
+            supervisor = Multiprocess(config, target=server.run, sockets=[sock])
+        if sockets:
+            # No single "started" moment across workers; the socket already
+            # listens, so connections queue until the workers accept them
+            take_over(replace)
+        supervisor.run()
+    else:
+        try:
+            server.run(sockets=sockets)
+        except KeyboardInterrupt:
+            pass
+
+
+# --- COMMAND LINE ---
+def module_available(name: str) -> bool:
+    import importlib.util
+    return importlib.util.find_spec(name) is not None
+
+
+def build_arg_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description="Local-LAN-Messenger server")
+    parser.add_argument("--host", default="0.0.0.0", help="interface to bind (default: all)")
+    parser.add_argument("--port", type=int, default=int(os.environ.get("PORT", 8000)))
+    parser.add_argument("--ssl", action="store_true", help="serve HTTPS (needed for calls from other devices)")
+    parser.add_argument("--cert", default="cert.pem", help="certificate file used with --ssl")
+    parser.add_argument("--key", default="key.pem", help="private key file used with --ssl")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes; chat state is per process, see README")
+    parser.add_argument("--loop", choices=["auto", "asyncio", "uvloop"], default="auto",
+                        help="event loop (auto: uvloop when installed)")
+    parser.add_argument("--http", choices=["auto", "h11", "httptools"], default="auto",
+                        help="HTTP parser (auto: httptools when installed)")
+    parser.add_argument("--ws-max-size", type=int, default=1024 * 1024,
+                        help="largest accepted WebSocket frame in bytes (default: 1MB)")
+    parser.add_argument("--no-ws-compression", action="store_true",
+                        help="disable permessage-deflate (less CPU, more bandwidth)")
+    parser.add_argument("--backlog", type=int, default=2048, help="TCP listen backlog")
+    parser.add_argument("--timeout-keep-alive", type=int, default=5,
+                        help="seconds an idle keep-alive connection stays open")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="bind with SO_REUSEPORT so a later --replace can take over the port")
+    parser.add_argument("--replace", action="store_true",
+                        help="zero-downtime restart: bind next to the running server, then make it drain")
+    return parser
+
+
+def resolve_loop(choice: str) -> str:
+    if choice == "auto":
+        return "uvloop" if sys.platform != "win32" and module_available("uvloop") else "asyncio"
+    if choice == "uvloop" and not module_available("uvloop"):
+        raise SystemExit("--loop uvloop: uvloop is not installed (pip install uvloop)")
+    return choice
+
+
+def resolve_http(choice: str) -> str:
+    if choice == "auto":
+        return "httptools" if module_available("httptools") else "h11"
+    if choice == "httptools" and not module_available("httptools"):
+        raise SystemExit("--http httptools: httptools is not installed (pip install httptools)")
+    return choice
+
+
+def uvicorn_options(args) -> dict:
+    """Translate parsed CLI arguments into uvicorn.run() keyword arguments."""
+    options = dict(
+        host=args.host,
+        port=args.port,
+        loop=resolve_loop(args.loop),
+        http=resolve_http(args.http),
+        ws_max_size=args.ws_max_size,
+        ws_per_message_deflate=not args.no_ws_compression,
+        ws_ping_interval=WS_PING_INTERVAL or None,
+        ws_ping_timeout=WS_PING_TIMEOUT or None,
+        backlog=args.backlog,
+        timeout_keep_alive=args.timeout_keep_alive,
+        workers=args.workers,
+    )
+    if args.ssl:
+        for path in (args.cert, args.key):
+            if not os.path.isfile(path):
+                raise SystemExit(f"--ssl: {path} not found. Run: python generate_ssl.py <your LAN IP>")
+        options.update(ssl_certfile=args.cert, ssl_keyfile=args.key)
+    return options
+
 
 if __name__ == "__main__":
-    import uvicorn
-    # This block allows running 'python main.py' directly, which is what start_server_mac.command does
-    # It defaults to HTTP on port 8000
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=False)
+    args = build_arg_parser().parse_args()
+    options = uvicorn_options(args)
+    log.server_starting()
+    log.info(f"Event loop: {options['loop']}, HTTP parser: {options['http']}, workers: {args.workers}")
+    if args.workers > 1:
+        # Each worker has its own ConnectionManager: users on different workers can't see each other
+        log.warning(f"Running {args.workers} workers: live chat only reaches users on the same worker process")
+        # Another worker's edits would leave this one's cached copy stale
+        os.environ["CHAT_MESSAGE_CACHE"] = "0"
+        # Migrate once here instead of in every worker's lifespan
+        prepare_storage()
+        os.environ["CHAT_STORAGE_READY"] = "1"
+    # A single worker runs this already-imported app instead of importing main a second time
+    run_server("main:app" if args.workers > 1 else app, options, reuse_port=args.reuse_port, replace=args.replace)
@@ -36,4 +36,4 @@ echo "⚠️  First-time browser certificate warning is expected"
 echo "🛑 Stop with:   Ctrl+C"
 echo
 
-python3 main.py --ssl --host 0.0.0.0 --port "$PORT"
+python3 main.py --ssl --host 0.0.0.0 --port "$PORT" "$@"
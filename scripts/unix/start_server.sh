@@ -29,4 +29,4 @@ echo "🌐 Share URL:   http://${LAN_IP}:${PORT}"
 echo "🛑 Stop with:   Ctrl+C"
 echo
 
-uvicorn main:app --host 0.0.0.0 --port "$PORT"
+python3 main.py --host 0.0.0.0 --port "$PORT" "$@"
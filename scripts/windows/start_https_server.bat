@@ -51,7 +51,7 @@ echo   🛑 Press Ctrl+C to stop the server
 echo ══════════════════════════════════════════════════════
 echo.
 
-python main.py --ssl --host 0.0.0.0 --port %PORT%
+python main.py --ssl --host 0.0.0.0 --port %PORT% %*
 
 echo.
 echo ══════════════════════════════════════════════════════
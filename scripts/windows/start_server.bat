@@ -37,7 +37,7 @@ echo   🛑 Press Ctrl+C to stop the server
 echo ══════════════════════════════════════════════════════
 echo.
 
-uvicorn main:app --host 0.0.0.0 --port %PORT%
+python main.py --host 0.0.0.0 --port %PORT% %*
 
 echo.
 echo ══════════════════════════════════════════════════════
@@ -0,0 +1,241 @@
+"""
+Selective forwarding unit (SFU) for group voice/video calls.
+
+Runs as its own process next to main.py:
+
+    python sfu.py --host 127.0.0.1 --port 8010
+    CHAT_SFU=127.0.0.1:8010 python main.py
+
+Browsers never talk to this process over HTTP. main.py relays signaling
+through its existing /ws connection and forwards it here over a local TCP
+socket, one JSON object per line:
+
+    main.py -> sfu    {"op": "join",   "room": r, "peer": p, "user": u}
+                      {"op": "answer", "room": r, "peer": p, "sdp": s}
+                      {"op": "leave",  "room": r, "peer": p}
+    sfu -> main.py    {"op": "offer",  "room": r, "peer": p, "sdp": s, "streams": {mid: user}}
+                      {"op": "closed", "room": r, "peer": p}
+
+Each participant has ONE peer connection to the SFU and uploads its camera
+and microphone once; the SFU fans the tracks out to everyone else in the
+room. The SFU is always the offerer, so there is no glare to resolve: a
+joiner gets an uplink-only offer, then a second one with the room's tracks,
+and when someone joins or leaves every other participant gets a fresh offer.
+
+aiortc has no packet-level forwarding API: incoming tracks are decoded once
+(MediaRelay shares the decoded frames) and re-encoded per subscriber. That
+is fine for a stand-up of 6-10 people on a LAN server, and it still means
+each phone uploads a single stream instead of N-1.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+from typing import Dict, Optional
+
+from aiortc import RTCConfiguration, RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+
+log = logging.getLogger("sfu")
+
+# LAN only: host candidates are enough, and STUN lookups would only delay
+# gathering (aiortc waits for gathering to finish before answering/offering)
+RTC_CONFIG = RTCConfiguration(iceServers=[])
+CONTROL_LINE_LIMIT = 1024 * 1024
+
+
+class Participant:
+    """One browser tab in a room: its peer connection and what it forwards."""
+
+    def __init__(self, room: "Room", peer: str, user: str):
+        self.room = room
+        self.peer = peer
+        self.user = user
+        self.pc = RTCPeerConnection(RTC_CONFIG)
+        self.published = []          # tracks this participant uploads
+        self.sources: Dict[object, Optional[tuple]] = {}  # outgoing transceiver -> (peer, user) it carries
+        self.awaiting_answer = False
+        self.renegotiate = False
+        self.subscribed = False      # has this participant received the room's existing tracks
+        # Uplink first: the browser's addTrack() reuses the first matching
+        # transceiver, so its camera/mic land on these two m-lines
+        self.pc.addTransceiver("audio", direction="recvonly")
+        self.pc.addTransceiver("video", direction="recvonly")
+
+    def forward(self, publisher: "Participant", track):
+        """Start sending `track` (uploaded by `publisher`) to this participant."""
+        relayed = self.room.relay.subscribe(track)
+        source = (publisher.peer, publisher.user)
+        for transceiver, current in self.sources.items():
+            if current is None and transceiver.kind == track.kind:
+                transceiver.sender.replaceTrack(relayed)
+                transceiver.direction = "sendonly"
+                self.sources[transceiver] = source
+                return
+        # addTrack() would recycle the recvonly uplink transceivers, so always add a sendonly one
+        transceiver = self.pc.addTransceiver(relayed, direction="sendonly")
+        self.sources[transceiver] = source
+
+    def stop_forwarding(self, peer: str):
+        """Park the transceivers that carried `peer`; they are reused for the next publisher."""
+        for transceiver, current in self.sources.items():
+            if current is not None and current[0] == peer:
+                transceiver.sender.replaceTrack(None)
+                transceiver.direction = "inactive"
+                self.sources[transceiver] = None
+
+    def stream_map(self) -> Dict[str, str]:
+        """mid -> user name, so the browser can label each incoming track."""
+        return {t.mid: source[1] for t, source in self.sources.items()
+                if source is not None and t.mid is not None}
+
+    async def negotiate(self):
+        if self.awaiting_answer:
+            self.renegotiate = True   # sent once the current answer arrives
+            return
+        self.awaiting_answer = True
+        self.renegotiate = False
+        offer = await self.pc.createOffer()
+        await self.pc.setLocalDescription(offer)  # waits for ICE gathering
+        await self.room.sfu.send({
+            "op": "offer", "room": self.room.name, "peer": self.peer,
+            "sdp": self.pc.localDescription.sdp, "streams": self.stream_map(),
+        })
+
+    async def accept_answer(self, sdp: str):
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp=sdp, type="answer"))
+        self.awaiting_answer = False
+        if not self.subscribed:
+            # The first offer carries only the uplink. Senders that were part
+            # of an initial aiortc offer never started flowing in our tests,
+            # so the room's existing tracks come in the follow-up offer.
+            self.subscribed = True
+            for other in self.room.participants.values():
+                if other is not self:
+                    for track in other.published:
+                        self.forward(other, track)
+                        self.renegotiate = True
+        if self.renegotiate:
+            await self.negotiate()
+
+
+class Room:
+    def __init__(self, sfu: "SfuServer", name: str):
+        self.sfu = sfu
+        self.name = name
+        self.relay = MediaRelay()
+        self.participants: Dict[str, Participant] = {}
+
+    async def join(self, peer: str, user: str):
+        if peer in self.participants:
+            await self.leave(peer)
+        participant = Participant(self, peer, user)
+        self.participants[peer] = participant
+
+        @participant.pc.on("track")
+        def on_track(track):
+            participant.published.append(track)
+            log.info("%s publishes %s in %s", user, track.kind, self.name)
+            for other in self.participants.values():
+                # Not yet subscribed: it picks this track up from `published` later
+                if other is not participant and other.subscribed:
+                    other.forward(participant, track)
+                    asyncio.ensure_future(other.negotiate())
+
+        @participant.pc.on("connectionstatechange")
+        async def on_state():
+            if participant.pc.connectionState in ("failed", "closed"):
+                await self.leave(peer, notify=True)
+
+        log.info("%s joined %s (%d in room)", user, self.name, len(self.participants))
+        await participant.negotiate()
+
+    async def leave(self, peer: str, notify: bool = False):
+        participant = self.participants.pop(peer, None)
+        if participant is None:
+            return
+        await participant.pc.close()
+        log.info("%s left %s (%d in room)", participant.user, self.name, len(self.participants))
+        for other in self.participants.values():
+            other.stop_forwarding(peer)
+            await other.negotiate()
+        if notify:
+            await self.sfu.send({"op": "closed", "room": self.name, "peer": peer})
+        if not self.participants:
+            self.sfu.rooms.pop(self.name, None)
+
+
+class SfuServer:
+    """Accepts the control connection from main.py and runs the rooms."""
+
+    def __init__(self):
+        self.rooms: Dict[str, Room] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def send(self, message: dict):
+        if self._writer is None:
+            return
+        self._writer.write(json.dumps(message).encode() + b"\n")
+        await self._writer.drain()
+
+    async def handle_control(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # One main.py at a time; a reconnecting server replaces the old link
+        self._writer = writer
+        log.info("control link from %s", writer.get_extra_info("peername"))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    await self.dispatch(json.loads(line))
+                except Exception:
+                    log.exception("bad control message")
+        finally:
+            if self._writer is writer:
+                self._writer = None
+                # Without main.py nobody can renegotiate; start clean next time
+                for room in list(self.rooms.values()):
+                    for peer in list(room.participants):
+                        await room.leave(peer)
+            writer.close()
+
+    async def dispatch(self, message: dict):
+        op, name, peer = message.get("op"), message.get("room"), message.get("peer")
+        if op == "join":
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = Room(self, name)
+            await room.join(peer, message["user"])
+        elif op == "answer":
+            room = self.rooms.get(name)
+            participant = room.participants.get(peer) if room else None
+            if participant is not None:
+                await participant.accept_answer(message["sdp"])
+        elif op == "leave":
+            room = self.rooms.get(name)
+            if room is not None:
+                await room.leave(peer)
+
+
+async def serve(host: str, port: int):
+    sfu = SfuServer()
+    # SDP for a 10-person room is tens of KB; stay well above that per line
+    server = await asyncio.start_server(sfu.handle_control, host, port, limit=CONTROL_LINE_LIMIT)
+    log.info("SFU control socket on %s:%d", host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local-LAN-Messenger group call SFU")
+    parser.add_argument("--host", default="127.0.0.1", help="control socket address (keep it local)")
+    parser.add_argument("--port", type=int, default=8010)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] 🎛️  %(message)s", datefmt="%H:%M:%S")
+    logging.getLogger("aioice").setLevel(logging.WARNING)  # per-candidate-pair chatter
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
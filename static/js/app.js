@@ -10,6 +10,11 @@
       let isTyping = false;
       let messageCache = {};
       let reconnectAttempts = 0;
+      let presenceVersion = 0; // last applied presence delta, see applyPresence()
+      let sessionToken = null; // resume token from login_success, skips password checks on reconnect
+      let restartDelay = 0; // ms, set by server_restarting: reconnect after it, not all at once
+      let channels = {}; // id -> {id, name, kind, joined, members, unread, pendingRead}
+      let currentChannel = "general";
       const MAX_RECONNECT_ATTEMPTS = 10;
 
       // ===== USER COLOR SYSTEM =====
@@ -168,13 +173,13 @@
         input.addEventListener("input", () => {
           if (!isTyping && input.value.length > 0) {
             isTyping = true;
-            ws?.send(JSON.stringify({ type: "typing_start" }));
+            sendFrame({ type: "typing_start", channel: currentChannel });
           }
           clearTimeout(typingTimeout);
           typingTimeout = setTimeout(() => {
             if (isTyping) {
               isTyping = false;
-              ws?.send(JSON.stringify({ type: "typing_stop" }));
+              sendFrame({ type: "typing_stop", channel: currentChannel });
             }
           }, 2000);
         });
@@ -321,6 +326,7 @@
       }
 
       async function sendVoiceMessage(blob) {
+        const channel = currentChannel;
         // Upload logic
         const formData = new FormData();
         formData.append("files", blob, "voice-note.webm");
@@ -336,13 +342,12 @@
           const result = await response.json();
           const fileData = result.files[0];
 
-          ws.send(
-            JSON.stringify({
-              type: "voice",
-              content: fileData.filename,
-              reply_to: replyToId,
-            }),
-          );
+          sendFrame({
+            type: "voice",
+            content: fileData.filename,
+            reply_to: replyToId,
+            channel,
+          });
           playSound("sent");
 
           cancelReply();
@@ -352,6 +357,219 @@
         }
       }
 
+      // ===== WIRE CODEC =====
+      // We offer MessagePack at login; if the server agrees, it sends binary
+      // frames (smaller, cheaper to parse than JSON) and we answer in kind.
+      // Text frames are always JSON, binary frames always MessagePack, so a
+      // server without msgpack simply keeps talking JSON. Hot fields travel
+      // under short keys: WIRE_KEYS must match the table in main.py.
+      const WIRE_KEYS = {
+        type: "t",
+        id: "i",
+        user: "u",
+        msg: "m",
+        timestamp: "ts",
+        reply_to: "r",
+        reply_data: "rd",
+        read_by: "rb",
+        file_size: "fs",
+        original_name: "on",
+        reactions: "rx",
+        content: "ct",
+        ids: "is",
+        from: "f",
+        to: "o",
+        candidate: "c",
+        offer: "of",
+        answer: "an",
+        channel: "ch",
+      };
+      const WIRE_KEYS_BACK = Object.fromEntries(
+        Object.entries(WIRE_KEYS).map(([key, short]) => [short, key]),
+      );
+      const textEncoder = new TextEncoder();
+      const textDecoder = new TextDecoder();
+      let wireCodec = "json"; // what login_success said the server will send
+
+      function msgpackEncode(value) {
+        let buf = new Uint8Array(512);
+        let view = new DataView(buf.buffer);
+        let pos = 0;
+        const ensure = (n) => {
+          if (pos + n <= buf.length) return;
+          let size = buf.length * 2;
+          while (size < pos + n) size *= 2;
+          const bigger = new Uint8Array(size);
+          bigger.set(buf);
+          buf = bigger;
+          view = new DataView(buf.buffer);
+        };
+        const byte = (b) => {
+          ensure(1);
+          buf[pos++] = b;
+        };
+        const header = (n, fix, fixMax, code16) => {
+          if (n < fixMax) return byte(fix | n);
+          ensure(5);
+          if (n < 0x10000) {
+            buf[pos++] = code16;
+            view.setUint16(pos, n);
+            pos += 2;
+          } else {
+            buf[pos++] = code16 + 1;
+            view.setUint32(pos, n);
+            pos += 4;
+          }
+        };
+        const write = (v) => {
+          if (v === null || v === undefined) return byte(0xc0);
+          if (v === false) return byte(0xc2);
+          if (v === true) return byte(0xc3);
+          if (typeof v === "number") {
+            ensure(9);
+            if (Number.isInteger(v) && v >= 0 && v < 0x100000000) {
+              if (v < 0x80) buf[pos++] = v;
+              else if (v < 0x100) {
+                buf[pos++] = 0xcc;
+                buf[pos++] = v;
+              } else if (v < 0x10000) {
+                buf[pos++] = 0xcd;
+                view.setUint16(pos, v);
+                pos += 2;
+              } else {
+                buf[pos++] = 0xce;
+                view.setUint32(pos, v);
+                pos += 4;
+              }
+            } else if (Number.isInteger(v) && v < 0 && v >= -0x80000000) {
+              if (v >= -32) buf[pos++] = v & 0xff;
+              else {
+                buf[pos++] = 0xd2;
+                view.setInt32(pos, v);
+                pos += 4;
+              }
+            } else if (Number.isSafeInteger(v)) {
+              // e.g. File.lastModified, sizes over 4GB: keep them integers
+              buf[pos++] = v < 0 ? 0xd3 : 0xcf;
+              view.setBigInt64(pos, BigInt(v));
+              pos += 8;
+            } else {
+              buf[pos++] = 0xcb;
+              view.setFloat64(pos, v);
+              pos += 8;
+            }
+            return;
+          }
+          if (typeof v === "string") {
+            const bytes = textEncoder.encode(v);
+            if (bytes.length < 32) byte(0xa0 | bytes.length);
+            else if (bytes.length < 0x100) {
+              byte(0xd9);
+              byte(bytes.length);
+            } else header(bytes.length, 0, 0, 0xda);
+            ensure(bytes.length);
+            buf.set(bytes, pos);
+            pos += bytes.length;
+            return;
+          }
+          if (Array.isArray(v)) {
+            header(v.length, 0x90, 16, 0xdc);
+            v.forEach(write);
+            return;
+          }
+          // RTCSessionDescription / RTCIceCandidate have no own keys, only toJSON()
+          if (typeof v.toJSON === "function") return write(v.toJSON());
+          const keys = Object.keys(v).filter((k) => v[k] !== undefined);
+          header(keys.length, 0x80, 16, 0xde);
+          for (const key of keys) {
+            write(key);
+            write(v[key]);
+          }
+        };
+        write(value);
+        return buf.subarray(0, pos);
+      }
+
+      function msgpackDecode(buffer) {
+        const bytes = new Uint8Array(buffer);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let pos = 0;
+        const str = (n) => textDecoder.decode(bytes.subarray(pos, (pos += n)));
+        const bin = (n) => bytes.slice(pos, (pos += n));
+        const array = (n) => {
+          const out = new Array(n);
+          for (let i = 0; i < n; i++) out[i] = read();
+          return out;
+        };
+        const map = (n) => {
+          const out = {};
+          for (let i = 0; i < n; i++) {
+            const key = read();
+            out[key] = read();
+          }
+          return out;
+        };
+        const num = (getter, size) => {
+          const v = view[getter](pos);
+          pos += size;
+          return typeof v === "bigint" ? Number(v) : v;
+        };
+        const read = () => {
+          const b = bytes[pos++];
+          if (b < 0x80) return b;
+          if (b < 0x90) return map(b & 0x0f);
+          if (b < 0xa0) return array(b & 0x0f);
+          if (b < 0xc0) return str(b & 0x1f);
+          if (b >= 0xe0) return b - 0x100;
+          switch (b) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: return bin(num("getUint8", 1));
+            case 0xc5: return bin(num("getUint16", 2));
+            case 0xc6: return bin(num("getUint32", 4));
+            case 0xca: return num("getFloat32", 4);
+            case 0xcb: return num("getFloat64", 8);
+            case 0xcc: return num("getUint8", 1);
+            case 0xcd: return num("getUint16", 2);
+            case 0xce: return num("getUint32", 4);
+            case 0xcf: return num("getBigUint64", 8);
+            case 0xd0: return num("getInt8", 1);
+            case 0xd1: return num("getInt16", 2);
+            case 0xd2: return num("getInt32", 4);
+            case 0xd3: return num("getBigInt64", 8);
+            case 0xd9: return str(num("getUint8", 1));
+            case 0xda: return str(num("getUint16", 2));
+            case 0xdb: return str(num("getUint32", 4));
+            case 0xdc: return array(num("getUint16", 2));
+            case 0xdd: return array(num("getUint32", 4));
+            case 0xde: return map(num("getUint16", 2));
+            case 0xdf: return map(num("getUint32", 4));
+          }
+          throw new Error(`msgpack: unsupported type 0x${b.toString(16)}`);
+        };
+        return read();
+      }
+
+      function decodeFrame(data) {
+        if (typeof data === "string") return JSON.parse(data);
+        const message = msgpackDecode(data);
+        const out = {};
+        for (const key in message) out[WIRE_KEYS_BACK[key] || key] = message[key];
+        return out;
+      }
+
+      function sendFrame(message) {
+        if (!ws) return;
+        if (wireCodec !== "msgpack") {
+          ws.send(JSON.stringify(message));
+          return;
+        }
+        const short = {};
+        for (const key in message) short[WIRE_KEYS[key] || key] = message[key];
+        ws.send(msgpackEncode(short));
+      }
+
       // ===== LOGIN =====
       function login() {
         const u = document.getElementById("username").value.trim();
@@ -375,21 +593,30 @@
       function connectWebSocket(username, password) {
         const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
         ws = new WebSocket(`${protocol}//${window.location.host}/ws`);
+        ws.binaryType = "arraybuffer";
+        wireCodec = "json"; // until login_success says otherwise
 
         ws.onopen = () => {
           reconnectAttempts = 0;
-          ws.send(JSON.stringify({ username, password }));
+          sendFrame({ username, password, token: sessionToken, codecs: ["msgpack", "json"] });
         };
 
         ws.onclose = (event) => {
-          if (myUsername && reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
+          if (myUsername && restartDelay) {
+            // Planned restart: the server picked our slot in the reconnect window
+            const delay = restartDelay;
+            restartDelay = 0;
+            reconnectAttempts = 0;
+            setTimeout(() => connectWebSocket(myUsername, password), delay);
+          } else if (myUsername && reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
             reconnectAttempts++;
             showToast(
               `Connection lost. Reconnecting... (${reconnectAttempts}/${MAX_RECONNECT_ATTEMPTS})`,
             );
+            // Jittered, so a crashed server isn't hit by every client in the same instant
             setTimeout(
               () => connectWebSocket(myUsername, password),
-              Math.min(1000 * reconnectAttempts, 5000),
+              Math.min(1000 * reconnectAttempts, 5000) * (0.5 + Math.random()),
             );
           } else if (!myUsername) {
             // Login failed connection drop
@@ -416,11 +643,10 @@
           }
         };
 
-        ws.onmessage = handleMessage;
+        ws.onmessage = (event) => handleMessage(decodeFrame(event.data));
       }
 
-      function handleMessage(event) {
-        const data = JSON.parse(event.data);
+      function handleMessage(data) {
         console.log("WS Message:", data.type, data);
 
         switch (data.type) {
@@ -429,12 +655,15 @@
             document.getElementById("chat-container").style.display = "flex";
             myUsername = data.username;
             onlineUsers = data.online_users || [];
-            // Store password for call window authentication
-            localStorage.setItem(
-              "chatPassword",
-              document.getElementById("password").value,
-            );
+            presenceVersion = data.presence_version || 0;
+            // Resume token for reconnects and the call window (no password stored)
+            sessionToken = data.token || null;
+            localStorage.removeItem("chatPassword");
+            if (sessionToken) localStorage.setItem("chatToken", sessionToken);
             localStorage.setItem("chatUsername", myUsername);
+            sfuAvailable = !!data.sfu;
+            wireCodec = data.codec === "msgpack" ? "msgpack" : "json";
+            setChannels(data.channels || []);
             updateOnlineDisplay();
             break;
 
@@ -449,19 +678,35 @@
             showToast(data.msg, "error");
             break;
 
-          case "user_joined":
-            onlineUsers = data.online_users || [];
-            updateOnlineDisplay();
-            showToast(`${data.username} joined`, "success");
+          case "presence":
+            applyPresence(data);
             break;
 
-          case "user_left":
+          case "presence_snapshot":
             onlineUsers = data.online_users || [];
+            presenceVersion = data.v;
             updateOnlineDisplay();
             break;
 
           case "typing_update":
-            updateTypingIndicator(data.typing_users || []);
+            if ((data.channel || "general") === currentChannel) {
+              updateTypingIndicator(data.typing_users || []);
+            }
+            break;
+
+          case "channel_added":
+            handleChannelAdded(data);
+            break;
+
+          case "channel_created":
+            if (!channels[data.channel.id]) {
+              channels[data.channel.id] = { ...data.channel, unread: 0, pendingRead: [] };
+              renderChannelList();
+            }
+            break;
+
+          case "channel_removed":
+            handleChannelRemoved(data.channel);
             break;
 
           // ===== CALL SIGNALING =====
@@ -475,13 +720,11 @@
             // Check if already in call
             if (currentCall) {
               console.log("Already in call, rejecting with busy");
-              ws.send(
-                JSON.stringify({
-                  type: "call_reject",
-                  to: data.from,
-                  reason: "busy",
-                }),
-              );
+              sendFrame({
+                type: "call_reject",
+                to: data.from,
+                reason: "busy",
+              });
             } else {
               currentCall = {
                 with: data.from,
@@ -566,28 +809,111 @@
             updateReadReceipts(data.id, data.read_by);
             break;
 
+          case "media_update":
+            handleMediaUpdate(data);
+            break;
+
+          case "ping":
+            // Server heartbeat: answering keeps this socket from being reaped
+            sendFrame({ type: "pong" });
+            break;
+
+          case "rate_limited":
+            showToast("You're sending too fast. Please slow down.", "error");
+            break;
+
+          case "server_restarting":
+            restartDelay = (data.reconnect_in || 1) * 1000;
+            showToast("Server is restarting. Reconnecting shortly...");
+            break;
+
+          // ===== DIRECT FILE TRANSFER (P2P) =====
+          case "p2p_file_offer":
+            handleP2pFileOffer(data);
+            break;
+
+          case "p2p_file_accept":
+            handleP2pFileAccept(data);
+            break;
+
+          case "p2p_file_cancel":
+            handleP2pFileCancel(data);
+            break;
+
+          case "p2p_signal":
+            handleP2pSignal(data);
+            break;
+
+          // ===== GROUP CALLS (SFU) =====
+          case "sfu_offer":
+            handleSfuOffer(data);
+            break;
+
+          case "sfu_joined":
+            if (groupCall) groupCall.room = data.room;
+            break;
+
+          case "sfu_invite":
+            handleSfuInvite(data);
+            break;
+
+          case "sfu_closed":
+            if (groupCall && groupCall.room === data.room) {
+              showToast("Group call ended", "error");
+              leaveGroupCall(false);
+            }
+            break;
+
           default:
             if (
               ["text", "image", "video", "file", "voice"].includes(data.type)
             ) {
               addMessageBubble(data);
-              document.getElementById("empty-state").style.display = "none";
+              const channel = data.channel || "general";
+              if (channel === currentChannel) {
+                document.getElementById("empty-state").style.display = "none";
+              }
               // Mark as read if from others
               if (data.user !== myUsername) {
                 playSound("received");
-                setTimeout(
-                  () =>
-                    ws?.send(
-                      JSON.stringify({ type: "mark_read", ids: [data.id] }),
-                    ),
-                  500,
-                );
+                if (channel === currentChannel) {
+                  setTimeout(
+                    () =>
+                      sendFrame({ type: "mark_read", ids: [data.id] }),
+                    500,
+                  );
+                } else {
+                  noteUnread(channel, data);
+                }
               }
             }
         }
       }
 
       // ===== ONLINE USERS =====
+      // The server sends numbered presence deltas; if one goes missing we ask
+      // for a full snapshot instead of guessing.
+      function applyPresence(data) {
+        if (data.v <= presenceVersion) return;
+        if (data.v !== presenceVersion + 1) {
+          sendFrame({ type: "presence_sync" });
+          return;
+        }
+        presenceVersion = data.v;
+        const online = new Set(onlineUsers);
+        data.left.forEach((u) => online.delete(u));
+        data.joined.forEach((u) => online.add(u));
+        onlineUsers = [...online];
+        updateOnlineDisplay();
+
+        const others = data.joined.filter((u) => u !== myUsername);
+        if (others.length === 1) {
+          showToast(`${others[0]} joined`, "success");
+        } else if (others.length > 1) {
+          showToast(`${others.length} people joined`, "success");
+        }
+      }
+
       function updateOnlineDisplay() {
         document.getElementById("online-count").textContent =
           `${onlineUsers.length} online`;
@@ -627,6 +953,164 @@
         }
       }
 
+      // ===== CHANNELS =====
+      // Every message belongs to a channel: "general", a public channel or a
+      // direct conversation. The server only sends us channels we are in;
+      // all of their messages share #messages and rows of other channels
+      // are hidden until we switch to them.
+      function setChannels(list) {
+        const previous = channels;
+        channels = {};
+        list.forEach((c) => {
+          channels[c.id] = {
+            ...c,
+            unread: previous[c.id]?.unread || 0,
+            pendingRead: previous[c.id]?.pendingRead || [],
+          };
+        });
+        if (!channels[currentChannel]?.joined) currentChannel = "general";
+        switchChannel(currentChannel);
+      }
+
+      function channelLabel(c) {
+        if (c.kind === "dm") {
+          const other = (c.members || []).find((u) => u !== myUsername);
+          return "@ " + (other || myUsername);
+        }
+        return "# " + c.name;
+      }
+
+      function switchChannel(id) {
+        const channel = channels[id];
+        if (!channel || !channel.joined) return;
+        currentChannel = id;
+        document.getElementById("channel-title").textContent =
+          channelLabel(channel);
+        document.querySelectorAll(".msg-row").forEach((row) => {
+          row.classList.toggle("other-channel", row.dataset.channel !== id);
+        });
+        if (channel.pendingRead.length) {
+          sendFrame({ type: "mark_read", ids: channel.pendingRead });
+        }
+        channel.unread = 0;
+        channel.pendingRead = [];
+        if (replyToId && messageCache[replyToId]?.channel !== id) cancelReply();
+        updateTypingIndicator([]);
+        checkEmptyState();
+        renderChannelList();
+        const messages = document.getElementById("messages");
+        messages.scrollTop = messages.scrollHeight;
+        document.getElementById("channel-panel").style.display = "none";
+      }
+
+      function noteUnread(id, data) {
+        const channel = channels[id];
+        if (!channel) return;
+        channel.unread++;
+        channel.pendingRead.push(data.id);
+        renderChannelList();
+      }
+
+      function renderChannelList() {
+        const all = Object.values(channels);
+        const row = (c) => `
+          <div class="channel-item ${c.id === currentChannel ? "active" : ""}"
+               onclick="${c.joined ? "switchChannel" : "joinChannel"}('${c.id}')">
+            <span class="channel-name">${escapeHtml(channelLabel(c))}</span>
+            ${c.unread ? `<span class="channel-unread">${c.unread}</span>` : ""}
+            ${
+              c.joined && c.kind === "channel" && c.id !== "general"
+                ? `<button class="user-call-btn" title="Leave"
+                     onclick="event.stopPropagation(); leaveChannel('${c.id}')">
+                     <span class="material-icons">logout</span>
+                   </button>`
+                : ""
+            }
+            ${c.joined ? "" : '<span class="channel-join">Join</span>'}
+          </div>`;
+        const section = (title, items) =>
+          items.length
+            ? `<div class="channel-section">${title}</div>${items.map(row).join("")}`
+            : "";
+        document.getElementById("channel-list").innerHTML =
+          section(
+            "Channels",
+            all.filter((c) => c.kind === "channel" && c.joined),
+          ) +
+          section(
+            "Direct messages",
+            all.filter((c) => c.kind === "dm"),
+          ) +
+          section(
+            "Other channels",
+            all.filter((c) => c.kind === "channel" && !c.joined),
+          );
+        const unread = all.reduce(
+          (sum, c) => sum + (c.id === currentChannel ? 0 : c.unread),
+          0,
+        );
+        const badge = document.getElementById("channel-unread-total");
+        badge.textContent = unread;
+        badge.style.display = unread ? "inline-block" : "none";
+      }
+
+      function toggleChannelPanel() {
+        const panel = document.getElementById("channel-panel");
+        panel.style.display =
+          panel.style.display === "block" ? "none" : "block";
+      }
+
+      function createChannel(event) {
+        event.preventDefault();
+        const input = document.getElementById("channel-name-input");
+        const name = input.value.trim();
+        if (!name) return;
+        sendFrame({ type: "channel_create", name });
+        input.value = "";
+      }
+
+      function joinChannel(id) {
+        sendFrame({ type: "channel_join", channel: id });
+      }
+
+      function leaveChannel(id) {
+        sendFrame({ type: "channel_leave", channel: id });
+      }
+
+      function openDirectMessage(user) {
+        document.getElementById("online-panel").style.display = "none";
+        const existing = Object.values(channels).find(
+          (c) => c.kind === "dm" && (c.members || []).includes(user),
+        );
+        if (existing) switchChannel(existing.id);
+        else sendFrame({ type: "dm_open", user });
+      }
+
+      // The server subscribed us and follows up with the channel's history
+      function handleChannelAdded(data) {
+        const c = data.channel;
+        channels[c.id] = {
+          ...channels[c.id],
+          ...c,
+          unread: channels[c.id]?.unread || 0,
+          pendingRead: channels[c.id]?.pendingRead || [],
+        };
+        if (data.focus) switchChannel(c.id);
+        else renderChannelList();
+      }
+
+      function handleChannelRemoved(id) {
+        if (channels[id]) channels[id].joined = false;
+        document
+          .querySelectorAll(`.msg-row[data-channel="${CSS.escape(id)}"]`)
+          .forEach((row) => {
+            delete messageCache[row.id.slice(4)];
+            row.remove();
+          });
+        if (currentChannel === id) switchChannel("general");
+        else renderChannelList();
+      }
+
       // ===== FILE UPLOAD =====
       async function uploadFiles(inputElement) {
         const files = inputElement.files;
@@ -635,15 +1119,26 @@
         inputElement.value = "";
       }
 
+      // Mirrors MAX_FILE_SIZE in main.py - no point sending what the server will refuse
+      const MAX_UPLOAD_BYTES = 100 * 1024 * 1024;
+
       async function handleFileUpload(files) {
         const formData = new FormData();
+        let count = 0;
         for (let i = 0; i < files.length; i++) {
+          if (files[i].size > MAX_UPLOAD_BYTES) {
+            showToast(`${files[i].name} is larger than 100MB`, "error");
+            continue;
+          }
           formData.append("files", files[i]);
+          count++;
         }
+        if (count === 0) return;
         await uploadFormData(formData);
       }
 
       async function uploadFormData(formData) {
+        const channel = currentChannel; // where the upload was started
         const progress = document.getElementById("upload-progress");
         const fill = document.getElementById("progress-fill");
         progress.style.display = "block";
@@ -675,13 +1170,12 @@
               type = "image";
             else if (["mp4", "webm", "mov"].includes(ext)) type = "video";
 
-            ws.send(
-              JSON.stringify({
-                type,
-                content: fileData.filename,
-                reply_to: replyToId,
-              }),
-            );
+            sendFrame({
+              type,
+              content: fileData.filename,
+              reply_to: replyToId,
+              channel,
+            });
           });
 
           cancelReply();
@@ -735,23 +1229,122 @@
         const input = document.getElementById("messageInput");
         const text = input.value.trim();
         if (text && ws) {
-          ws.send(
-            JSON.stringify({
-              type: "text",
-              content: text,
-              reply_to: replyToId,
-            }),
-          );
+          sendFrame({
+            type: "text",
+            content: text,
+            reply_to: replyToId,
+            channel: currentChannel,
+          });
           playSound("sent");
           input.value = "";
           cancelReply();
           if (isTyping) {
             isTyping = false;
-            ws.send(JSON.stringify({ type: "typing_stop" }));
+            sendFrame({ type: "typing_stop", channel: currentChannel });
           }
         }
       }
 
+      // ===== VOICE NOTES =====
+      // Once the server has transcoded a voice note, messages carry `audio`
+      // (duration, waveform peaks, URL of the small Opus copy): the bubble is
+      // drawn from that and nothing is downloaded until play is pressed.
+      function renderVoiceNote(data) {
+        const original = `/media/${data.msg}`;
+        if (!data.audio) {
+          return `<audio src="${original}" controls class="voice-msg" style="height: 48px; width: 260px; margin: 4px 0; border-radius: 24px;"></audio>`;
+        }
+        const bars = (data.audio.peaks || [])
+          .map((peak) => `<span style="height: ${Math.max(8, peak)}%"></span>`)
+          .join("");
+        return `<div class="voice-note" data-duration="${data.audio.duration}">
+                    <button class="voice-play" onclick="toggleVoiceNote(this)">
+                        <span class="material-icons">play_arrow</span>
+                    </button>
+                    <div class="voice-wave" onclick="seekVoiceNote(event, this)">${bars}</div>
+                    <span class="voice-time">${formatVoiceTime(data.audio.duration)}</span>
+                    <audio preload="none" src="${data.audio.src || original}" data-fallback="${original}"
+                        onerror="voiceNoteFallback(this)" ontimeupdate="updateVoiceNote(this)"
+                        onended="voiceNoteEnded(this)"></audio>
+                </div>`;
+      }
+
+      function formatVoiceTime(seconds) {
+        const total = Math.round(seconds || 0);
+        return `${Math.floor(total / 60)}:${String(total % 60).padStart(2, "0")}`;
+      }
+
+      function toggleVoiceNote(button) {
+        const audio = button.parentElement.querySelector("audio");
+        if (!audio.paused) {
+          audio.pause();
+          button.firstElementChild.textContent = "play_arrow";
+          return;
+        }
+        document.querySelectorAll(".voice-note audio").forEach((other) => {
+          if (other !== audio && !other.paused) {
+            other.pause();
+            other.parentElement.querySelector(".voice-play .material-icons").textContent =
+              "play_arrow";
+          }
+        });
+        button.firstElementChild.textContent = "pause";
+        audio.play().catch(() => {
+          button.firstElementChild.textContent = "play_arrow";
+        });
+      }
+
+      function seekVoiceNote(event, wave) {
+        const note = wave.parentElement;
+        const audio = note.querySelector("audio");
+        const rect = wave.getBoundingClientRect();
+        const fraction = Math.min(1, Math.max(0, (event.clientX - rect.left) / rect.width));
+        const duration = isFinite(audio.duration)
+          ? audio.duration
+          : parseFloat(note.dataset.duration);
+        audio.currentTime = fraction * duration;
+        if (audio.paused) toggleVoiceNote(note.querySelector(".voice-play"));
+      }
+
+      function updateVoiceNote(audio) {
+        const note = audio.parentElement;
+        const duration = isFinite(audio.duration)
+          ? audio.duration
+          : parseFloat(note.dataset.duration);
+        const bars = note.querySelectorAll(".voice-wave span");
+        const played = duration ? (audio.currentTime / duration) * bars.length : 0;
+        bars.forEach((bar, i) => bar.classList.toggle("played", i < played));
+        note.querySelector(".voice-time").textContent = formatVoiceTime(audio.currentTime);
+      }
+
+      function voiceNoteEnded(audio) {
+        const note = audio.parentElement;
+        note.querySelector(".voice-play .material-icons").textContent = "play_arrow";
+        note
+          .querySelectorAll(".voice-wave span")
+          .forEach((bar) => bar.classList.remove("played"));
+        note.querySelector(".voice-time").textContent = formatVoiceTime(note.dataset.duration);
+      }
+
+      function voiceNoteFallback(audio) {
+        // The Opus copy is missing (e.g. restored from a backup): play the upload
+        const fallback = audio.dataset.fallback;
+        if (!fallback) return;
+        delete audio.dataset.fallback;
+        const playing = audio.parentElement.querySelector(".voice-play .material-icons")
+          .textContent === "pause";
+        audio.src = fallback;
+        if (playing) audio.play().catch(() => {});
+      }
+
+      function handleMediaUpdate(data) {
+        const cached = messageCache[data.id];
+        if (!cached || !data.audio) return;
+        cached.audio = data.audio;
+        const player = document.querySelector(`#row-${data.id} .voice-msg`);
+        if (player && player.paused) player.outerHTML = renderVoiceNote(cached);
+      }
+
       // ===== MESSAGE BUBBLE =====
       function addMessageBubble(data) {
         messageCache[data.id] = data;
@@ -760,6 +1353,8 @@
         row.id = "row-" + data.id;
         const isMe = data.user === myUsername;
         row.className = "msg-row " + (isMe ? "right-row" : "left-row");
+        row.dataset.channel = data.channel || "general";
+        if (row.dataset.channel !== currentChannel) row.classList.add("other-channel");
 
         const timeStr = new Date(data.timestamp).toLocaleTimeString([], {
           hour: "2-digit",
@@ -786,10 +1381,11 @@
 
         if (data.type === "image") {
           const thumbSrc = `/thumbs/${data.msg}`;
-          const fullSrc = `/media/${data.msg}`;
+          // Chat-sized copy; the server falls back to the original for small images
+          const displaySrc = `/display/${data.msg}`;
           contentHtml = `<img src="${thumbSrc}" class="media-preview" 
-                    onclick="openLightbox('${fullSrc}')" 
-                    onerror="this.src='${fullSrc}'">`;
+                    onclick="openLightbox('${displaySrc}')" 
+                    onerror="this.src='${displaySrc}'">`;
           actionBar = getActionBar(data.msg);
         } else if (data.type === "video") {
           contentHtml = `<video src="/media/${data.msg}" class="media-preview video" controls preload="metadata"></video>`;
@@ -813,7 +1409,7 @@
                     </div>`;
           actionBar = getActionBar(data.msg);
         } else if (data.type === "voice") {
-          contentHtml = `<audio src="/media/${data.msg}" controls class="voice-msg" style="height: 48px; width: 260px; margin: 4px 0; border-radius: 24px;"></audio>`;
+          contentHtml = renderVoiceNote(data);
         } else {
           contentHtml = `<div class="text-content">${escapeHtml(
             data.msg,
@@ -1051,9 +1647,7 @@
       function saveEdit() {
         const val = document.getElementById("edit-input").value.trim();
         if (val && currentEditId && ws) {
-          ws.send(
-            JSON.stringify({ type: "edit", id: currentEditId, content: val }),
-          );
+          sendFrame({ type: "edit", id: currentEditId, content: val });
         }
         closeEditModal();
       }
@@ -1062,7 +1656,7 @@
       function deleteSingle(id) {
         hideContextMenu();
         if (confirm("Delete this message?")) {
-          ws?.send(JSON.stringify({ type: "delete", ids: [id] }));
+          sendFrame({ type: "delete", ids: [id] });
         }
       }
 
@@ -1107,7 +1701,7 @@
           document.querySelectorAll(".select-checkbox:checked"),
         ).map((c) => c.value);
         if (ids.length > 0 && confirm(`Delete ${ids.length} message(s)?`)) {
-          ws?.send(JSON.stringify({ type: "delete", ids }));
+          sendFrame({ type: "delete", ids });
         }
       }
 
@@ -1134,11 +1728,11 @@
         if (fromGallery && galleryMedia.length > 0) {
           lightboxImages = galleryMedia
             .filter((m) => m.type === "image")
-            .map((m) => m.media_url);
+            .map((m) => m.display_url || m.media_url);
         } else {
           lightboxImages = Array.from(
             document.querySelectorAll(".media-preview:not(.video)"),
-          ).map((img) => img.src.replace("/thumbs/", "/media/"));
+          ).map((img) => new URL(img.src).pathname.replace("/thumbs/", "/display/"));
         }
 
         currentLightboxIndex = lightboxImages.indexOf(src);
@@ -1174,14 +1768,19 @@
         document.getElementById("lightbox").style.display = "none";
       }
 
+      // Open/save always fetch the full-resolution original
+      function originalImageUrl(src) {
+        return src.replace("/display/", "/media/");
+      }
+
       function openCurrentImage() {
-        window.open(lightboxImages[currentLightboxIndex], "_blank");
+        window.open(originalImageUrl(lightboxImages[currentLightboxIndex]), "_blank");
       }
 
       function saveCurrentImage() {
         const link = document.createElement("a");
-        link.href = lightboxImages[currentLightboxIndex];
-        link.download = lightboxImages[currentLightboxIndex].split("/").pop();
+        link.href = originalImageUrl(lightboxImages[currentLightboxIndex]);
+        link.download = link.href.split("/").pop();
         link.click();
       }
 
@@ -1206,6 +1805,7 @@
       let galleryMedia = [];
       let galleryFilter = "all";
       let gallerySort = "newest";
+      let gallerySelecting = false;
 
       async function openGallery() {
         document.getElementById("media-gallery").style.display = "flex";
@@ -1223,12 +1823,13 @@
           '<div class="gallery-loading"><div class="spinner"></div><div style="margin-top:16px;">Loading media...</div></div>';
 
         try {
-          const params = new URLSearchParams();
+          const params = new URLSearchParams({ user: myUsername, token: sessionToken || "" });
           if (galleryFilter !== "all")
             params.append("media_type", galleryFilter);
           params.append("sort", gallerySort);
 
           const response = await fetch(`/api/media?${params}`);
+          if (!response.ok) throw new Error(`HTTP ${response.status}`);
           const data = await response.json();
           galleryMedia = data.media;
 
@@ -1261,16 +1862,20 @@
         let html = "";
         for (const [dateLabel, items] of Object.entries(groups)) {
           html += `<div class="gallery-date-group">
-            <div class="gallery-date-header">${dateLabel}</div>
+            <div class="gallery-date-header">${dateLabel}
+              <button onclick="downloadGalleryGroup(this)" title="Download these as ZIP">
+                <span class="material-icons">download</span>
+              </button>
+            </div>
             <div class="gallery-grid">`;
 
           items.forEach((item) => {
             const thumbSrc = item.thumb_url || item.media_url;
             const isVideo = item.type === "video";
 
-            html += `<div class="gallery-item" onclick="openGalleryItem('${
-              item.media_url
-            }', '${item.type}')">
+            html += `<div class="gallery-item" data-id="${item.id}" onclick="openGalleryItem('${
+              item.display_url || item.media_url
+            }', '${item.type}', this)">
               ${
                 isVideo
                   ? `<video src="${item.media_url}" muted></video>`
@@ -1298,6 +1903,7 @@
         }
 
         content.innerHTML = html;
+        updateGallerySelection();
       }
 
       function getDateLabel(date) {
@@ -1314,7 +1920,12 @@
         });
       }
 
-      function openGalleryItem(url, type) {
+      function openGalleryItem(url, type, element) {
+        if (gallerySelecting && element) {
+          element.classList.toggle("selected");
+          updateGallerySelection();
+          return;
+        }
         if (type === "video") {
           window.open(url, "_blank");
         } else {
@@ -1329,6 +1940,85 @@
         link.click();
       }
 
+      // ZIP downloads: the server streams the archive, so the form posts into
+      // a hidden frame and the browser saves it like any other download
+      const ARCHIVE_MAX_FILES = 5000;
+
+      function toggleGallerySelect() {
+        gallerySelecting = !gallerySelecting;
+        document
+          .getElementById("media-gallery")
+          .classList.toggle("selecting", gallerySelecting);
+        document
+          .getElementById("gallery-select-btn")
+          .classList.toggle("active", gallerySelecting);
+        if (!gallerySelecting) {
+          document
+            .querySelectorAll(".gallery-item.selected")
+            .forEach((el) => el.classList.remove("selected"));
+        }
+        updateGallerySelection();
+      }
+
+      function updateGallerySelection() {
+        const count = document.querySelectorAll(".gallery-item.selected").length;
+        document.getElementById("gallery-selected-count").textContent = count
+          ? count
+          : "";
+      }
+
+      function downloadGallerySelection() {
+        const selected = document.querySelectorAll(".gallery-item.selected");
+        const ids = selected.length
+          ? Array.from(selected, (el) => el.dataset.id)
+          : galleryMedia.map((item) => item.id);
+        downloadGalleryZip(ids);
+      }
+
+      function downloadGalleryGroup(button) {
+        const items = button
+          .closest(".gallery-date-group")
+          .querySelectorAll(".gallery-item[data-id]");
+        downloadGalleryZip(Array.from(items, (el) => el.dataset.id));
+      }
+
+      function downloadGalleryZip(ids) {
+        if (ids.length === 0) {
+          showToast("Nothing to download", "error");
+          return;
+        }
+        if (ids.length > ARCHIVE_MAX_FILES) {
+          showToast(`At most ${ARCHIVE_MAX_FILES} files per download`, "error");
+          return;
+        }
+        let frame = document.getElementById("archive-frame");
+        if (!frame) {
+          frame = document.createElement("iframe");
+          frame.id = frame.name = "archive-frame";
+          frame.style.display = "none";
+          document.body.appendChild(frame);
+        }
+        const form = document.createElement("form");
+        form.method = "POST";
+        form.action = "/api/media/archive";
+        form.target = "archive-frame";
+        const fields = { user: myUsername, token: sessionToken || "", ids: ids.join(",") };
+        for (const [name, value] of Object.entries(fields)) {
+          const field = document.createElement("input");
+          field.type = "hidden";
+          field.name = name;
+          field.value = value;
+          form.appendChild(field);
+        }
+        document.body.appendChild(form);
+        form.submit();
+        form.remove();
+        showToast(
+          `Downloading ${ids.length} file${ids.length === 1 ? "" : "s"} as ZIP`,
+          "success",
+        );
+      }
+
       function filterGallery(filter) {
         galleryFilter = filter;
         document.querySelectorAll(".gallery-filter").forEach((btn) => {
@@ -1407,7 +2097,8 @@
 
       // ===== EMPTY STATE =====
       function checkEmptyState() {
-        const hasMessages = document.querySelectorAll(".msg-row").length > 0;
+        const hasMessages =
+          document.querySelectorAll(".msg-row:not(.other-channel)").length > 0;
         document.getElementById("empty-state").style.display = hasMessages
           ? "none"
           : "flex";
@@ -1428,6 +2119,12 @@
         ) {
           document.getElementById("online-panel").style.display = "none";
         }
+        if (
+          !e.target.closest("#channel-panel") &&
+          !e.target.closest('[onclick*="toggleChannelPanel"]')
+        ) {
+          document.getElementById("channel-panel").style.display = "none";
+        }
         if (
           !e.target.closest("#emoji-picker") &&
           !e.target.closest('[onclick*="toggleEmojiPicker"]')
@@ -1462,10 +2159,12 @@
       }
 
       function selectAllMessages() {
-        document.querySelectorAll(".select-checkbox").forEach((c) => {
-          c.checked = true;
-          c.closest(".msg-row").classList.add("selected");
-        });
+        document
+          .querySelectorAll(".msg-row:not(.other-channel) .select-checkbox")
+          .forEach((c) => {
+            c.checked = true;
+            c.closest(".msg-row").classList.add("selected");
+          });
         updateCount();
       }
 
@@ -1555,6 +2254,16 @@
                 )}', 'video')" title="Video Call">
                   <span class="material-icons">videocam</span>
                 </button>
+                <button class="user-call-btn" onclick="pickDirectFile('${escapeHtml(
+                  u,
+                )}')" title="Send File Directly">
+                  <span class="material-icons">upload_file</span>
+                </button>
+                <button class="user-call-btn" onclick="openDirectMessage('${escapeHtml(
+                  u,
+                )}')" title="Message Privately">
+                  <span class="material-icons">chat</span>
+                </button>
               </div>
             `
                 : ""
@@ -1795,13 +2504,11 @@
         // Handle ICE candidates
         peerConnection.onicecandidate = (event) => {
           if (event.candidate && currentCall) {
-            ws?.send(
-              JSON.stringify({
-                type: "ice_candidate",
-                to: currentCall.with,
-                candidate: event.candidate,
-              }),
-            );
+            sendFrame({
+              type: "ice_candidate",
+              to: currentCall.with,
+              candidate: event.candidate,
+            });
           }
         };
 
@@ -1873,13 +2580,11 @@
         document.getElementById("outgoing-call-name").textContent = username;
         document.getElementById("outgoing-call-modal").style.display = "flex";
 
-        ws?.send(
-          JSON.stringify({
-            type: "call_initiate",
-            to: username,
-            callType: callType,
-          }),
-        );
+        sendFrame({
+          type: "call_initiate",
+          to: username,
+          callType: callType,
+        });
 
         document.getElementById("online-panel").style.display = "none";
         currentCall.status = "ringing";
@@ -1913,7 +2618,7 @@
       }
 
       function rejectIncomingCall(user) {
-        ws?.send(JSON.stringify({ type: "call_reject", to: user }));
+        sendFrame({ type: "call_reject", to: user });
         document.getElementById("incoming-call-modal").style.display = "none";
         stopRingtone();
       }
@@ -2037,12 +2742,10 @@
           handleWebRTCOffer(fromUserToProcess, offerToProcess);
         }
 
-        ws?.send(
-          JSON.stringify({
-            type: "call_accept",
-            to: currentCall.with,
-          }),
-        );
+        sendFrame({
+          type: "call_accept",
+          to: currentCall.with,
+        });
 
         startActiveCall();
 
@@ -2093,12 +2796,10 @@
           return;
         }
 
-        ws?.send(
-          JSON.stringify({
-            type: "call_reject",
-            to: currentCall.with,
-          }),
-        );
+        sendFrame({
+          type: "call_reject",
+          to: currentCall.with,
+        });
 
         cleanupCall();
         clearIncomingCallModal();
@@ -2115,12 +2816,10 @@
       function cancelCall() {
         if (!currentCall) return;
 
-        ws?.send(
-          JSON.stringify({
-            type: "call_cancel",
-            to: currentCall.with,
-          }),
-        );
+        sendFrame({
+          type: "call_cancel",
+          to: currentCall.with,
+        });
 
         cleanupCall();
         document.getElementById("outgoing-call-modal").style.display = "none";
@@ -2135,13 +2834,11 @@
           const offer = await peerConnection.createOffer();
           await peerConnection.setLocalDescription(offer);
 
-          ws?.send(
-            JSON.stringify({
-              type: "webrtc_offer",
-              to: currentCall.with,
-              offer: offer,
-            }),
-          );
+          sendFrame({
+            type: "webrtc_offer",
+            to: currentCall.with,
+            offer: offer,
+          });
         } catch (err) {
           console.error("Error creating offer:", err);
           endCall();
@@ -2172,13 +2869,11 @@
           await peerConnection.setLocalDescription(answer);
 
           console.log("Sending WebRTC answer");
-          ws?.send(
-            JSON.stringify({
-              type: "webrtc_answer",
-              to: fromUser,
-              answer: answer,
-            }),
-          );
+          sendFrame({
+            type: "webrtc_answer",
+            to: fromUser,
+            answer: answer,
+          });
         } catch (err) {
           console.error("Error handling offer:", err);
         }
@@ -2310,12 +3005,10 @@
       function endCall() {
         if (!currentCall) return;
 
-        ws?.send(
-          JSON.stringify({
-            type: "call_end",
-            to: currentCall.with,
-          }),
-        );
+        sendFrame({
+          type: "call_end",
+          to: currentCall.with,
+        });
 
         cleanupCall();
         closeAllCallModals();
@@ -2529,14 +3222,22 @@
       function inviteToCall(username) {
         if (!currentCall || invitedUsers.has(username)) return;
 
+        if (sfuAvailable) {
+          // A 1:1 mesh can't carry a third person: move both of us plus the
+          // invitee onto the server's SFU, then hang up the direct call
+          invitedUsers.add(username);
+          closeAddPersonModal();
+          startGroupCall([currentCall.with, username], currentCall.type);
+          endCall();
+          return;
+        }
+
         // Send call invitation to the user
-        ws?.send(
-          JSON.stringify({
-            type: "call_initiate",
-            to: username,
-            callType: currentCall.type,
-          }),
-        );
+        sendFrame({
+          type: "call_initiate",
+          to: username,
+          callType: currentCall.type,
+        });
 
         invitedUsers.add(username);
         renderAddPersonList(onlineUsers);
@@ -2586,6 +3287,543 @@
         showToast(isCameraOn ? "Camera on" : "Camera off");
       }
 
+      // ===== DIRECT FILE TRANSFER (P2P) =====
+      // A 1:1 send can skip the server: the file goes over a WebRTC data
+      // channel between the two browsers and /ws only carries the handshake
+      // (p2p_file_offer / accept / cancel, p2p_signal for SDP and ICE).
+      // If the connection drops, the sender re-offers the same file and the
+      // receiver accepts at the byte offset it already has.
+      const P2P_CHUNK_BYTES = 64 * 1024; // largest message every browser accepts
+      const P2P_READ_BYTES = 1024 * 1024; // file is read from disk in blocks this big
+      const P2P_BUFFER_HIGH = 8 * 1024 * 1024; // stop queueing above this...
+      const P2P_BUFFER_LOW = 1024 * 1024; // ...until the channel drains below this
+      const P2P_BLOB_FLUSH_BYTES = 16 * 1024 * 1024; // let the browser page received data to disk
+      const P2P_MAX_RETRIES = 3;
+      const outgoingTransfers = new Map(); // transfer id -> { to, file, pc, offset, retries, ui }
+      const incomingTransfers = new Map(); // transfer id -> { from, key, meta, download, pc }
+      const partialDownloads = new Map(); // "from|name|size|modified" -> { parts, pending, received, ui }
+
+      function newTransferId() {
+        // crypto.randomUUID() needs HTTPS; direct sends also work on plain HTTP
+        return Date.now().toString(36) + Math.random().toString(36).slice(2, 10);
+      }
+
+      function pickDirectFile(username) {
+        const input = document.createElement("input");
+        input.type = "file";
+        input.onchange = () => {
+          const file = input.files[0];
+          if (!file) return;
+          const storeCopy =
+            file.size <= MAX_UPLOAD_BYTES &&
+            confirm(
+              `Also keep a copy of ${file.name} on the server?\n\nIt will show up in the chat for everyone.`,
+            );
+          sendFileDirect(username, file, storeCopy);
+        };
+        input.click();
+      }
+
+      function sendFileDirect(username, file, storeCopy = false) {
+        if (storeCopy) {
+          const formData = new FormData();
+          formData.append("files", file);
+          uploadFormData(formData);
+        }
+        const transfer = { to: username, file, retries: 0 };
+        transfer.ui = transferProgress(
+          `Sending ${file.name} to ${username}`,
+          () => cancelOutgoing(transfer, "cancelled"),
+        );
+        offerDirectFile(transfer);
+      }
+
+      function offerDirectFile(transfer) {
+        const { file } = transfer;
+        transfer.id = newTransferId();
+        transfer.pc = null;
+        outgoingTransfers.set(transfer.id, transfer);
+        sendFrame({
+          type: "p2p_file_offer",
+          to: transfer.to,
+          transfer: transfer.id,
+          name: file.name,
+          size: file.size,
+          mime: file.type,
+          modified: file.lastModified,
+        });
+      }
+
+      function createTransferConnection(peer, transferId) {
+        const pc = new RTCPeerConnection(iceServers);
+        pc.onicecandidate = (e) => {
+          if (e.candidate) sendP2pSignal(peer, transferId, { candidate: e.candidate });
+        };
+        return pc;
+      }
+
+      function sendP2pSignal(to, transferId, fields) {
+        sendFrame({ type: "p2p_signal", to, transfer: transferId, ...fields });
+      }
+
+      async function handleP2pFileAccept(data) {
+        const transfer = outgoingTransfers.get(data.transfer);
+        if (!transfer || transfer.pc || data.from !== transfer.to) return;
+        transfer.offset = Math.max(0, Math.min(Number(data.offset) || 0, transfer.file.size));
+
+        const pc = (transfer.pc = createTransferConnection(transfer.to, transfer.id));
+        pc.onconnectionstatechange = () => {
+          if (pc.connectionState === "failed") finishOutgoing(transfer, false);
+        };
+        const channel = pc.createDataChannel("file", { ordered: true });
+        channel.binaryType = "arraybuffer";
+        channel.bufferedAmountLowThreshold = P2P_BUFFER_LOW;
+        channel.onopen = () => pumpFile(transfer, channel);
+        channel.onmessage = (e) => {
+          if (e.data === "done") finishOutgoing(transfer, true);
+        };
+        channel.onclose = () => finishOutgoing(transfer, false);
+
+        await pc.setLocalDescription(await pc.createOffer());
+        sendP2pSignal(transfer.to, transfer.id, { description: pc.localDescription });
+      }
+
+      async function pumpFile(transfer, channel) {
+        const { file } = transfer;
+        try {
+          while (transfer.offset < file.size && channel.readyState === "open") {
+            // Flow control: never let the SCTP send queue grow without bound
+            if (channel.bufferedAmount > P2P_BUFFER_HIGH) {
+              await new Promise((resolve) => (channel.onbufferedamountlow = resolve));
+              continue;
+            }
+            const end = Math.min(transfer.offset + P2P_READ_BYTES, file.size);
+            const block = await file.slice(transfer.offset, end).arrayBuffer();
+            for (let pos = 0; pos < block.byteLength; pos += P2P_CHUNK_BYTES) {
+              const length = Math.min(P2P_CHUNK_BYTES, block.byteLength - pos);
+              channel.send(new Uint8Array(block, pos, length));
+            }
+            transfer.offset = end;
+            updateTransferProgress(transfer.ui, end / file.size);
+          }
+        } catch (err) {
+          // Channel closed under us: onclose schedules the resume
+        }
+      }
+
+      function finishOutgoing(transfer, complete) {
+        if (outgoingTransfers.get(transfer.id) !== transfer) return;
+        outgoingTransfers.delete(transfer.id);
+        transfer.pc?.close();
+
+        const { file, to } = transfer;
+        if (complete) {
+          endTransferProgress(transfer.ui, `Sent ${file.name} to ${to}`, "success");
+        } else if (transfer.retries < P2P_MAX_RETRIES && onlineUsers.includes(to)) {
+          transfer.retries++;
+          setTimeout(() => transfer.cancelled || offerDirectFile(transfer), 2000);
+        } else {
+          sendFrame({ type: "p2p_file_cancel", to, transfer: transfer.id, reason: "failed" });
+          endTransferProgress(transfer.ui, `Couldn't send ${file.name} to ${to}`, "error");
+        }
+      }
+
+      function cancelOutgoing(transfer, reason) {
+        if (outgoingTransfers.get(transfer.id) === transfer) {
+          outgoingTransfers.delete(transfer.id);
+          transfer.pc?.close();
+          sendFrame({ type: "p2p_file_cancel", to: transfer.to, transfer: transfer.id, reason });
+        }
+        transfer.cancelled = true; // a pending retry timer must not revive it
+        const verb = reason === "declined" ? "declined" : "cancelled";
+        endTransferProgress(transfer.ui, `${transfer.file.name}: ${verb}`, "error");
+      }
+
+      function handleP2pFileOffer(data) {
+        const key = `${data.from}|${data.name}|${data.size}|${data.modified}`;
+        const partial = partialDownloads.get(key);
+        // A re-offer of something we already have part of is the sender resuming
+        if (
+          !partial &&
+          !confirm(
+            `${data.from} wants to send you ${data.name} (${formatBytes(data.size)}) directly. Accept?`,
+          )
+        ) {
+          sendFrame({
+            type: "p2p_file_cancel",
+            to: data.from,
+            transfer: data.transfer,
+            reason: "declined",
+          });
+          return;
+        }
+
+        // The previous attempt may not have noticed its connection died yet
+        for (const incoming of incomingTransfers.values()) {
+          if (incoming.key === key) finishIncoming(incoming, false);
+        }
+        const download = partial || {
+          from: data.from,
+          parts: [],
+          pending: [],
+          pendingBytes: 0,
+          received: 0,
+        };
+        if (!download.ui) {
+          download.ui = transferProgress(`Receiving ${data.name} from ${data.from}`, () =>
+            cancelIncoming(key),
+          );
+        }
+        download.transfer = data.transfer; // the sender's current attempt
+        const incoming = { from: data.from, key, meta: data, download, pc: null };
+        partialDownloads.set(key, download);
+        incomingTransfers.set(data.transfer, incoming);
+        sendFrame({
+          type: "p2p_file_accept",
+          to: data.from,
+          transfer: data.transfer,
+          offset: download.received,
+        });
+      }
+
+      async function handleP2pSignal(data) {
+        const outgoing = outgoingTransfers.get(data.transfer);
+        if (outgoing) {
+          if (!outgoing.pc || data.from !== outgoing.to) return;
+          if (data.description) await outgoing.pc.setRemoteDescription(data.description);
+          if (data.candidate) await outgoing.pc.addIceCandidate(data.candidate).catch(() => {});
+          return;
+        }
+
+        const incoming = incomingTransfers.get(data.transfer);
+        if (!incoming || data.from !== incoming.from) return;
+        if (!incoming.pc) {
+          const pc = (incoming.pc = createTransferConnection(data.from, data.transfer));
+          pc.ondatachannel = (e) => receiveFile(incoming, e.channel);
+          pc.onconnectionstatechange = () => {
+            if (pc.connectionState === "failed") finishIncoming(incoming, false);
+          };
+        }
+        if (data.description) {
+          await incoming.pc.setRemoteDescription(data.description);
+          await incoming.pc.setLocalDescription(await incoming.pc.createAnswer());
+          sendP2pSignal(data.from, data.transfer, { description: incoming.pc.localDescription });
+        }
+        if (data.candidate) await incoming.pc.addIceCandidate(data.candidate).catch(() => {});
+      }
+
+      function receiveFile(incoming, channel) {
+        const { download, meta } = incoming;
+        const checkComplete = () => {
+          if (download.received < meta.size) return;
+          channel.send("done");
+          finishIncoming(incoming, true);
+        };
+        channel.binaryType = "arraybuffer";
+        channel.onopen = checkComplete; // empty files
+        channel.onmessage = (e) => {
+          download.pending.push(e.data);
+          download.pendingBytes += e.data.byteLength;
+          download.received += e.data.byteLength;
+          if (download.pendingBytes >= P2P_BLOB_FLUSH_BYTES) {
+            // Blobs can live on disk; a pile of ArrayBuffers can't
+            download.parts.push(new Blob(download.pending));
+            download.pending = [];
+            download.pendingBytes = 0;
+          }
+          updateTransferProgress(download.ui, download.received / meta.size);
+          checkComplete();
+        };
+        channel.onclose = () => finishIncoming(incoming, false);
+      }
+
+      function finishIncoming(incoming, complete) {
+        const { meta, download } = incoming;
+        if (incomingTransfers.get(meta.transfer) !== incoming) {
+          incoming.pc?.close(); // channel closing after a completed transfer
+          return;
+        }
+        incomingTransfers.delete(meta.transfer);
+        if (!complete) {
+          // Keep what we have: the sender re-offers and we resume from here
+          incoming.pc?.close();
+          return;
+        }
+
+        partialDownloads.delete(incoming.key);
+        const blob = new Blob([...download.parts, ...download.pending], {
+          type: meta.mime || "application/octet-stream",
+        });
+        const url = URL.createObjectURL(blob);
+        const link = document.createElement("a");
+        link.href = url;
+        link.download = meta.name;
+        link.click();
+        setTimeout(() => URL.revokeObjectURL(url), 60000);
+        endTransferProgress(download.ui, `Received ${meta.name} from ${incoming.from}`, "success");
+      }
+
+      function cancelIncoming(key) {
+        const download = partialDownloads.get(key);
+        if (!download) return;
+        partialDownloads.delete(key);
+        const incoming = incomingTransfers.get(download.transfer);
+        if (incoming) {
+          incomingTransfers.delete(download.transfer);
+          incoming.pc?.close();
+        }
+        sendFrame({
+          type: "p2p_file_cancel",
+          to: download.from,
+          transfer: download.transfer,
+          reason: "cancelled",
+        });
+        endTransferProgress(download.ui, "Transfer cancelled", "error");
+      }
+
+      function handleP2pFileCancel(data) {
+        const outgoing = outgoingTransfers.get(data.transfer);
+        if (outgoing && data.from === outgoing.to) {
+          outgoingTransfers.delete(data.transfer);
+          outgoing.pc?.close();
+          cancelOutgoing(outgoing, data.reason);
+          return;
+        }
+        for (const [key, download] of partialDownloads) {
+          if (download.transfer !== data.transfer || download.from !== data.from) continue;
+          partialDownloads.delete(key);
+          const incoming = incomingTransfers.get(data.transfer);
+          if (incoming) {
+            incomingTransfers.delete(data.transfer);
+            incoming.pc?.close();
+          }
+          endTransferProgress(download.ui, `${data.from} stopped sending the file`, "error");
+        }
+      }
+
+      function transferProgress(label, onCancel) {
+        const el = document.createElement("div");
+        el.className = "toast p2p-transfer";
+        el.innerHTML = `
+          <div class="p2p-transfer-row">
+            <span class="p2p-transfer-label"></span>
+            <button class="p2p-transfer-cancel" title="Cancel">
+              <span class="material-icons">close</span>
+            </button>
+          </div>
+          <div class="progress-bar"><div class="progress-fill"></div></div>`;
+        el.querySelector(".p2p-transfer-label").textContent = label;
+        el.querySelector(".p2p-transfer-cancel").onclick = onCancel;
+        document.getElementById("toast-container").appendChild(el);
+        return el;
+      }
+
+      function updateTransferProgress(el, fraction) {
+        const percent = Math.floor(fraction * 100);
+        if (el.dataset.percent === String(percent)) return;
+        el.dataset.percent = percent;
+        el.querySelector(".progress-fill").style.width = percent + "%";
+      }
+
+      function endTransferProgress(el, message, type) {
+        if (!el.isConnected) return;
+        el.remove();
+        showToast(message, type);
+      }
+
+      // ===== GROUP CALLS (SFU) =====
+      // With an SFU on the server each phone uploads its camera/mic once and
+      // the server forwards it to everyone else. The server always sends the
+      // offer; we only answer, so renegotiation (people joining/leaving) never
+      // collides with anything we do.
+      let sfuAvailable = false;
+      let groupCall = null; // { room, type, pc, stream, streams: {mid: user}, published }; room is null until sfu_joined
+
+      function startGroupCall(invitees, callType) {
+        // The server names the room (see sfu_joined) and admits only invitees
+        return joinGroupCall(null, callType, invitees);
+      }
+
+      async function joinGroupCall(room, callType, invite = []) {
+        if (groupCall) return;
+        const stream = await getUserMediaStream(callType);
+        if (!stream) return;
+        // Everyone's video is re-sent to everyone: keep each upload small
+        stream.getVideoTracks().forEach((track) =>
+          track
+            .applyConstraints({
+              width: { ideal: 640 },
+              height: { ideal: 360 },
+              frameRate: { max: 24 },
+            })
+            .catch(() => {}),
+        );
+
+        groupCall = {
+          room,
+          type: callType,
+          // LAN only: no STUN, so ICE gathering finishes immediately
+          pc: new RTCPeerConnection({
+            bundlePolicy: "max-bundle",
+            rtcpMuxPolicy: "require",
+          }),
+          stream,
+          streams: {},
+          published: false,
+        };
+        groupCall.pc.ontrack = () => refreshGroupTiles();
+        groupCall.pc.onconnectionstatechange = () => {
+          if (groupCall?.pc.connectionState === "failed") {
+            showToast("Group call connection lost", "error");
+            leaveGroupCall();
+          }
+        };
+
+        showGroupCallView();
+        sendFrame({ type: "sfu_join", room, invite, callType });
+      }
+
+      function handleSfuInvite(data) {
+        if (groupCall) return;
+        if (currentCall && currentCall.with === data.from) {
+          // Our 1:1 call is being upgraded: follow it into the group call
+          joinGroupCall(data.room, data.callType);
+          return;
+        }
+        if (confirm(`${data.from} invites you to a group ${data.callType} call. Join?`)) {
+          joinGroupCall(data.room, data.callType);
+        }
+      }
+
+      async function handleSfuOffer(data) {
+        if (!groupCall || data.room !== groupCall.room) return;
+        const { pc, stream } = groupCall;
+        groupCall.streams = data.streams || {};
+        await pc.setRemoteDescription({ type: "offer", sdp: data.sdp });
+        if (!groupCall.published) {
+          // addTrack() reuses the first matching transceivers, which are the
+          // SFU's receive-only uplink slots at the top of the first offer
+          stream.getTracks().forEach((track) => pc.addTrack(track, stream));
+          groupCall.published = true;
+        }
+        await pc.setLocalDescription(await pc.createAnswer());
+        await waitForIceGathering(pc);
+        sendFrame({
+          type: "sfu_answer",
+          room: groupCall.room,
+          sdp: pc.localDescription.sdp,
+        });
+        refreshGroupTiles();
+      }
+
+      function waitForIceGathering(pc, timeoutMs = 2000) {
+        if (pc.iceGatheringState === "complete") return Promise.resolve();
+        return new Promise((resolve) => {
+          const done = () => {
+            pc.removeEventListener("icegatheringstatechange", check);
+            resolve();
+          };
+          const check = () => pc.iceGatheringState === "complete" && done();
+          pc.addEventListener("icegatheringstatechange", check);
+          setTimeout(done, timeoutMs);
+        });
+      }
+
+      function showGroupCallView() {
+        let view = document.getElementById("group-call-view");
+        if (!view) {
+          view = document.createElement("div");
+          view.id = "group-call-view";
+          view.innerHTML = `
+            <div class="group-call-header">
+              <span class="material-icons">groups</span>
+              <span id="group-call-count">1 in call</span>
+            </div>
+            <div id="group-call-grid"></div>
+            <div class="video-call-controls">
+              <button class="call-action-btn call-mute" id="group-mute-btn" onclick="toggleGroupMute()">
+                <span class="material-icons">mic</span>
+              </button>
+              <button class="call-action-btn call-reject" onclick="leaveGroupCall()">
+                <span class="material-icons">call_end</span>
+              </button>
+            </div>`;
+          document.body.appendChild(view);
+        }
+        const grid = document.getElementById("group-call-grid");
+        grid.innerHTML = `<div class="group-tile self">
+            <video autoplay playsinline muted></video>
+            <span class="group-tile-name">You</span>
+          </div>`;
+        grid.querySelector("video").srcObject = groupCall.stream;
+        view.style.display = "flex";
+      }
+
+      // Rebuild "who is on which tile" from the transceivers; the SFU recycles
+      // slots when people leave, so a mid can change owner between offers
+      function refreshGroupTiles() {
+        if (!groupCall) return;
+        const byUser = {};
+        groupCall.pc.getTransceivers().forEach((t) => {
+          const user = groupCall.streams[t.mid];
+          if (!user || !t.receiver.track) return;
+          (byUser[user] = byUser[user] || []).push(t.receiver.track);
+        });
+
+        const grid = document.getElementById("group-call-grid");
+        grid.querySelectorAll(".group-tile:not(.self)").forEach((tile) => {
+          if (!byUser[tile.dataset.user]) tile.remove();
+        });
+        for (const [user, tracks] of Object.entries(byUser)) {
+          let tile = grid.querySelector(
+            `.group-tile[data-user="${CSS.escape(user)}"]`,
+          );
+          if (!tile) {
+            tile = document.createElement("div");
+            tile.className = "group-tile";
+            tile.dataset.user = user;
+            tile.innerHTML = `<video autoplay playsinline></video>
+              <span class="group-tile-name">${escapeHtml(user)}</span>`;
+            grid.appendChild(tile);
+          }
+          const video = tile.querySelector("video");
+          const current = video.srcObject ? video.srcObject.getTracks() : [];
+          if (
+            current.length !== tracks.length ||
+            tracks.some((track) => !current.includes(track))
+          ) {
+            video.srcObject = new MediaStream(tracks);
+          }
+        }
+        document.getElementById("group-call-count").textContent = `${
+          Object.keys(byUser).length + 1
+        } in call`;
+      }
+
+      function toggleGroupMute() {
+        if (!groupCall) return;
+        const track = groupCall.stream.getAudioTracks()[0];
+        if (!track) return;
+        track.enabled = !track.enabled;
+        const btn = document.getElementById("group-mute-btn");
+        btn.classList.toggle("active", !track.enabled);
+        btn.querySelector(".material-icons").textContent = track.enabled
+          ? "mic"
+          : "mic_off";
+      }
+
+      function leaveGroupCall(notify = true) {
+        if (!groupCall) return;
+        if (notify && groupCall.room) {
+          sendFrame({ type: "sfu_leave", room: groupCall.room });
+        }
+        groupCall.pc.close();
+        groupCall.stream.getTracks().forEach((track) => track.stop());
+        groupCall = null;
+        document.getElementById("group-call-view").style.display = "none";
+        playCallEndSound();
+      }
+
       // ===== WHATSAPP-STYLE CAMERA CONTROLS =====
       let currentFacingMode = "user"; // 'user' = front camera, 'environment' = back camera
       let isSpeakerOn = true;
@@ -2856,6 +4094,7 @@
         for (const [id, msg] of Object.entries(messageCache)) {
           if (
             msg.type === "text" &&
+            (msg.channel || "general") === currentChannel &&
             msg.msg.toLowerCase().includes(lowerQuery)
           ) {
             matches.push(msg);
@@ -2960,23 +4199,19 @@
 
       function addReaction(msgId, emoji) {
         hideAllReactionPickers();
-        ws?.send(
-          JSON.stringify({
-            type: "reaction_add",
-            id: msgId,
-            emoji: emoji,
-          }),
-        );
+        sendFrame({
+          type: "reaction_add",
+          id: msgId,
+          emoji: emoji,
+        });
       }
 
       function removeReaction(msgId, emoji) {
-        ws?.send(
-          JSON.stringify({
-            type: "reaction_remove",
-            id: msgId,
-            emoji: emoji,
-          }),
-        );
+        sendFrame({
+          type: "reaction_remove",
+          id: msgId,
+          emoji: emoji,
+        });
       }
 
       function renderReactions(msgId, reactions) {
@@ -3051,8 +4286,7 @@
 
       // ===== HANDLE NEW MESSAGE TYPES IN WEBSOCKET =====
       const _originalHandleMessage = handleMessage;
-      handleMessage = function (event) {
-        const data = JSON.parse(event.data);
+      handleMessage = function (data) {
 
         // Handle call signaling
         if (data.type === "call_incoming") {
@@ -3116,7 +4350,7 @@
         }
 
         // Call original handler
-        _originalHandleMessage.call(this, event);
+        _originalHandleMessage.call(this, data);
       };
 
       // Close search panel when clicking outside
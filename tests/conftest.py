@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A running app whose database and data/ live in a throwaway folder."""
+    monkeypatch.chdir(tmp_path)
+    with TestClient(main.app) as client:
+        yield client
+
+
+def login(ws, username, password="pw"):
+    """Log a /ws socket in and return the login_success frame."""
+    ws.send_json({"username": username, "password": password})
+    while True:
+        frame = ws.receive_json()
+        if frame.get("type") in ("login_success", "login_failed", "error"):
+            return frame
+
+
+def receive_until(ws, frame_type):
+    while True:
+        frame = ws.receive_json()
+        if frame.get("type") == frame_type:
+            return frame
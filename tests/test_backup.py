@@ -0,0 +1,42 @@
+import os
+
+import main
+
+
+def test_backup_needs_loopback_or_the_backup_token(client, monkeypatch):
+    # TestClient connects as host "testclient", i.e. from another machine
+    assert client.post("/api/backup").status_code == 403
+    monkeypatch.setattr(main, "BACKUP_TOKEN", "s3cret")
+    assert client.post("/api/backup", headers={"Authorization": "Bearer wrong"}).status_code == 403
+    monkeypatch.setattr(main, "manual_backup_limiter", main.RateLimiter(max_requests=2, window_seconds=3600))
+    names = []
+    for _ in range(2):
+        response = client.post("/api/backup", headers={"Authorization": "Bearer s3cret"})
+        assert response.status_code == 200
+        names.append(response.json()["database"])
+    assert client.post("/api/backup", headers={"Authorization": "Bearer s3cret"}).status_code == 429
+    # Two snapshots within the same second must not overwrite each other
+    assert len(set(names)) == 2
+    assert all(os.path.exists(os.path.join(main.BACKUP_DIR, name)) for name in names)
+
+
+def test_database_backup_finishes_while_another_connection_keeps_writing(client, monkeypatch, tmp_path):
+    with main.get_db() as conn:
+        conn.executemany("INSERT INTO users VALUES (?, ?)", [(f"user{i}", "x" * 2000) for i in range(3000)])
+        conn.commit()
+    writer = main.sqlite3.connect(main.DB_NAME, check_same_thread=False, timeout=30)
+    pauses = []
+
+    def write_between_steps(seconds):
+        pauses.append(seconds)
+        writer.execute("INSERT INTO users VALUES (?, ?)", (f"late{len(pauses)}", ""))
+        writer.commit()
+
+    monkeypatch.setattr(main.time, "sleep", write_between_steps)
+    main.backup_database(str(tmp_path / "snapshot.db"))
+    writer.close()
+    # Every stepped attempt was restarted, then the single-step copy finished
+    assert len(pauses) == main.BACKUP_ATTEMPTS
+    snapshot = main.sqlite3.connect(str(tmp_path / "snapshot.db"))
+    assert snapshot.execute("SELECT count(*) FROM users").fetchone()[0] == 3000 + main.BACKUP_ATTEMPTS
+    snapshot.close()
@@ -0,0 +1,25 @@
+import main
+
+
+def statement_labels():
+    return {labels[0] for labels in main.DB_QUERY_SECONDS._values}
+
+
+def test_statement_labels_are_verb_and_table():
+    assert main.statement_label("SELECT id FROM messages WHERE id IN (?,?,?)") == "SELECT messages"
+    assert main.statement_label(f"SELECT id FROM messages WHERE id IN ({','.join('?' * 50)})") == "SELECT messages"
+    assert main.statement_label("INSERT OR IGNORE INTO channel_members VALUES (?, ?)") == "INSERT channel_members"
+    assert main.statement_label("UPDATE messages SET read_by=? WHERE id=?") == "UPDATE messages"
+    assert main.statement_label("delete from voice_notes where media_key=?") == "DELETE voice_notes"
+    assert main.statement_label(main.MESSAGE_RECORD_SELECT) == "SELECT messages"
+    assert main.statement_label("SELECT 1") == "SELECT"
+
+
+def test_connection_shortcuts_are_timed(client):
+    main.DB_QUERY_SECONDS._values.clear()
+    with main.get_db() as conn:
+        conn.execute("CREATE TABLE scratch (x)")
+        conn.executemany("INSERT INTO scratch VALUES (?)", [(1,), (2,)])
+        for size in range(1, 20):
+            conn.execute(f"SELECT x FROM scratch WHERE x IN ({','.join('?' * size)})", list(range(size))).fetchall()
+    assert statement_labels() == {"CREATE scratch", "INSERT scratch", "SELECT scratch"}
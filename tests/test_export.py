@@ -0,0 +1,37 @@
+import io
+import json
+import zipfile
+from datetime import date
+
+import main
+from conftest import login, receive_until
+
+
+def test_export_streams_every_message_across_batches(client, monkeypatch):
+    monkeypatch.setattr(main, "EXPORT_BATCH", 3)
+    with client.websocket_connect("/ws") as ws:
+        token = login(ws, "alice")["token"]
+        uploaded = client.post("/upload", files={"files": ("photo.jpg", b"\xff\xd8" + b"x" * 100, "image/jpeg")})
+        media_key = uploaded.json()["files"][0]["filename"]
+        ws.send_json({"type": "image", "content": media_key, "file_size": 102})
+        receive_until(ws, "image")
+        for i in range(7):
+            ws.send_json({"type": "text", "content": f"message {i}"})
+            receive_until(ws, "text")
+
+    today = date.today().isoformat()
+    response = client.get("/api/export", params={"user": "alice", "token": token, "start": today, "end": today})
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    assert archive.testzip() is None
+    messages = json.loads(archive.read("messages.json"))
+    assert [m["msg"] for m in messages] == [media_key] + [f"message {i}" for i in range(7)]
+    assert archive.namelist() == ["messages.json", "media/" + media_key]
+
+
+def test_export_of_an_empty_range_is_an_empty_list(client):
+    with client.websocket_connect("/ws") as ws:
+        token = login(ws, "alice")["token"]
+    response = client.get("/api/export", params={"user": "alice", "token": token,
+                                                 "start": "2001-01-01", "end": "2001-01-02"})
+    assert json.loads(zipfile.ZipFile(io.BytesIO(response.content)).read("messages.json")) == []
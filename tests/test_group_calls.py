@@ -0,0 +1,52 @@
+import json
+import socket
+import threading
+
+import pytest
+
+import main
+from conftest import login, receive_until
+
+
+@pytest.fixture
+def fake_sfu(monkeypatch):
+    """A control socket that records what the bridge sends and answers nothing."""
+    server = socket.create_server(("127.0.0.1", 0))
+    received = []
+
+    def serve():
+        conn, _ = server.accept()
+        with conn, conn.makefile() as lines:
+            for line in lines:
+                received.append(json.loads(line))
+
+    threading.Thread(target=serve, daemon=True).start()
+    monkeypatch.setattr(main.sfu, "address", "127.0.0.1:%d" % server.getsockname()[1])
+    yield received
+    server.close()
+
+
+def test_only_invited_users_can_join_a_group_call(client, fake_sfu):
+    with client.websocket_connect("/ws") as alice, client.websocket_connect("/ws") as bob, \
+            client.websocket_connect("/ws") as mallory:
+        login(alice, "alice")
+        login(bob, "bob")
+        login(mallory, "mallory")
+        alice.send_json({"type": "sfu_join", "invite": ["bob"], "callType": "video"})
+        room = receive_until(alice, "sfu_joined")["room"]
+        assert len(room) >= 20 and "alice" not in room
+        assert receive_until(bob, "sfu_invite")["room"] == room
+
+        mallory.send_json({"type": "sfu_join", "room": room})
+        assert receive_until(mallory, "error")["msg"] == "That group call has ended or you weren't invited"
+        bob.send_json({"type": "sfu_join", "room": room})
+        assert receive_until(bob, "sfu_joined")["room"] == room
+
+        for ws in (alice, bob):
+            ws.send_json({"type": "sfu_leave", "room": room})
+            ws.send_json({"type": "ping"})
+            receive_until(ws, "pong")
+        # Empty rooms are forgotten, so the id can't be reused later
+        assert room not in main.sfu.rooms
+        bob.send_json({"type": "sfu_join", "room": room})
+        assert receive_until(bob, "error")["msg"] == "That group call has ended or you weren't invited"
@@ -0,0 +1,35 @@
+import asyncio
+import time
+
+import main
+
+
+class SilentSocket:
+    """A half-open client: never answers, and closing it hangs until the send timeout."""
+
+    async def send_text(self, data):
+        await asyncio.sleep(3600)
+
+    async def close(self, code=1000):
+        await asyncio.sleep(3600)
+
+
+def test_silent_clients_are_reaped_together_within_one_pass(monkeypatch):
+    monkeypatch.setattr(main, "WS_SEND_TIMEOUT", 0.5)
+    manager = main.ConnectionManager()
+    sockets = [SilentSocket() for _ in range(6)]
+
+    async def run():
+        silent_since = time.monotonic() - (main.WS_PING_INTERVAL + main.WS_PING_TIMEOUT + 1)
+        for i, ws in enumerate(sockets):
+            manager.active_connections[ws] = f"user{i}"
+            manager.user_sockets[f"user{i}"] = 1
+            manager.last_seen[ws] = silent_since
+        started = time.monotonic()
+        await manager.check_heartbeats()
+        return time.monotonic() - started
+
+    elapsed = asyncio.run(run())
+    assert not manager.active_connections
+    # One close timeout for the whole pass, not one per dead socket
+    assert elapsed < 2 * main.WS_SEND_TIMEOUT
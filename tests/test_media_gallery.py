@@ -0,0 +1,26 @@
+from conftest import login, receive_until
+
+
+def test_gallery_only_lists_media_from_the_callers_channels(client):
+    with client.websocket_connect("/ws") as alice, client.websocket_connect("/ws") as bob, \
+            client.websocket_connect("/ws") as carol:
+        alice_token = login(alice, "alice")["token"]
+        bob_token = login(bob, "bob")["token"]
+        carol_token = login(carol, "carol")["token"]
+        alice.send_json({"type": "dm_open", "user": "bob"})
+        dm = receive_until(alice, "channel_added")["channel"]["id"]
+        uploaded = client.post("/upload", files={"files": ("secret.jpg", b"\xff\xd8" + b"x" * 100, "image/jpeg")})
+        media_key = uploaded.json()["files"][0]["filename"]
+        alice.send_json({"type": "image", "content": media_key, "file_size": 102, "channel": dm})
+        receive_until(alice, "image")
+
+    def listed(user, token):
+        response = client.get("/api/media", params={"user": user, "token": token})
+        assert response.status_code == 200
+        return [item["filename"] for item in response.json()["media"]]
+
+    assert listed("alice", alice_token) == [media_key]
+    assert listed("bob", bob_token) == [media_key]
+    assert listed("carol", carol_token) == []
+    assert client.get("/api/media").status_code == 422
+    assert client.get("/api/media", params={"user": "carol", "token": alice_token}).status_code == 403
@@ -0,0 +1,22 @@
+import main
+from conftest import login
+
+
+def test_issued_token_verifies_for_its_user_only(client):
+    token = main.issue_session_token("alice")
+    assert main.verify_session_token(token, "alice")
+    assert not main.verify_session_token(token, "bob")
+
+
+def test_non_ascii_token_is_rejected_not_raised(client):
+    payload = main.issue_session_token("alice").rsplit(".", 1)[0]
+    for token in (f"{payload}.ü", f"{payload}.\ud800", "é.é.é"):
+        assert not main.verify_session_token(token, "alice")
+    response = client.get("/api/export", params={"user": "alice", "token": f"{payload}.ü",
+                                                 "start": "2024-01-01", "end": "2024-01-02"})
+    assert response.status_code == 403
+    with client.websocket_connect("/ws") as ws:
+        assert login(ws, "alice", password="pw")["type"] == "login_success"
+    with client.websocket_connect("/ws") as ws:
+        ws.send_json({"username": "alice", "password": "wrong", "token": f"{payload}.ü"})
+        assert ws.receive_json()["type"] != "login_success"
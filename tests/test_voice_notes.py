@@ -0,0 +1,30 @@
+import json
+import os
+
+import main
+from conftest import login, receive_until
+
+
+def test_deleting_a_voice_message_removes_opus_copy_and_waveform(client):
+    uploaded = client.post("/upload", files={"files": ("note.webm", b"\x1a\x45\xdf\xa3" + b"0" * 2000, "audio/webm")})
+    media_key = uploaded.json()["files"][0]["filename"]
+    # What the transcoder leaves behind (ffmpeg isn't needed for this)
+    opus_path = main.opus_disk_path(media_key)
+    os.makedirs(os.path.dirname(opus_path), exist_ok=True)
+    with open(opus_path, "wb") as f:
+        f.write(b"opus")
+    with main.get_db() as conn:
+        conn.execute("INSERT INTO voice_notes VALUES (?, ?, ?, ?)", (media_key, 1.5, json.dumps([10, 100]), 4))
+        conn.commit()
+
+    with client.websocket_connect("/ws") as ws:
+        login(ws, "alice")
+        ws.send_json({"type": "voice", "content": media_key, "file_size": 2004})
+        msg_id = receive_until(ws, "voice")["id"]
+        ws.send_json({"type": "delete", "ids": [msg_id]})
+        assert receive_until(ws, "delete_confirmed")["ids"] == [msg_id]
+
+    assert not os.path.exists(main.media_disk_path(media_key))
+    assert not os.path.exists(opus_path)
+    with main.get_db() as conn:
+        assert conn.execute("SELECT 1 FROM voice_notes WHERE media_key=?", (media_key,)).fetchone() is None
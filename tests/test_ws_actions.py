@@ -0,0 +1,11 @@
+from conftest import login, receive_until
+
+
+def test_malformed_ids_get_an_error_frame_and_keep_the_socket(client):
+    with client.websocket_connect("/ws") as ws:
+        login(ws, "alice")
+        for action in ("mark_read", "delete"):
+            ws.send_json({"type": action, "ids": [{}]})
+            assert receive_until(ws, "error")["msg"] == f"Invalid request: '{action}' got a bad item in 'ids'"
+        ws.send_json({"type": "ping"})
+        assert receive_until(ws, "pong")